@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of LolliPop's main steps, on synthetic data of parametrized size.
+
+Each benchmark is timed a few times and the results are written as JSON,
+which can be compared against a previous (baseline) run:
+
+    python benchmarks/bench.py --size small --output results.json
+    python benchmarks/bench.py --size small --compare results.json
+"""
+import pandas as pd
+import numpy as np
+import lollipop as ll
+import click
+import ruamel.yaml
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+from lollipop.cli.getmutations_from_basecount import (
+    scan_basecnt,
+    write_basecnt_store,
+)
+from lollipop.cli.generate_mutlist import generate_mutlist
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# rows of the tally = locations x dates x mutations
+sizes = {
+    "small": dict(
+        locations=2, dates=30, mutations=100, variants=4, bootstrap=5, vocs=20
+    ),
+    "medium": dict(
+        locations=5, dates=120, mutations=300, variants=6, bootstrap=20, vocs=100
+    ),
+    "large": dict(
+        locations=20, dates=365, mutations=1000, variants=10, bootstrap=50, vocs=300
+    ),
+}
+
+benchmarks = []
+
+
+def benchmark(setup):
+    """
+    register a benchmark: setup(params, workdir) prepares the data
+    and returns {case name: callable to time}
+    """
+    benchmarks.append(setup)
+    return setup
+
+
+def synthetic_tally(params, seed=42):
+    """tallymut-like table (as read from TSV), with variant signatures as text labels"""
+    rng = np.random.default_rng(seed)
+    n_mut = params["mutations"]
+    shorts = [f"v{v}" for v in range(params["variants"])]
+    labels = np.array([np.nan, np.nan, np.nan, "mut", "shared", "subset"], dtype=object)
+    pos = np.sort(rng.choice(np.arange(1, 29000), size=n_mut, replace=False))
+    base = rng.choice(list("ACGT-"), size=n_mut)
+    sig = {s: labels[rng.integers(0, labels.size, size=n_mut)] for s in shorts}
+
+    dates = pd.date_range("2021-01-01", periods=params["dates"], freq="D")
+    locations = [f"Plant {i}" for i in range(params["locations"])]
+    idx = pd.MultiIndex.from_product(
+        [locations, dates, range(n_mut)], names=["location", "date", "mut"]
+    ).to_frame(index=False)
+    m = idx["mut"].to_numpy()
+    cov = rng.integers(10, 2000, size=len(idx))
+    var = rng.binomial(cov, rng.random(len(idx)))
+    return pd.DataFrame(
+        {
+            "sample": idx["location"] + "_" + idx["date"].dt.strftime("%Y-%m-%d"),
+            "batch": "b1",
+            "proto": rng.choice(["v3", "v4"], size=len(idx)),
+            "date": idx["date"].dt.strftime("%Y-%m-%d"),
+            "location": idx["location"],
+            "location_code": idx["location"].str.slice(6),
+            "gene": np.where(pos[m] > 21563, "S", "ORF1ab"),
+            "pos": pos[m],
+            "base": base[m],
+            "cov": cov,
+            "var": var,
+            "frac": var / cov,
+            **{s: v[m] for s, v in sig.items()},
+        }
+    )
+
+
+def variants_config(params):
+    shorts = [f"v{v}" for v in range(params["variants"])]
+    return {
+        "variants_list": [f"B.{v}" for v in range(params["variants"])],
+        "variants_pangolin": {s: f"B.{v}" for v, s in enumerate(shorts)},
+        "variants_not_reported": [],
+        "to_drop": ["subset"],
+    }
+
+
+def load_yaml(path):
+    with open(path) as file:
+        return ruamel.yaml.YAML(typ="safe").load(file)
+
+
+def preprocessed(params, compact=False):
+    """single location tally, ready for deconvolution"""
+    conf = variants_config(params)
+    df = synthetic_tally(dict(params, locations=1))
+    return (
+        ll.DataPreprocesser(df)
+        .general_preprocess(**conf, compact=compact)
+        .filter_mutations()
+        .df_tally
+    ), conf["variants_list"] + ["undetermined"]
+
+
+@benchmark
+def bench_kerneldeconv(params, workdir):
+    df, cols = preprocessed(params)
+    kernels = {"gaussian": ll.GaussianKernel(30), "box": ll.BoxKernel(10)}
+    regs = {"nnls": ll.NnlsReg(), "robust": ll.RobustReg(f_scale=0.01)}
+    confints = {
+        "null": ll.NullConfint(),
+        "wald": ll.WaldConfint(),
+        "wald_logit": ll.WaldConfint(scale="logit"),
+    }
+
+    def run(kernel, reg, confint):
+        return lambda: ll.KernelDeconv(
+            df[cols], df["frac"], df["date"], kernel=kernel, reg=reg, confint=confint
+        ).deconv_all(min_tol=1e-3)
+
+    return {
+        f"kerneldeconv[{k}-{r}-{c}]": run(kernel, reg, confint)
+        for k, kernel in kernels.items()
+        for r, reg in regs.items()
+        for c, confint in confints.items()
+    }
+
+
+@benchmark
+def bench_bootstrap(params, workdir):
+    df, cols = preprocessed(params)
+    mutations = pd.Index(df["mutations"].unique())
+    codes = mutations.get_indexer(df["mutations"])
+
+    def run():
+        counts = ll.resample_weights(
+            mutations, params["bootstrap"], rng=np.random.default_rng(42)
+        )
+        agg = ll.ExactQuantiles(params["bootstrap"], (df["date"].nunique(), len(cols)))
+        for fitted in ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            kernel=ll.GaussianKernel(30),
+            confint=ll.NullConfint(),
+        ).deconv_bootstrap(codes, counts, min_tol=1e-3):
+            agg.update(fitted.to_numpy())
+        return agg.quantiles()
+
+    return {"deconv_bootstrap": run}
+
+
+@benchmark
+def bench_preprocess(params, workdir):
+    df = synthetic_tally(params)
+    conf = variants_config(params)
+    filters = load_yaml(os.path.join(repo, "filters_preprint.yaml"))
+    tallies = {
+        compact: ll.DataPreprocesser(df.copy()).general_preprocess(
+            **conf, compact=compact
+        )
+        for compact in (False, True)
+    }
+
+    def preprocess(compact):
+        return lambda: ll.DataPreprocesser(df.copy()).general_preprocess(
+            **conf, compact=compact
+        )
+
+    def filter_mutations(compact):
+        def run():
+            preprocesser = ll.DataPreprocesser(tallies[compact].df_tally.copy())
+            preprocesser.complemented = tallies[compact].complemented
+            return preprocesser.filter_mutations(filters)
+
+        return run
+
+    return {
+        f"{name}[{'compact' if compact else 'default'}]": fn(compact)
+        for name, fn in [
+            ("general_preprocess", preprocess),
+            ("filter_mutations", filter_mutations),
+        ]
+        for compact in (False, True)
+    }
+
+
+@benchmark
+def bench_scan_basecnt(params, workdir):
+    rng = np.random.default_rng(42)
+    length = 29903
+    basecnt = os.path.join(workdir, "basecnt.tsv.gz")
+    pd.DataFrame(
+        rng.integers(0, 500, size=(length, 5)),
+        index=pd.MultiIndex.from_arrays(
+            [["NC_045512.2"] * length, np.arange(1, length + 1)], names=["ref", "pos"]
+        ),
+        columns=pd.MultiIndex.from_product(
+            [["sample"], ["A", "C", "G", "T", "-"]], names=["sample", "base"]
+        ),
+    ).to_csv(basecnt, sep="\t")
+    store = write_basecnt_store(basecnt, workdir, "sample")
+
+    n_mut = params["mutations"] * params["variants"]
+    mut = pd.DataFrame(
+        {
+            "position": np.sort(rng.integers(1, length, size=n_mut)),
+            "reference": "N",
+            "variant": rng.choice(list("ACGT-"), size=n_mut),
+            "gene": "ORF1ab",
+            **{
+                f"v{v}": rng.choice([np.nan, "mut"], size=n_mut)
+                for v in range(params["variants"])
+            },
+        }
+    )
+
+    return {
+        "scan_basecnt[tsv]": lambda: scan_basecnt(basecnt, 1, mut),
+        "scan_basecnt[store]": lambda: scan_basecnt(store, 1, mut),
+    }
+
+
+@benchmark
+def bench_generate_mutlist(params, workdir):
+    rng = np.random.default_rng(42)
+    vocdir = os.path.join(workdir, "vocs")
+    os.makedirs(vocdir, exist_ok=True)
+    pool = [
+        (int(p), f"{rng.choice(list('ACGT'))}>{rng.choice(list('ACGT'))}")
+        for p in rng.choice(np.arange(1, 29000), size=5000, replace=False)
+    ]
+    for v in range(params["vocs"]):
+        lines = [f"variant:\n  short: 'v{v}'\n  pangolin: 'B.1.{v}'\n"]
+        for c in ["mut", "shared"]:
+            lines += [f"{c}:\n"] + [
+                f"  {pool[i][0]}: '{pool[i][1]}'\n"
+                for i in rng.choice(len(pool), size=30, replace=False)
+            ]
+        with open(os.path.join(vocdir, f"v{v}.yaml"), "w") as file:
+            file.writelines(lines)
+
+    def run():
+        generate_mutlist.main(
+            ["-o", os.path.join(workdir, "mutlist.tsv"), "-d", vocdir],
+            standalone_mode=False,
+        )
+
+    return {"generate_mutlist": run}
+
+
+@benchmark
+def bench_deconvolute(params, workdir):
+    """end-to-end command line, with each of the presets"""
+    tally = os.path.join(workdir, "tally.tsv")
+    synthetic_tally(params).to_csv(tally, sep="\t", index=False)
+    yaml = ruamel.yaml.YAML(typ="safe")
+    conf = os.path.join(workdir, "variants_config.yaml")
+    with open(conf, "w") as file:
+        yaml.dump(variants_config(params), file)
+
+    def run(preset):
+        def deconvolute():
+            subprocess.run(
+                [sys.executable, "-m", "lollipop.cli.lollipop", "deconvolute"]
+                + ["-o", os.path.join(workdir, "deconvolved.tsv")]
+                + ["-c", conf, "-k", preset, "-s", "42", tally],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+        return deconvolute
+
+    cases = {}
+    presets = os.path.join(repo, "presets")
+    for name in sorted(os.listdir(presets)):
+        preset = load_yaml(os.path.join(presets, name))
+        if "bootstrap" in preset:
+            # replicates from the benchmark size instead
+            preset["bootstrap"] = params["bootstrap"]
+        path = os.path.join(workdir, name)
+        with open(path, "w") as file:
+            yaml.dump(preset, file)
+        cases[f"deconvolute[{os.path.splitext(name)[0]}]"] = run(path)
+    return cases
+
+
+@benchmark
+def bench_startup(params, workdir):
+    """start-up of the command line: importing lollipop and the dependencies of one subcommand"""
+
+    def run(args):
+        def startup():
+            subprocess.run(
+                [sys.executable, "-m", "lollipop.cli.lollipop"] + args,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+        return startup
+
+    return {
+        "startup[version]": run(["--version"]),
+        "startup[from-basecount]": run(["getmutations", "from-basecount", "--help"]),
+        "startup[deconvolute]": run(["deconvolute", "--help"]),
+    }
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        # the steps' progress messages
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def compare(results, baseline, threshold):
+    """print the ratios against the baseline, returns the names of the regressions"""
+    base = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    print(f"{'benchmark':<55} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for r in results:
+        if r["name"] not in base:
+            continue
+        ratio = r["min"] / base[r["name"]]["min"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(r["name"])
+            flag = "  SLOWER"
+        print(
+            f"{r['name']:<55} {base[r['name']]['min']:>10.4f} {r['min']:>10.4f} {ratio:>7.2f}{flag}"
+        )
+    return regressions
+
+
+@click.command(
+    help="Time LolliPop's main steps on synthetic data, and write the results as JSON",
+)
+@click.option(
+    "--size",
+    "-S",
+    required=False,
+    default="small",
+    type=click.Choice(list(sizes)),
+    help="Size of the synthetic data",
+)
+@click.option(
+    "--param",
+    "-p",
+    "overrides",
+    metavar="NAME=VALUE",
+    required=False,
+    multiple=True,
+    help=f"Override one of the size parameters ({', '.join(sizes['small'])})",
+)
+@click.option(
+    "--filter",
+    "-k",
+    "pattern",
+    metavar="REGEX",
+    required=False,
+    default=None,
+    help="Only run the benchmarks whose name matches",
+)
+@click.option(
+    "--repeat",
+    "-r",
+    required=False,
+    default=3,
+    type=int,
+    help="Number of times each benchmark is timed",
+)
+@click.option(
+    "--output",
+    "-o",
+    metavar="JSON",
+    required=False,
+    default=None,
+    type=click.Path(),
+    help="Write the results to this JSON",
+)
+@click.option(
+    "--compare",
+    "-c",
+    "baseline",
+    metavar="JSON",
+    required=False,
+    default=None,
+    type=click.Path(exists=True),
+    help="Compare against the results of a previous run, exiting with an error on regressions",
+)
+@click.option(
+    "--threshold",
+    "-t",
+    required=False,
+    default=1.2,
+    type=float,
+    help="Ratio of the best times (current / baseline) above which a benchmark is a regression",
+)
+def main(size, overrides, pattern, repeat, output, baseline, threshold):
+    params = dict(sizes[size])
+    for override in overrides:
+        name, value = override.split("=", 1)
+        assert name in params, f"unknown parameter {name}"
+        params[name] = int(value)
+
+    # e.g.: pandas deprecations, not the point here
+    warnings.simplefilter("ignore", FutureWarning)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="lollipop-bench-") as workdir:
+        for setup in benchmarks:
+            with contextlib.redirect_stdout(io.StringIO()):
+                cases = setup(params, workdir)
+            for name, fn in cases.items():
+                if pattern and not re.search(pattern, name):
+                    continue
+                times = timeit(fn, repeat)
+                results.append(
+                    {
+                        "name": name,
+                        "times": times,
+                        "min": min(times),
+                        "median": statistics.median(times),
+                    }
+                )
+                print(f"{name:<55} {min(times):>10.4f}s", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "lollipop": ll.__version__,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.platform(),
+            "size": size,
+            "params": params,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=1)
+
+    if baseline:
+        with open(baseline) as file:
+            baseline = json.load(file)
+        if baseline["meta"]["params"] != params:
+            print("WARNING: the baseline was run with different sizes", file=sys.stderr)
+        if compare(results, baseline, threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,36 @@
-from .preprocessors import DataPreprocesser
-from .kernels import GaussianKernel, BoxKernel
-from .regressors import NnlsReg, RobustReg
-from .confints import NullConfint, WaldConfint, resample_mutations
-from .kerneldeconv import KernelDeconv
+import importlib
+
 from ._version import __version__
+
+# the classes and functions are only imported from their modules when first used,
+# so that e.g. the command line doesn't load pandas and scipy just to print the version
+_exports = {
+    "DataPreprocesser": ".preprocessors",
+    "GaussianKernel": ".kernels",
+    "BoxKernel": ".kernels",
+    "NnlsReg": ".regressors",
+    "RobustReg": ".regressors",
+    "NullConfint": ".confints",
+    "WaldConfint": ".confints",
+    "resample_mutations": ".confints",
+    "resample_weights": ".confints",
+    "KernelDeconv": ".kerneldeconv",
+    "ExactQuantiles": ".aggregators",
+    "P2Quantiles": ".aggregators",
+    "SolveDiagnostics": ".diagnostics",
+}
+
+__all__ = list(_exports) + ["__version__"]
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(_exports[name], __name__), name)
+        # cache, for the next lookups
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
@@ -0,0 +1,129 @@
+import numpy as np
+
+
+class ExactQuantiles:
+    """
+    running mean and exact quantiles of bootstrap replicates,
+    keeping the values of all replicates in a preallocated array
+    """
+
+    def __init__(self, n, shape, quantiles=(0.025, 0.975)):
+        """
+        n (int): maximum number of replicates
+        shape (tuple): shape of the values of each replicate (e.g.: dates x variants)
+        quantiles (list): quantiles to estimate
+        """
+        self.quantile_levels = quantiles
+        self.values = np.empty((n,) + tuple(shape))
+        self.count = 0
+        self.running_mean = np.zeros(shape)
+
+    def update(self, values):
+        """add the values of one replicate"""
+        self.values[self.count] = values
+        self.count += 1
+        self.running_mean += (values - self.running_mean) / self.count
+        return self
+
+    def mean(self):
+        return self.running_mean
+
+    def quantiles(self):
+        """list of arrays, one per quantile level"""
+        return list(
+            np.quantile(self.values[: self.count], q=self.quantile_levels, axis=0)
+        )
+
+
+class P2Quantiles:
+    """
+    running mean and approximate quantiles of bootstrap replicates in fixed memory,
+    using the P-square algorithm (Jain & Chlamtac, 1985) on every value at once
+    """
+
+    def __init__(self, n, shape, quantiles=(0.025, 0.975)):
+        """
+        n (int): maximum number of replicates (unused, memory doesn't depend on it)
+        shape (tuple): shape of the values of each replicate (e.g.: dates x variants)
+        quantiles (list): quantiles to estimate
+        """
+        self.quantile_levels = quantiles
+        self.count = 0
+        self.running_mean = np.zeros(shape)
+        # 5 markers per quantile: heights, positions, desired positions and their increments
+        self.heights = np.empty((len(quantiles), 5) + tuple(shape))
+        self.positions = np.tile(
+            np.arange(5.0).reshape((1, 5) + (1,) * len(shape)),
+            (len(quantiles), 1) + tuple(shape),
+        )
+        p = np.array(quantiles).reshape((-1, 1) + (1,) * len(shape))
+        self.increments = np.concatenate(
+            [np.zeros_like(p), p / 2, p, (1 + p) / 2, np.ones_like(p)], axis=1
+        )
+        self.desired = 4 * self.increments
+
+    def update(self, values):
+        """add the values of one replicate"""
+        self.count += 1
+        self.running_mean += (values - self.running_mean) / self.count
+
+        if self.count <= 5:
+            # initialisation: the first 5 values are the markers
+            self.heights[:, self.count - 1] = values
+            if self.count == 5:
+                self.heights.sort(axis=1)
+            return self
+
+        q, n = self.heights, self.positions
+        # extremes
+        q[:, 0] = np.minimum(q[:, 0], values)
+        q[:, 4] = np.maximum(q[:, 4], values)
+        # cell k such as q[k] <= values < q[k+1], shift the markers above it
+        k = np.clip((values >= q[:, 1:4]).sum(axis=1), 0, 3)
+        n += np.arange(5).reshape((1, 5) + (1,) * (k.ndim - 1)) > np.expand_dims(k, 1)
+        self.desired += self.increments
+
+        # adjust the middle markers
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in (1, 2, 3):
+                d = self.desired[:, i] - n[:, i]
+                move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | (
+                    (d <= -1) & (n[:, i - 1] - n[:, i] < -1)
+                )
+                d = np.sign(d)
+                # piecewise-parabolic prediction
+                parabolic = q[:, i] + d / (n[:, i + 1] - n[:, i - 1]) * (
+                    (n[:, i] - n[:, i - 1] + d)
+                    * (q[:, i + 1] - q[:, i])
+                    / (n[:, i + 1] - n[:, i])
+                    + (n[:, i + 1] - n[:, i] - d)
+                    * (q[:, i] - q[:, i - 1])
+                    / (n[:, i] - n[:, i - 1])
+                )
+                # linear prediction, when the parabolic one isn't between neighbours
+                neighbour = np.where(d > 0, q[:, i + 1], q[:, i - 1])
+                neighbour_pos = np.where(d > 0, n[:, i + 1], n[:, i - 1])
+                linear = q[:, i] + d * (neighbour - q[:, i]) / (neighbour_pos - n[:, i])
+                height = np.where(
+                    (q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1]),
+                    parabolic,
+                    linear,
+                )
+                q[:, i] = np.where(move, height, q[:, i])
+                n[:, i] = np.where(move, n[:, i] + d, n[:, i])
+
+        return self
+
+    def mean(self):
+        return self.running_mean
+
+    def quantiles(self):
+        """list of arrays, one per quantile level"""
+        if self.count < 5:
+            # not enough values yet for the markers: exact
+            return list(
+                np.quantile(
+                    self.heights[0, : self.count], q=self.quantile_levels, axis=0
+                )
+            )
+        return list(self.heights[:, 2])
@@ -1,4 +1,16 @@
+import importlib
+
 from .lollipop import cli
-from .generate_mutlist import generate_mutlist
-from .deconvolute import deconvolute
-from .getmutations_from_basecount import from_basecount
+
+# subcommands, only imported when first used (see LazyGroup)
+_exports = {
+    "generate_mutlist": ".generate_mutlist",
+    "deconvolute": ".deconvolute",
+    "from_basecount": ".getmutations_from_basecount",
+}
+
+
+def __getattr__(name):
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,14 +2,33 @@
 import pandas as pd
 import numpy as np
 import lollipop as ll
-from scipy.optimize import nnls, least_squares
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 import click
 import ruamel.yaml
 import json
 import os
 import sys
+import hashlib
+import pickle
+import zlib
+import functools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from lollipop.cli.profiling import Profiler
+from lollipop.cli.result_cache import ResultCache
+from lollipop.cli.results_io import (
+    output_format,
+    write_covspectrum_json,
+    write_results,
+)
+from lollipop.cli.tally_io import (
+    can_chunk,
+    filters_columns,
+    read_tally_dataset,
+    read_tally_tsv,
+    spill_tally,
+)
 
 
 kernels = {
@@ -24,6 +43,449 @@ regressors = {
     "nnls": ll.NnlsReg,
     "robust": ll.RobustReg,
 }
+aggregators = {
+    "exact": ll.ExactQuantiles,
+    "p2": ll.P2Quantiles,
+}
+
+
+def date_hashes(df, columns):
+    """hash the rows of each date, to detect new or changed observations between runs"""
+    # (columns in a canonical order)
+    rows = pd.util.hash_pandas_object(df[sorted(columns)], index=False).values
+    return {
+        str(date): hashlib.sha1(rows[idx].tobytes()).hexdigest()
+        for date, idx in df.groupby("date").indices.items()
+    }
+
+
+def state_path(incremental, location):
+    """file storing the state of a location between incremental runs"""
+    return os.path.join(
+        incremental, f"{hashlib.sha1(location.encode()).hexdigest()}.pickle"
+    )
+
+
+def location_rng(seed, location):
+    """independent random stream for each location, reproducible from the seed regardless of scheduling"""
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(zlib.crc32(location.encode()),))
+    )
+
+
+def load_spilled(files, preprocess_args, filters=None):
+    """load a location spilled by chunks (see spill_tally), and preprocess it"""
+    preproc = ll.DataPreprocesser(pd.concat([pd.read_pickle(file) for file in files]))
+    preproc = preproc.general_preprocess(**preprocess_args)
+    return preproc.filter_mutations(filters=filters).df_tally
+
+
+def deconv_settings(deconv, no_date=False):
+    """
+    parameters of deconvolute_location (kernel, confint, regressor, bootstrap and their parameters)
+    from a kernel deconvolution configuration (see presets/)
+    """
+    # TODO parameters sanitation (e.g.: JSON schema, check in list)
+    # bootstrap
+    bootstrap = deconv.get("bootstrap", 0)
+    # kernel
+    kernel = kernels.get(deconv.get("kernel"), ll.GaussianKernel)
+    kernel_params = dict(deconv.get("kernel_params", {}))
+    if no_date:
+        print("no_date: overriding kernel bandwidth")
+        kernel_params["bandwidth"] = 1e-17
+    # confint
+    confint = confints.get(deconv.get("confint"), ll.NullConfint)
+    have_confint = confint != ll.NullConfint
+    assert not (
+        have_confint and bootstrap > 1
+    ), f"either use bootstrapping or a confint class, not both at the same time.\nbootstrap: {bootstrap}, confint: {confint}"
+    confint_name = deconv["confint"].capitalize() if have_confint else None
+    confint_params = deconv.get("confint_params", {})
+    # regressor
+    regressor = regressors.get(deconv.get("regressor"), ll.NnlsReg)
+    regressor_params = deconv.get("regressor_params", {})
+    # deconv
+    deconv_params = deconv.get("deconv_params", {})
+    # bootstrap: aggregation of replicates
+    aggregate = deconv.get("bootstrap_aggregate", "exact")
+    assert (
+        aggregate in aggregators or aggregate == "concat"
+    ), f"unknown bootstrap_aggregate {aggregate}, use one of: concat, {', '.join(aggregators)}"
+
+    return dict(
+        bootstrap=bootstrap,
+        kernel=kernel,
+        kernel_params=kernel_params,
+        confint=confint,
+        confint_params=confint_params,
+        confint_name=confint_name,
+        regressor=regressor,
+        regressor_params=regressor_params,
+        deconv_params=deconv_params,
+        aggregate=aggregate,
+    )
+
+
+def deconvolute_location(
+    location,
+    loc_df,
+    date_intervals,
+    var_dates,
+    no_date,
+    bootstrap,
+    kernel,
+    kernel_params,
+    confint,
+    confint_params,
+    confint_name,
+    regressor,
+    regressor_params,
+    deconv_params,
+    aggregate=None,
+    rng=None,
+    incremental=None,
+    fingerprint=None,
+    progress=True,
+    leave=True,
+    profiler=None,
+    diagnostics=None,
+    cache=None,
+):
+    """
+    deconvolve all the dates intervals (and bootstrap replicates) of a single location, returns the list of results
+
+    loc_df (pd.DataFrame or callable): preprocessed data of the location, or function loading it (see load_spilled)
+    profiler (Profiler): records each interval and bootstrap replicate, and the solver calls
+    diagnostics (list): if provided, append the diagnostics of the solves of each interval to it (see SolveDiagnostics)
+    cache (ResultCache): reuse the results of intervals whose rows, variants and parameters are unchanged
+    """
+    if profiler is None:
+        profiler = Profiler()
+    if callable(loc_df):
+        with profiler.stage("load location"):
+            loc_df = loc_df()
+    all_deconv = []
+    loc_state = None
+    if incremental:
+        loc_state = {"fingerprint": fingerprint, "intervals": {}}
+        if os.path.exists(state_path(incremental, location)):
+            with open(state_path(incremental, location), "rb") as file:
+                prev_state = pickle.load(file)
+            if prev_state["fingerprint"] == fingerprint:
+                loc_state["previous"] = prev_state["intervals"]
+    if bootstrap > 1:
+        # draw the resampling of mutations for all replicates at once
+        mutations = pd.Index(loc_df.mutations.unique())
+        counts = ll.resample_weights(mutations, bootstrap, rng=rng)
+
+    for mindate, maxdate in profiler.iterate(
+        (
+            tqdm(date_intervals, desc=location, leave=leave, disable=not progress)
+            if bootstrap > 1 or len(date_intervals) > 1
+            else date_intervals
+        ),
+        "interval",
+        lambda i, interval: dict(zip(["mindate", "maxdate"], interval)),
+    ):
+        if not no_date:
+            # filter by time period for period-specific variants list
+            if maxdate is not None:
+                temp_df2 = loc_df[
+                    loc_df.date.between(mindate, maxdate, inclusive="left")
+                ]
+            else:
+                temp_df2 = loc_df[loc_df.date >= mindate]
+        else:
+            # no date => no filtering
+            temp_df2 = loc_df
+        if temp_df2.size == 0:
+            continue
+
+        # remove uninformative mutations (present either always or never)
+        variants_columns = list(
+            set(var_dates["var_dates"][mindate]) & set(temp_df2.columns)
+        )
+        temp_df2 = temp_df2[
+            ~temp_df2[variants_columns].sum(axis=1).isin([0, len(variants_columns)])
+        ]
+        if temp_df2.size == 0:
+            continue
+
+        cached = None
+        if cache is not None:
+            # unit of work: the rows of the interval, its variants and all the deconvolution parameters
+            columns = (
+                ["date", "frac"] + var_dates["var_dates"][mindate] + ["undetermined"]
+            )
+            key = cache.key(
+                ll.__version__,
+                location,
+                [kernel, kernel_params, confint, confint_params, confint_name],
+                [regressor, regressor_params, deconv_params, bootstrap, aggregate],
+                # (columns in a canonical order)
+                temp_df2[sorted(columns) + (["mutations"] if bootstrap > 1 else [])],
+                # the resampling of the replicates
+                *([mutations, counts] if bootstrap > 1 else []),
+            )
+            cached = cache.get(key)
+
+        # deconvolution
+        # (bootstrap replicates aren't diagnosed)
+        solves = (
+            ll.SolveDiagnostics()
+            if diagnostics is not None and bootstrap <= 1
+            else None
+        )
+        t_kdec = ll.KernelDeconv(
+            temp_df2[var_dates["var_dates"][mindate] + ["undetermined"]],
+            temp_df2["frac"],
+            temp_df2["date"],
+            kernel=kernel(**kernel_params),
+            reg=profiler.wrap(regressor(**regressor_params)),
+            confint=confint(**confint_params),
+            diagnostics=solves,
+        )
+        if bootstrap > 1 and cached is not None:
+            all_deconv += cached
+            continue
+        if bootstrap > 1:
+            interval_deconv = []
+            # all replicates, reweighting the resampled mutations
+            replicates = profiler.iterate(
+                t_kdec.deconv_bootstrap(
+                    mutations.get_indexer(temp_df2["mutations"]),
+                    counts,
+                    **deconv_params,
+                ),
+                "replicate",
+            )
+            if aggregate in aggregators:
+                # summarize each replicate as it finishes
+                index = t_kdec.output_dates()
+                agg = aggregators[aggregate](
+                    bootstrap, (len(index), len(t_kdec.variant_names))
+                )
+                for res in replicates:
+                    # missing fits (e.g.: no resampled observation on a date) count as 0,
+                    # as when aggregating the concatenated replicates (see aggregate_results)
+                    agg.update(np.nan_to_num(res.values))
+                for estimate, values in zip(
+                    ["mean", "quantile_lower", "quantile_upper"],
+                    [agg.mean()] + agg.quantiles(),
+                ):
+                    res = pd.DataFrame(
+                        values, columns=t_kdec.variant_names, index=index
+                    )
+                    res["location"] = location
+                    res["estimate"] = estimate
+                    interval_deconv.append(res)
+            else:
+                for res in replicates:
+                    res["location"] = location
+                    interval_deconv.append(res)
+            if cache is not None:
+                cache.put(key, interval_deconv)
+            all_deconv += interval_deconv
+            continue
+
+        if cached is not None:
+            fitted, conf_bands = cached
+            if loc_state is not None:
+                loc_state["intervals"][mindate] = {
+                    "hashes": date_hashes(temp_df2, columns),
+                    "fitted": fitted.copy(),
+                    "conf_bands": conf_bands,
+                }
+        elif loc_state is not None:
+            # only recompute the dates within reach of new or changed observations
+            hashes = date_hashes(
+                temp_df2,
+                ["date", "frac"] + var_dates["var_dates"][mindate] + ["undetermined"],
+            )
+            prev = loc_state.get("previous", {}).get(mindate)
+            if prev is not None:
+                changed = [
+                    date
+                    for date in set(hashes) | set(prev["hashes"])
+                    if hashes.get(date) != prev["hashes"].get(date)
+                ]
+                t_kdec = t_kdec.deconv_all(
+                    **deconv_params,
+                    dates=t_kdec.affected_dates(
+                        changed, deconv_params.get("min_tol", 1e-10)
+                    ),
+                ).merge_previous(prev["fitted"], prev["conf_bands"])
+            else:
+                t_kdec = t_kdec.deconv_all(**deconv_params)
+            loc_state["intervals"][mindate] = {
+                "hashes": hashes,
+                "fitted": t_kdec.fitted.copy(),
+                "conf_bands": t_kdec.conf_bands,
+            }
+        else:
+            t_kdec = t_kdec.deconv_all(**deconv_params)
+        if cached is None:
+            fitted, conf_bands = t_kdec.fitted, t_kdec.conf_bands
+            if cache is not None:
+                cache.put(key, (fitted, conf_bands))
+        if confint != ll.NullConfint:
+            # with conf int
+            res = fitted.copy()
+            res["location"] = location
+            res["estimate"] = "MSE"
+            all_deconv.append(res)
+
+            res_lower = conf_bands["lower"].copy()
+            res_lower["location"] = location
+            res_lower["estimate"] = f"{confint_name}_lower"
+            all_deconv.append(res_lower)
+
+            res_upper = conf_bands["upper"].copy()
+            res_upper["location"] = location
+            res_upper["estimate"] = f"{confint_name}_upper"
+            all_deconv.append(res_upper)
+        else:
+            # without conf int
+            res = fitted.copy()
+            res["location"] = location
+            all_deconv.append(res)
+        if solves is not None:
+            diagnostics.append(solves.to_frame(location=location, interval=mindate))
+
+    if loc_state is not None:
+        loc_state.pop("previous", None)
+        with open(state_path(incremental, location), "wb") as file:
+            pickle.dump(loc_state, file)
+
+    return all_deconv
+
+
+def location_worker(location, loc_df, profile=False, diagnostics=False, **kwargs):
+    """
+    deconvolute_location in its own process (e.g.: a worker of the pool),
+    returns the list of results, the profiling records (see Profiler.merge)
+    and the list of diagnostics (None unless diagnostics is set)
+    """
+    profiler = Profiler(enabled=profile)
+    solves = [] if diagnostics else None
+    with profiler.stage("location", location=location):
+        all_deconv = deconvolute_location(
+            location, loc_df, profiler=profiler, diagnostics=solves, **kwargs
+        )
+    return all_deconv, profiler.records, solves
+
+
+def aggregate_results(all_deconv, variants_list, settings, variants_dates=None):
+    """
+    combine the results of deconvolute_location into a table with one row per location, variant and date,
+    and columns for the proportion and its confidence interval (if any), as exported
+
+    settings (dict): as returned by deconv_settings
+    returns: the table, and the mapping of the columns of the results to its columns
+    """
+    bootstrap = settings["bootstrap"]
+    confint_name = settings["confint_name"]
+    confint_params = settings["confint_params"]
+    have_confint = settings["confint"] != ll.NullConfint
+    have_estimates = have_confint or (
+        bootstrap > 1 and settings["aggregate"] in aggregators
+    )
+
+    deconv_df = pd.concat(all_deconv)
+    if not have_confint:
+        deconv_df = deconv_df.fillna(0)
+
+    id_vars = ["location"]
+    if have_estimates:
+        id_vars += ["estimate"]
+
+    # variants actually in dataframe
+    found_var = list(set(variants_list) & set(deconv_df.columns))
+    if len(found_var) < len(variants_list):
+        print(
+            f"some variants never found in dataset {set(variants_list) - set(found_var)}. Check the dates in {variants_dates}",
+            file=sys.stderr,
+        )
+
+    # deconv output
+    deconv_df_flat = deconv_df.melt(
+        id_vars=id_vars,
+        value_vars=found_var + ["undetermined"],
+        var_name="variant",
+        value_name="frac",
+        ignore_index=False,
+    )
+    # deconv_df_flat.to_csv(out_flat, sep="\t", index_label="date")
+
+    # aggregation
+    agg_columns = ["location", "variant", "index"]
+    if bootstrap > 1 and not have_estimates:
+        # bootstrap => mean + quantiles
+        deconv_df_agg = (
+            deconv_df_flat.reset_index()
+            .groupby(agg_columns)
+            .agg(
+                [
+                    "mean",
+                    lambda x: np.quantile(x, q=0.025),
+                    lambda x: np.quantile(x, q=0.975),
+                ]
+            )
+            .reset_index()
+        )
+
+        export_columns = {
+            ("index", ""): "date",
+            ("frac", "mean"): "proportion",
+            ("frac", "<lambda_0>"): "proportionLower",
+            ("frac", "<lambda_1>"): "proportionUpper",
+        }
+    elif have_estimates:
+        # wald, or bootstrap aggregated per replicate => pivot
+        deconv_df_agg = (
+            deconv_df_flat.reset_index()
+            .pivot(index=agg_columns, columns="estimate")
+            .reset_index()
+        )
+
+        export_columns = (
+            {
+                ("index", ""): "date",
+                ("frac", "MSE"): "proportion",
+                ("frac", f"{confint_name}_lower"): "proportionLower",
+                ("frac", f"{confint_name}_upper"): "proportionUpper",
+            }
+            if have_confint
+            else {
+                ("index", ""): "date",
+                ("frac", "mean"): "proportion",
+                ("frac", "quantile_lower"): "proportionLower",
+                ("frac", "quantile_upper"): "proportionUpper",
+            }
+        )
+    else:
+        # no conf => as-is
+        deconv_df_agg = deconv_df_flat.reset_index()[agg_columns + ["frac"]]
+        export_columns = {
+            "index": "date",
+            "frac": "proportion",
+        }
+    deconv_df_agg.columns = [
+        export_columns.get(col, "".join(col) if type(col) is tuple else col)
+        for col in deconv_df_agg.columns.values
+    ]
+    deconv_df_agg = deconv_df_agg.sort_values(by=["location", "variant", "date"])
+    # reverse logit scale
+    if have_confint and confint_params.get("scale", "linear") == "logit":
+        deconv_df_agg[["proportionLower", "proportionUpper"]] = deconv_df_agg[
+            ["proportionLower", "proportionUpper"]
+        ].applymap(
+            lambda x: np.exp(np.clip(x, -100, 100))
+            / (1 + np.exp(np.clip(x, -100, 100)))
+        )
+
+    return deconv_df_agg, export_columns
 
 
 @click.command(
@@ -39,6 +501,15 @@ regressors = {
     type=str,
     help="Write results to this output CSV instead of 'deconvolved.csv'",
 )
+@click.option(
+    "--format",
+    "-F",
+    "out_format",
+    required=False,
+    default=None,
+    type=click.Choice(["tsv", "parquet", "arrow"]),
+    help="Format of the output: tab-separated text, or typed columns in a Parquet or Arrow IPC file (default: guessed from the extension, e.g. '.parquet', '.arrow' or '.feather', otherwise TSV)",
+)
 @click.option(
     "--fmt-columns",
     "-C",
@@ -112,6 +583,64 @@ regressors = {
     type=int,
     help="Seed the random generator",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    metavar="N",
+    required=False,
+    default=None,
+    type=int,
+    help="Number of locations to process in parallel (default: 'n_jobs' from the deconv config, or 1)",
+)
+@click.option(
+    "--incremental",
+    "-i",
+    metavar="DIR",
+    required=False,
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Keep per-location state in this directory between runs, and only recompute dates within reach of new or changed observations",
+)
+@click.option(
+    "--chunk-size",
+    metavar="ROWS",
+    required=False,
+    default=None,
+    type=int,
+    help="Read the tally by chunks of this many rows, spilling each location to a temporary directory, to bound memory usage",
+)
+@click.option(
+    "--profile",
+    metavar="JSON",
+    required=False,
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write a profiling report to this JSON: wall time, CPU time, peak memory and solver calls of each stage, location, interval and bootstrap replicate",
+)
+@click.option(
+    "--diagnostics",
+    metavar="FILE",
+    required=False,
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write diagnostics of each solve (location, date) to this sidecar file: rows and mass of the kernel support, solver evaluations and status, solve time, condition numbers of the kernel-weighted Gram matrix and of the Fisher information of Wald confints (format guessed from the extension as for the output)",
+)
+@click.option(
+    "--cache",
+    metavar="DIR",
+    required=False,
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Cache the results of each location and dates interval in this directory, and reuse them when their input rows, variants and parameters are unchanged",
+)
+@click.option(
+    "--cache-size",
+    metavar="MB",
+    required=False,
+    default=1024,
+    type=int,
+    help="Evict the least recently used results when the cache grows above this size (default: 1024)",
+)
 @click.argument("tally_data", metavar="TALLY_TSV", nargs=1)
 def deconvolute(
     variants_config,
@@ -121,13 +650,23 @@ def deconvolute(
     filters,
     seed,
     output,
+    out_format,
     fmt_columns,
     out_json,
+    jobs,
+    incremental,
+    chunk_size,
+    profile,
+    diagnostics,
+    cache,
+    cache_size,
     tally_data,
 ):
+    profiler = Profiler(enabled=profile is not None)
     # load data
     yaml = ruamel.yaml.YAML(typ="rt")
     print("load data")
+    profiler.section("load data")
     with open(variants_config, "r") as file:
         conf_yaml = yaml.load(file)
     variants_pangolin = conf_yaml["variants_pangolin"]
@@ -139,6 +678,7 @@ def deconvolute(
     start_date = conf_yaml.get("start_date", None)
     end_date = conf_yaml.get("end_date", None)
     remove_deletions = conf_yaml.get("remove_deletions", True)
+    compact = conf_yaml.get("compact", False)
     locations_list = loc if loc and len(loc) else conf_yaml.get("locations_list", None)
 
     # kernel deconvolution params
@@ -155,84 +695,99 @@ def deconvolute(
         filters = None
 
     # data
-    try:
-        df_tally = pd.read_csv(
-            tally_data, sep="\t", parse_dates=["date"], dtype={"location_code": "str"}
-        )
-    except ValueError:
-        df_tally = pd.read_csv(tally_data, sep="\t", dtype={"location_code": "str"})
-
-    # handle location
-    if not no_loc and "location" not in df_tally.columns:
-        if "location_code" in df_tally.columns:
-            print("NOTE: No location fullnames, using codes instead")
-            df_tally["location"] = df_tally["location_code"]
-        elif len(locations_list) == 1:
-            print(
-                "WARNING: No location in input data, assuming everything is {locations_list[0]}"
-            )
-            df_tally["location"] = locations_list[0]
-        elif locations_list is None:
-            print(
-                f"WARNING: No location in input data. Either pass one with `--loc`/`locations_list` parameter  or set true the `no_loc` parameter {variants_config}"
-            )
-            no_loc = True
-        else:
-            print(
-                f"ERROR: No location in input data. Either pass exactly one with `--loc`/`locations_list` parameter or set true the `no_loc` parameter {variants_config}"
+    if os.path.isdir(tally_data):
+        # partitioned dataset (see tally-to-parquet): only read what will be used
+        df_tally = read_tally_dataset(
+            tally_data,
+            columns=set(
+                ["sample", "date", "location", "location_code", "pos", "base"]
+                + ["frac", "mutations"]
+                + list(variants_pangolin.keys())
+                + list(variants_pangolin.values())
             )
-            sys.exit(1)
+            | filters_columns(filters),
+            locations=locations_list if not no_loc else None,
+            start_date=start_date if not no_date else None,
+            end_date=end_date if not no_date else None,
+        )
+    elif chunk_size and not no_date and can_chunk(tally_data, locations_list, no_loc):
+        # read and spill per location by chunks (see below, "preprocess data")
+        df_tally = None
+    else:
+        df_tally = read_tally_tsv(tally_data)
 
-    if no_loc:
-        if "location" in df_tally:
-            locations_list = list(set(df_tally["location"].unique()) - {"", np.nan})
-            if len(locations_list):
+    if df_tally is not None:
+        # handle location
+        if not no_loc and "location" not in df_tally.columns:
+            if "location_code" in df_tally.columns:
+                print("NOTE: No location fullnames, using codes instead")
+                df_tally["location"] = df_tally["location_code"]
+            elif len(locations_list) == 1:
                 print(
-                    f"WARNING: no_loc is set, but there are still locations in input: {locations_list}"
+                    "WARNING: No location in input data, assuming everything is {locations_list[0]}"
+                )
+                df_tally["location"] = locations_list[0]
+            elif locations_list is None:
+                print(
+                    f"WARNING: No location in input data. Either pass one with `--loc`/`locations_list` parameter  or set true the `no_loc` parameter {variants_config}"
+                )
+                no_loc = True
+            else:
+                print(
+                    f"ERROR: No location in input data. Either pass exactly one with `--loc`/`locations_list` parameter or set true the `no_loc` parameter {variants_config}"
+                )
+                sys.exit(1)
+
+        if no_loc:
+            if "location" in df_tally:
+                locations_list = list(set(df_tally["location"].unique()) - {"", np.nan})
+                if len(locations_list):
+                    print(
+                        f"WARNING: no_loc is set, but there are still locations in input: {locations_list}"
+                    )
+            else:
+                print(
+                    "no_loc: ignoring location information and treating all input as a single location"
                 )
-        else:
-            print(
-                "no_loc: ignoring location information and treating all input as a single location"
-            )
 
-        df_tally["location"] = "location"
-        locations_list = ["location"]
+            df_tally["location"] = "location"
+            locations_list = ["location"]
 
-    if locations_list is None:
-        # remember to remove empty cells: nan or empty cells
-        locations_list = list(set(df_tally["location"].unique()) - {"", np.nan})
-        print(locations_list)
-    else:
-        bad_locations = set(locations_list) - set(df_tally["location"].unique())
-        assert 0 == len(
-            bad_locations
-        ), f"Bad locations in list: {bad_locations}, please fix {variants_config}."
-        # locations_list = list(set(locations_list) - bad_locations)
-
-    # check if dates are present
-    if "date" not in df_tally.columns or all(df_tally["date"].isna()):
-        if not no_date:
-            no_date = True
-            print(
-                f"WARNING: No dates found in input data, automatically switching `no_date` !!!\n\tPlease either check input if this is not expected or add set true the `no_date` parameter to your {variants_config}"
+        if locations_list is None:
+            # remember to remove empty cells: nan or empty cells
+            locations_list = list(set(df_tally["location"].unique()) - {"", np.nan})
+            print(locations_list)
+        else:
+            bad_locations = set(locations_list) - set(df_tally["location"].unique())
+            assert 0 == len(
+                bad_locations
+            ), f"Bad locations in list: {bad_locations}, please fix {variants_config}."
+            # locations_list = list(set(locations_list) - bad_locations)
+
+        # check if dates are present
+        if "date" not in df_tally.columns or all(df_tally["date"].isna()):
+            if not no_date:
+                no_date = True
+                print(
+                    f"WARNING: No dates found in input data, automatically switching `no_date` !!!\n\tPlease either check input if this is not expected or add set true the `no_date` parameter to your {variants_config}"
+                )
+        # no date!!!
+        if no_date:
+            print("no_date: special mode for deconvoluting without time component")
+            # HACK dummy date to keep the deconvolution kernel happy
+            # add dummy date
+            date_dict = dict(
+                zip(
+                    df_tally["sample"].unique(),
+                    [
+                        str(np.datetime64("1999-12-01") + np.timedelta64(i, "D"))
+                        for i in range(len(df_tally["sample"].unique()))
+                    ],
+                )
             )
-    # no date!!!
-    if no_date:
-        print("no_date: special mode for deconvoluting without time component")
-        # HACK dummy date to keep the deconvolution kernel happy
-        # add dummy date
-        date_dict = dict(
-            zip(
-                df_tally["sample"].unique(),
-                [
-                    str(np.datetime64("1999-12-01") + np.timedelta64(i, "D"))
-                    for i in range(len(df_tally["sample"].unique()))
-                ],
+            df_tally["date"] = pd.to_datetime(
+                np.array([date_dict[i] for i in df_tally["sample"]])
             )
-        )
-        df_tally["date"] = pd.to_datetime(
-            np.array([date_dict[i] for i in df_tally["sample"]])
-        )
 
     # dates intervals for which to apply different variants as discovered using cojac
     if variants_dates:
@@ -243,21 +798,22 @@ def deconvolute(
         with open(variants_dates, "r") as file:
             var_dates = yaml.load(file)
 
-        all_var_dates = set(
-            [var for lst in var_dates["var_dates"].values() for var in lst]
+        # (in order of appearance: stable between runs, see --incremental and --cache)
+        all_var_dates = list(
+            dict.fromkeys(var for lst in var_dates["var_dates"].values() for var in lst)
         )
 
         if variants_list is None:
             # build list of all variants from var_dates (if we did lack one)
-            variants_list = list(all_var_dates)
+            variants_list = all_var_dates
         else:
             # have list => double - check it against var_dates
-            not_on_date = list(set(variants_list) - all_var_dates)
+            not_on_date = [var for var in variants_list if var not in all_var_dates]
             if len(not_on_date):
                 print(
                     f"NOTE: {not_on_date} never used in {variants_dates}, despite being in variants_list"
                 )
-            not_on_list = list(all_var_dates - set(variants_list))
+            not_on_list = [var for var in all_var_dates if var not in variants_list]
             if len(not_on_list):
                 print(
                     f"WARNING: {variants_dates} lists variants: {not_on_list}, but they are not in variants_list"
@@ -266,7 +822,7 @@ def deconvolute(
     else:
         if variants_list is None:
             # build list of all variants from lineage map (if we did lack one)
-            variants_list = list(set(variants_pangolin.values()))
+            variants_list = list(dict.fromkeys(variants_pangolin.values()))
 
         if no_date:
             # dummy date
@@ -295,8 +851,8 @@ def deconvolute(
                 print(f"from {mindate} onward: {var_dates['var_dates'][mindate]}")
 
     print("preprocess data")
-    preproc = ll.DataPreprocesser(df_tally)
-    preproc = preproc.general_preprocess(
+    profiler.section("preprocess data")
+    preprocess_args = dict(
         variants_list=variants_list,
         variants_pangolin=variants_pangolin,
         variants_not_reported=variants_not_reported,
@@ -306,225 +862,203 @@ def deconvolute(
         no_date=no_date,
         remove_deletions=remove_deletions,
     )
-    preproc = preproc.filter_mutations(filters=filters)
+    if df_tally is None:
+        # bounded memory: select rows chunk by chunk, spilling each location to disk
+        spill_dir = tempfile.TemporaryDirectory(prefix="lollipop-")
+
+        def prefilter_chunk(chunk):
+            """location (see handle location above) and row selection of a chunk"""
+            if no_loc:
+                chunk["location"] = "location"
+            elif "location" not in chunk.columns:
+                chunk["location"] = (
+                    chunk["location_code"]
+                    if "location_code" in chunk.columns
+                    else locations_list[0]
+                )
+            return ll.DataPreprocesser(chunk).prefilter(**preprocess_args).df_tally
+
+        spilled = spill_tally(
+            tally_data,
+            spill_dir.name,
+            chunk_size,
+            preprocess=prefilter_chunk,
+            locations=locations_list if not no_loc else None,
+        )
+        if not spilled:
+            print(
+                f"ERROR: No data left in {tally_data} after selecting locations and dates (for data without dates, set true the `no_date` parameter in {variants_config})"
+            )
+            sys.exit(1)
+        if no_loc:
+            locations_list = ["location"]
+        elif locations_list is None:
+            # remember to remove empty cells
+            locations_list = list(set(spilled) - {""})
+            print(locations_list)
+        else:
+            bad_locations = set(locations_list) - set(spilled)
+            assert 0 == len(
+                bad_locations
+            ), f"Bad locations in list: {bad_locations}, please fix {variants_config}."
+        preprocess_args["compact"] = compact
+        sizes = pd.Series(
+            {
+                location: sum(os.path.getsize(file) for file in files)
+                for location, files in spilled.items()
+            }
+        )
+    else:
+        preproc = ll.DataPreprocesser(df_tally)
+        preproc = preproc.general_preprocess(**preprocess_args, compact=compact)
+        preproc = preproc.filter_mutations(filters=filters)
 
     print("deconvolve all")
+    profiler.section("deconvolve all")
     np.random.seed(seed)
     all_deconv = []
-    # TODO parameters sanitation (e.g.: JSON schema, check in list)
-    # bootstrap
-    bootstrap = deconv.get("bootstrap", 0)
-    # kernel
-    kernel = kernels.get(deconv.get("kernel"), ll.GaussianKernel)
-    kernel_params = deconv.get("kernel_params", {})
-    if no_date:
-        print("no_date: overriding kernel bandwidth")
-        kernel_params["bandwidth"] = 1e-17
-    # confint
-    confint = confints.get(deconv.get("confint"), ll.NullConfint)
+    all_solves = [] if diagnostics else None
+    settings = deconv_settings(deconv, no_date)
+    bootstrap = settings["bootstrap"]
+    confint = settings["confint"]
+    confint_name = settings["confint_name"]
+    confint_params = settings["confint_params"]
     have_confint = confint != ll.NullConfint
-    assert not (
-        have_confint and bootstrap > 1
-    ), f"either use bootstrapping or a confint class, not both at the same time.\nbootstrap: {bootstrap}, confint: {confint}"
-    confint_name = deconv["confint"].capitalize() if have_confint else None
-    confint_params = deconv.get("confint_params", {})
-    # regressor
-    regressor = regressors.get(deconv.get("regressor"), ll.NnlsReg)
-    regressor_params = deconv.get("regressor_params", {})
-    # deconv
-    deconv_params = deconv.get("deconv_params", {})
     print(
         f""" parameters:
   bootstrap: {bootstrap}
-  kernel: {kernel}
-   params: {kernel_params}
+  kernel: {settings["kernel"]}
+   params: {settings["kernel_params"]}
   confint: {confint}
    params: {confint_params}
    name: {confint_name}
    non-dummy: {have_confint}
-  regressor: {regressor}
-   params: {regressor_params}
+  regressor: {settings["regressor"]}
+   params: {settings["regressor_params"]}
   deconv:
-   params: {deconv_params}"""
+   params: {settings["deconv_params"]}"""
     )
 
-    # do it
-    for location in tqdm(locations_list) if len(locations_list) > 1 else locations_list:
-        if bootstrap <= 1 and len(date_intervals) <= 1:
-            tqdm.write(location)
-        # select the current location
-        loc_df = (
-            preproc.df_tally[preproc.df_tally["location"] == location]
-            if not no_loc
-            else preproc.df_tally
+    # incremental: state of previous runs
+    if incremental and bootstrap > 1:
+        print(
+            "WARNING: bootstrapping resamples all dates, ignoring `--incremental`",
+            file=sys.stderr,
         )
-        for b in (
-            trange(bootstrap, desc=location, leave=(len(locations_list) > 1))
-            if bootstrap > 1
-            else [0]
-        ):
-            if bootstrap > 1:
-                # resample if we're doing bootstrapping
-                temp_dfb = ll.resample_mutations(loc_df, loc_df.mutations.unique())[0]
-            else:
-                # just run one on everything
-                temp_dfb = loc_df
-
-            for mindate, maxdate in (
-                tqdm(date_intervals, desc=location)
-                if bootstrap <= 1 and len(date_intervals) > 1
-                else date_intervals
-            ):
-                if not no_date:
-                    # filter by time period for period-specific variants list
-                    if maxdate is not None:
-                        temp_df2 = temp_dfb[
-                            temp_dfb.date.between(mindate, maxdate, inclusive="left")
-                        ]
-                    else:
-                        temp_df2 = temp_dfb[temp_dfb.date >= mindate]
-                else:
-                    # no date => no filtering
-                    temp_df2 = temp_dfb
-                if temp_df2.size == 0:
-                    continue
-
-                # remove uninformative mutations (present either always or never)
-                variants_columns = list(
-                    set(var_dates["var_dates"][mindate]) & set(temp_df2.columns)
-                )
-                temp_df2 = temp_df2[
-                    ~temp_df2[variants_columns]
-                    .sum(axis=1)
-                    .isin([0, len(variants_columns)])
-                ]
-                if temp_df2.size == 0:
-                    continue
-
-                # resampling weights
-                if bootstrap > 1:
-                    weights = {"weights": temp_df2["resample_value"]}
-                else:
-                    # just run one on everything
-                    weights = {}
-
-                # deconvolution
-                t_kdec = ll.KernelDeconv(
-                    temp_df2[var_dates["var_dates"][mindate] + ["undetermined"]],
-                    temp_df2["frac"],
-                    temp_df2["date"],
-                    kernel=kernel(**kernel_params),
-                    reg=regressor(**regressor_params),
-                    confint=confint(**confint_params),
-                    **weights,
-                )
-                t_kdec = t_kdec.deconv_all(**deconv_params)
-                if have_confint:
-                    # with conf int
-                    res = t_kdec.fitted.copy()
-                    res["location"] = location
-                    res["estimate"] = "MSE"
-                    all_deconv.append(res)
-
-                    res_lower = t_kdec.conf_bands["lower"].copy()
-                    res_lower["location"] = location
-                    res_lower["estimate"] = f"{confint_name}_lower"
-                    all_deconv.append(res_lower)
-
-                    res_upper = t_kdec.conf_bands["upper"].copy()
-                    res_upper["location"] = location
-                    res_upper["estimate"] = f"{confint_name}_upper"
-                    all_deconv.append(res_upper)
-                else:
-                    # without conf int
-                    res = t_kdec.fitted
-                    res["location"] = location
-                    all_deconv.append(res)
-
-    print("post-process data")
-    deconv_df = pd.concat(all_deconv)
-    if not have_confint:
-        deconv_df = deconv_df.fillna(0)
-
-    id_vars = ["location"]
-    if have_confint:
-        id_vars += ["estimate"]
-
-    # variants actually in dataframe
-    found_var = list(set(variants_list) & set(deconv_df.columns))
-    if len(found_var) < len(variants_list):
+        incremental = None
+    if incremental and no_date:
         print(
-            f"some variants never found in dataset {set(variants_list) - set(found_var)}. Check the dates in {variants_dates}",
+            "WARNING: dummy dates of no_date are not stable between runs, ignoring `--incremental`",
             file=sys.stderr,
         )
+        incremental = None
+    if incremental:
+        os.makedirs(incremental, exist_ok=True)
+        # any change of parameters invalidates the previous results
+        fingerprint = hashlib.sha1(
+            json.dumps(
+                [
+                    ll.__version__,
+                    conf_yaml,
+                    sorted(variants_list),
+                    var_dates,
+                    deconv,
+                    filters,
+                ],
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
 
-    # deconv output
-    deconv_df_flat = deconv_df.melt(
-        id_vars=id_vars,
-        value_vars=found_var + ["undetermined"],
-        var_name="variant",
-        value_name="frac",
-        ignore_index=False,
+    # results of previous runs, per location and interval
+    if cache:
+        if bootstrap > 1 and seed is None:
+            print(
+                "WARNING: bootstrapping without `--seed` draws new replicates on each run, they can't be reused from `--cache`",
+                file=sys.stderr,
+            )
+        cache = ResultCache(cache, cache_size * 1024**2)
+
+    # do it
+    n_jobs = jobs if jobs is not None else deconv.get("n_jobs", 1)
+    location_args = dict(
+        date_intervals=date_intervals,
+        var_dates=var_dates,
+        no_date=no_date,
+        **settings,
+        incremental=incremental,
+        fingerprint=fingerprint if incremental else None,
+        cache=cache,
     )
-    # deconv_df_flat.to_csv(out_flat, sep="\t", index_label="date")
 
-    # aggregation
-    agg_columns = ["location", "variant", "index"]
-    if bootstrap > 1:
-        # bootstrap => mean + quantiles
-        deconv_df_agg = (
-            deconv_df_flat.reset_index()
-            .groupby(agg_columns)
-            .agg(
-                [
-                    "mean",
-                    lambda x: np.quantile(x, q=0.025),
-                    lambda x: np.quantile(x, q=0.975),
-                ]
+    def select_location(location):
+        """select the current location (spilled: loaded and preprocessed only when deconvolving it)"""
+        if df_tally is None:
+            return functools.partial(
+                load_spilled, spilled[location], preprocess_args, filters
             )
-            .reset_index()
-        )
-
-        export_columns = {
-            ("index", ""): "date",
-            ("frac", "mean"): "proportion",
-            ("frac", "<lambda_0>"): "proportionLower",
-            ("frac", "<lambda_1>"): "proportionUpper",
-        }
-    elif have_confint:
-        # wald => pivot
-        deconv_df_agg = (
-            deconv_df_flat.reset_index()
-            .pivot(index=agg_columns, columns="estimate")
-            .reset_index()
+        return (
+            preproc.df_tally[preproc.df_tally["location"] == location]
+            if not no_loc
+            else preproc.df_tally
         )
 
-        export_columns = {
-            ("index", ""): "date",
-            ("frac", "MSE"): "proportion",
-            ("frac", f"{confint_name}_lower"): "proportionLower",
-            ("frac", f"{confint_name}_upper"): "proportionUpper",
-        }
+    if n_jobs > 1 and len(locations_list) > 1:
+        # locations are independent: process them in parallel, largest first
+        if df_tally is not None:
+            sizes = preproc.df_tally["location"].value_counts()
+        loc_results = {}
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {
+                executor.submit(
+                    location_worker,
+                    location,
+                    select_location(location),
+                    rng=location_rng(seed, location),
+                    progress=False,
+                    profile=profiler.enabled,
+                    diagnostics=diagnostics is not None,
+                    **location_args,
+                ): location
+                for location in sorted(
+                    locations_list, key=lambda l: sizes.get(l, 0), reverse=True
+                )
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                loc_results[futures[future]] = future.result()
+                profiler.merge(loc_results[futures[future]][1])
+        # keep the order of locations
+        for location in locations_list:
+            all_deconv += loc_results[location][0]
+            if diagnostics:
+                all_solves += loc_results[location][2]
     else:
-        # no conf => as-is
-        deconv_df_agg = deconv_df_flat.reset_index()[agg_columns + ["frac"]]
-        export_columns = {
-            "index": "date",
-            "frac": "proportion",
-        }
-    deconv_df_agg.columns = [
-        export_columns.get(col, "".join(col) if type(col) is tuple else col)
-        for col in deconv_df_agg.columns.values
-    ]
-    deconv_df_agg = deconv_df_agg.sort_values(by=["location", "variant", "date"])
-    # reverse logit scale
-    if have_confint and confint_params["scale"] == "logit":
-        deconv_df_agg[["proportionLower", "proportionUpper"]] = deconv_df_agg[
-            ["proportionLower", "proportionUpper"]
-        ].applymap(
-            lambda x: np.exp(np.clip(x, -100, 100))
-            / (1 + np.exp(np.clip(x, -100, 100)))
-        )
+        for location in (
+            tqdm(locations_list) if len(locations_list) > 1 else locations_list
+        ):
+            if bootstrap <= 1 and len(date_intervals) <= 1:
+                tqdm.write(location)
+            with profiler.stage("location", location=location):
+                all_deconv += deconvolute_location(
+                    location,
+                    select_location(location),
+                    rng=location_rng(seed, location),
+                    leave=(len(locations_list) > 1),
+                    profiler=profiler,
+                    diagnostics=all_solves,
+                    **location_args,
+                )
+
+    if df_tally is None:
+        spill_dir.cleanup()
+    if cache:
+        cache.evict()
+
+    print("post-process data")
+    profiler.section("post-process data")
+    deconv_df_agg, export_columns = aggregate_results(
+        all_deconv, variants_list, settings, variants_dates
+    )
 
     ### CSV output
     if fmt_columns:
@@ -533,7 +1067,7 @@ def deconvolute(
             .pivot(
                 index=["location", "date"],
                 columns="variant",
-                values=list(set(export_columns.values()) - {"date"}),
+                values=[col for col in export_columns.values() if col != "date"],
             )
             .reset_index()
         )
@@ -556,44 +1090,58 @@ def deconvolute(
     else:
         output_df = deconv_df_agg
     print("output data")
-    output_df.drop(
-        (["location"] if no_loc else []) + (["date"] if no_date else []),
-        axis=1,
-        errors="ignore",
-    ).to_csv(output, sep="\t", index=None)
+    profiler.section("output data")
+    write_results(
+        output_df.drop(
+            (["location"] if no_loc else []) + (["date"] if no_date else []),
+            axis=1,
+            errors="ignore",
+        ),
+        output,
+        output_format(output, out_format),
+    )
 
     ### JSON
     print("output json")
+    profiler.section("output json")
     if out_json:
-        update_data = {}
-
-        loc_uniq = deconv_df_agg["location"].unique()
-        var_uniq = deconv_df_agg["variant"].unique()
+        json_columns = [
+            col for col in export_columns.values() if not (no_date and col == "date")
+        ]
+        write_covspectrum_json(deconv_df_agg, json_columns, out_json)
 
-        json_columns = export_columns.values()
-        if no_date:
-            json_columns = list(set(json_columns) - {"date"})
-        for loc in tqdm(loc_uniq, desc="Location", position=0):
-            update_data[loc] = {}
-            for var in tqdm(var_uniq, desc=loc, position=1, leave=False):
-                tt_df = deconv_df_agg.loc[
-                    (deconv_df_agg["variant"] == var)
-                    & (deconv_df_agg["location"] == loc),
-                    json_columns,
-                ].copy()
-                if not no_date:
-                    tt_df["date"] = tt_df["date"].astype("str")
-
-                update_data[loc][var] = {
-                    "timeseriesSummary": [
-                        dict(tt_df.iloc[i,]) for i in range(tt_df.shape[0])
-                    ]
-                }
+    if diagnostics:
+        print("output diagnostics")
+        profiler.section("output diagnostics")
+        if bootstrap > 1:
+            print(
+                "WARNING: bootstrap replicates are not diagnosed, only single fits",
+                file=sys.stderr,
+            )
+        write_results(
+            (
+                pd.concat(all_solves, ignore_index=True)
+                if all_solves
+                else ll.SolveDiagnostics().to_frame(location=None, interval=None)
+            ).drop(
+                (["location"] if no_loc else []) + (["date"] if no_date else []),
+                axis=1,
+                errors="ignore",
+            ),
+            diagnostics,
+            output_format(diagnostics),
+        )
 
-        with open(out_json, "w") as file:
-            file.write(
-                json.dumps(update_data).replace("NaN", "null")
-            )  # syntactically standard compliant JSON vs. python numpy's output.
+    if profile:
+        profiler.write(
+            profile,
+            version=ll.__version__,
+            argv=sys.argv,
+            jobs=n_jobs,
+            locations=len(locations_list),
+            intervals=len(date_intervals),
+            bootstrap=bootstrap,
+        )
 
 
 if __name__ == "__main__":
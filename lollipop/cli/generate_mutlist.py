@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 import pandas as pd
-import strictyaml
+import numpy as np
 import re
 import glob
 import os
 import sys
+import io
+import json
+import hashlib
+import contextlib
 import click
 
+from lollipop import __version__
+
 rxmutdec = re.compile(
     r"^(?:(?:(?:(?P<ref>[ATCG]+)\>)?(?P<mut>[ATCG]+))|(?P<del>[\-]+)|(?:[\+](?P<ins>[ATGC]+)))$"
 )
@@ -19,15 +25,14 @@ schema = {
 
 types = {"position": "int"}
 
+categories = ["mut", "revert", "extra", "shared", "subset"]
 
-def load_voc_yaml(yam, yp="(yaml)"):
-    muts = pd.DataFrame(
-        data=schema
-        | {
-            yam["variant"]["short"]: [],
-        }
-    ).astype(types)
-    for c in ["mut", "revert", "extra", "shared", "subset"]:
+
+def voc_yaml_records(yam, yp="(yaml)"):
+    """
+    generate the mutated bases of a voc YAML, as (position, reference, variant, category) tuples
+    """
+    for c in categories:
         # all categories (we don't care, we will compare accross samples)
         if c not in yam:
             continue
@@ -40,50 +45,108 @@ def load_voc_yaml(yam, yp="(yaml)"):
             if match["ins"]:
                 print(f"{yp}:{pos} insertions not supported (yet): {match['ins']}")
                 continue
-            elif match["mut"]:
-                for i in range(len(match["mut"])):
-                    muts = pd.concat(
-                        [
-                            muts,
-                            pd.DataFrame.from_records(
-                                [
-                                    {
-                                        "position": int(pos) + i,
-                                        "reference": (
-                                            match["ref"][i]
-                                            if match["ref"] and i < len(match["ref"])
-                                            else "N"
-                                        ),
-                                        "variant": match["mut"][i],
-                                        yam["variant"]["short"]: c,
-                                    }
-                                ]
-                            ),
-                        ]
-                    )
-            elif match["del"]:
-                # TODO this is wrong and will be fixed in ShoRAH
-                for i in range(len(match["del"])):
-                    muts = pd.concat(
-                        [
-                            muts,
-                            pd.DataFrame.from_records(
-                                [
-                                    {
-                                        "position": int(pos) + i,
-                                        "reference": (
-                                            match["ref"][i]
-                                            if match["ref"] and i < len(match["ref"])
-                                            else "N"
-                                        ),
-                                        "variant": "-",
-                                        yam["variant"]["short"]: c,
-                                    }
-                                ]
-                            ),
-                        ]
-                    )
-    return muts
+            # TODO deletions are wrong and will be fixed in ShoRAH
+            bases = match["mut"] or match["del"]
+            for i in range(len(bases)):
+                yield (
+                    int(pos) + i,
+                    (
+                        match["ref"][i]
+                        if match["ref"] and i < len(match["ref"])
+                        else "N"
+                    ),
+                    bases[i],
+                    c,
+                )
+
+
+def load_voc_yaml(yam, yp="(yaml)"):
+    return pd.DataFrame.from_records(
+        list(voc_yaml_records(yam, yp)),
+        columns=list(schema) + [yam["variant"]["short"]],
+    ).astype(types)
+
+
+def file_digest(path):
+    """SHA-256 of the content of a file"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def parse_voc_yaml(yp):
+    """
+    short name, pangolin lineage, mutated bases (see voc_yaml_records) and parsing messages of a voc YAML
+    """
+    import strictyaml
+
+    with open(yp, "r") as yf:
+        yam = strictyaml.dirty_load(yf.read(), allow_flow_style=True).data
+
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        records = list(voc_yaml_records(yam, yp))
+    return {
+        "short": yam["variant"]["short"],
+        "pangolin": yam["variant"].get("pangolin"),
+        "records": records,
+        "messages": messages.getvalue(),
+    }
+
+
+def cached_voc_yaml(yp, cache, digest):
+    """
+    parse_voc_yaml, stored in the cache directory under the digest of the content of the voc YAML,
+    so that only new or modified YAMLs are parsed again
+    """
+    entry = os.path.join(cache, f"voc-{digest}.json")
+    if os.path.exists(entry):
+        with open(entry) as f:
+            voc = json.load(f)
+        voc["records"] = [tuple(rec) for rec in voc["records"]]
+        return voc
+
+    voc = parse_voc_yaml(yp)
+    # write-then-rename: a concurrent or interrupted run never sees a partial entry
+    with open(f"{entry}.tmp{os.getpid()}", "w") as f:
+        json.dump(voc, f)
+    os.replace(f"{entry}.tmp{os.getpid()}", entry)
+    return voc
+
+
+def pivot_records(records, shorts):
+    """
+    table of mutations (rows) by variants (columns) from (position, reference, variant, short, category) records,
+    a mutation listed in several categories of the same variant keeps the first one
+    """
+    records = pd.DataFrame.from_records(
+        records, columns=list(schema) + ["short", "category"]
+    ).astype(types)
+    records = records.drop_duplicates(subset=list(schema) + ["short"])
+    return (
+        records.pivot(index=list(schema), columns="short", values="category")
+        .reindex(columns=shorts)
+        .rename_axis(columns=None)
+        .reset_index()
+    )
+
+
+def gene_intervals(features):
+    """
+    flatten (possibly overlapping) gene features into sorted disjoint intervals, where the last feature wins
+    features: list of (start, end, name), bounds included
+    returns the first position of each interval, and their gene names ("" outside of genes)
+    """
+    bounds = np.unique([b for start, end, _ in features for b in (start, end + 1)])
+    names = np.full(len(bounds), "", dtype=object)
+    for start, end, name in features:
+        names[np.searchsorted(bounds, start) : np.searchsorted(bounds, end + 1)] = name
+    return bounds, names
+
+
+def annotate_genes(positions, bounds, names):
+    """gene name of each position, looked up in the intervals of gene_intervals"""
+    idx = np.searchsorted(bounds, positions, side="right") - 1
+    return np.where(idx >= 0, names[np.maximum(idx, 0)], "") if len(bounds) else ""
 
 
 @click.command(
@@ -137,8 +200,17 @@ def load_voc_yaml(yam, yp="(yaml)"):
     type=bool,
     help="Verbose (dumps table on terminal)",
 )
+@click.option(
+    "--cache",
+    "-c",
+    metavar="DIR",
+    required=False,
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Keep the parsed voc YAMLs in this directory, only parse again the new or modified ones, and skip writing outputs that would be unchanged",
+)
 @click.argument("vocs", metavar="VOC_YAML", nargs=-1, type=click.Path(exists=True))
-def generate_mutlist(output, out_pangovars, genes, voc_dir, vocs, verbose):
+def generate_mutlist(output, out_pangovars, genes, voc_dir, vocs, verbose, cache):
     """
     Generate a mutations list TSV file from COJAC voc YAMLs, to be used by the LolliPop signature extractions commands, e.g, getmutations_from_basecnt.
     """
@@ -152,42 +224,87 @@ def generate_mutlist(output, out_pangovars, genes, voc_dir, vocs, verbose):
         vocs
     ), f"at least provide some voc YAML files, by listing them directly or either by scanning directories with option '--voc-dir'."
 
+    vocs = list(dict.fromkeys(vocs))
+    for yp in vocs:
+        assert os.path.exists(yp), f"cannot find {yp}"
+
+    if cache:
+        os.makedirs(cache, exist_ok=True)
+        digests = [file_digest(yp) for yp in vocs]
+        # everything the outputs depend on
+        manifest_key = hashlib.sha256(
+            json.dumps(
+                [
+                    __version__,
+                    digests,
+                    file_digest(genes) if genes else None,
+                    bool(out_pangovars),
+                ]
+            ).encode()
+        ).hexdigest()
+        manifest_file = os.path.join(cache, "outputs.json")
+        manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        outputs = {
+            os.path.abspath(out): key
+            for out, key in ((output, "output"), (out_pangovars, "pangovars"))
+            if out
+        }
+        previous = manifest.get(os.path.abspath(output), {})
+        if (
+            not verbose
+            and previous.get("key") == manifest_key
+            and all(
+                os.path.exists(out) and previous.get(key) == file_digest(out)
+                for out, key in outputs.items()
+            )
+        ):
+            print(f"{output} is up to date")
+            return
+
     pango_vars = {"variants_pangolin": {}}
-    vartable = pd.DataFrame(data=schema).astype({"position": "int"})
-    for yp in set(vocs):
+    records = []
+    shorts = []
+    for i, yp in enumerate(vocs):
         print(yp)
-        assert os.path.exists(yp), f"cannot find {yp}"
 
-        with open(yp, "r") as yf:
-            yam = strictyaml.dirty_load(yf.read(), allow_flow_style=True).data
+        voc = cached_voc_yaml(yp, cache, digests[i]) if cache else parse_voc_yaml(yp)
+        print(voc["messages"], end="")
 
-        muts = load_voc_yaml(yam, yp)
+        short = voc["short"]
+        records += [rec[:3] + (short,) + rec[3:] for rec in voc["records"]]
+        shorts += [short]
 
-        if out_pangovars and "pangolin" in yam["variant"]:
-            pango_vars["variants_pangolin"][yam["variant"]["short"]] = yam["variant"][
-                "pangolin"
-            ]
+        if out_pangovars and voc["pangolin"] is not None:
+            pango_vars["variants_pangolin"][short] = voc["pangolin"]
 
-        vartable = vartable.merge(
-            how="outer", right=muts, copy=False, sort=True
-        )  # .fillna('')
+    # single pivot for all the variants
+    vartable = pivot_records(records, list(dict.fromkeys(shorts)))
 
     if genes:
         from BCBio import GFF
 
-        # place an empty column right after the standard columns
-        if not "gene" in vartable.columns:
-            vartable.insert(len(schema), "gene", [""] * len(vartable.index))
+        features = []
         with open(genes) as gf:
             for record in GFF.parse(gf):
                 for feature in record.features:
                     if feature.type == "gene":
-                        mask = (int(feature.location.end) >= vartable["position"]) & (
-                            vartable["position"] >= int(feature.location.start)
-                        )
-                        vartable.loc[mask, "gene"] = feature.qualifiers.get(
-                            "Name", [feature.id]
-                        )[0]
+                        features += [
+                            (
+                                int(feature.location.start),
+                                int(feature.location.end),
+                                feature.qualifiers.get("Name", [feature.id])[0],
+                            )
+                        ]
+
+        # place the column right after the standard columns
+        if not "gene" in vartable.columns:
+            vartable.insert(len(schema), "gene", "")
+        vartable["gene"] = annotate_genes(
+            vartable["position"].to_numpy(), *gene_intervals(features)
+        )
 
     if verbose:
         with pd.option_context(
@@ -200,9 +317,19 @@ def generate_mutlist(output, out_pangovars, genes, voc_dir, vocs, verbose):
     )
 
     if out_pangovars:
+        import strictyaml
+
         with open(out_pangovars, "w") as yf:
             print(strictyaml.as_document(pango_vars).as_yaml(), file=yf)
 
+    if cache:
+        manifest[os.path.abspath(output)] = {"key": manifest_key} | {
+            key: file_digest(out) for out, key in outputs.items()
+        }
+        with open(f"{manifest_file}.tmp{os.getpid()}", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(f"{manifest_file}.tmp{os.getpid()}", manifest_file)
+
 
 if __name__ == "__main__":
     generate_mutlist()
@@ -8,6 +8,11 @@ import os
 import click
 from click_option_group import optgroup
 import sys
+import re
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 __author__ = "Matteo Carrara"
 __maintainer__ = "Ivan Topolsky"
@@ -17,9 +22,9 @@ __email__ = "v-pipe@bsse.ethz.ch"
 #####
 
 
-def scan_basecnt(basecnt, tsvbase, mut):
-    # warning that table is *tsvbase*-based
-    basecount = (
+def read_basecnt(basecnt):
+    """read a basecount table (positions x bases) produced by V-pipe"""
+    return (
         pd.read_csv(
             basecnt,
             sep="\t",
@@ -30,42 +35,109 @@ def scan_basecnt(basecnt, tsvbase, mut):
         .T.droplevel("sample")
         .T
     )
+
+
+def write_basecnt_store(basecnt, store, name):
+    """
+    convert a basecount table into a binary store entry: a (positions x bases) uint32 array in
+    store/name.npy (memory-mapped on read), and its index (first position, bases) in store/name.json
+    returns the path of the entry
+
+    An existing entry (e.g.: written by an interrupted run, see store_entry_name) is reused, never overwritten:
+    both files are written under temporary names and moved in place, the array last.
+    """
+    name = re.sub(r"[^\w.-]", "_", name)
+    path = os.path.join(store, f"{name}.npy")
+    if os.path.exists(path):
+        return path
+
+    basecount = read_basecnt(basecnt)
+    # contiguous positions (missing ones: no coverage)
+    positions = basecount.index.astype(int)
+    basecount = basecount.reindex(
+        pd.RangeIndex(positions.min(), positions.max() + 1), fill_value=0
+    )
+
+    fd, tmp = tempfile.mkstemp(dir=store, suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        json.dump(
+            {"first": int(positions.min()), "bases": list(basecount.columns)}, file
+        )
+    os.replace(tmp, os.path.join(store, f"{name}.json"))
+    fd, tmp = tempfile.mkstemp(dir=store, suffix=".tmp")
+    with os.fdopen(fd, "wb") as file:
+        np.save(file, basecount.to_numpy(dtype=np.uint32))
+    os.replace(tmp, path)
+
+    return path
+
+
+def store_entry_name(sample, batch):
+    """
+    name of the binary store entry of a sample: hash of the (sample, batch) pair,
+    distinct for each pair whatever characters they contain
+    """
+    return hashlib.sha256(json.dumps([sample, batch]).encode()).hexdigest()
+
+
+def basecnt_arrays(basecnt):
+    """
+    counts of a basecount table, with the positions and bases labeling its rows and columns
+    basecnt: TSV file name, binary store entry (see write_basecnt_store), or table read by read_basecnt
+    """
+    if isinstance(basecnt, pd.DataFrame):
+        return basecnt.to_numpy(), basecnt.index, basecnt.columns
+    if str(basecnt).endswith(".npy"):
+        counts = np.load(basecnt, mmap_mode="r")
+        with open(f"{str(basecnt)[:-len('.npy')]}.json") as file:
+            index = json.load(file)
+        return (
+            counts,
+            pd.RangeIndex(index["first"], index["first"] + counts.shape[0]),
+            pd.Index(index["bases"]),
+        )
+    return basecnt_arrays(read_basecnt(basecnt))
+
+
+def scan_basecnt(basecnt, tsvbase, mut):
+    """
+    look up the mutations of mut into a basecount table (see basecnt_arrays),
+    gathering all the positions and bases at once
+    """
+    # warning that table is *tsvbase*-based
+    counts, positions, bases = basecnt_arrays(basecnt)
+
+    # -1 : 1-based to 0-based
+    rows = positions.get_indexer(mut["position"] - (1 - tsvbase))
+    cols = bases.get_indexer(mut["variant"])
+    if (rows < 0).any():
+        raise KeyError(f"positions not in basecount: {list(mut['position'][rows < 0])}")
+    if (cols < 0).any():
+        raise KeyError(f"bases not in basecount: {list(mut['variant'][cols < 0])}")
+
     # total coverage
-    basecount["cov"] = basecount.apply(sum, axis=1)
-    # look mutations per position
-    return pd.DataFrame(
-        data=mut.apply(
-            lambda x: pd.concat(
-                [
-                    pd.Series(
-                        [
-                            x.gene,
-                            x.position,
-                            x.variant,
-                            # -1 : 1-based to 0-based
-                            basecount.loc[x.position - (1 - tsvbase)]["cov"],
-                            basecount.loc[x.position - (1 - tsvbase)][x.variant],
-                            (
-                                basecount.loc[x.position - (1 - tsvbase)][x.variant]
-                                / basecount.loc[x.position - (1 - tsvbase)]["cov"]
-                                if basecount.loc[x.position - (1 - tsvbase)]["cov"]
-                                else np.nan
-                            ),
-                        ],
-                        index=[
-                            "gene",
-                            "pos",
-                            "base",
-                            "cov",
-                            "var",
-                            "frac",
-                        ],
-                    ),
-                    pd.Series(x[4:]),
-                ]
+    selected = np.asarray(counts[rows, :], dtype=np.int64)
+    cov = selected.sum(axis=1)
+    var = selected[np.arange(rows.size), cols]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(cov != 0, var / cov, np.nan)
+
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "gene": mut["gene"],
+                    "pos": mut["position"],
+                    "base": mut["variant"],
+                    "cov": cov,
+                    "var": var,
+                    "frac": frac,
+                },
+                index=mut.index,
             ),
-            axis=1,
-        )
+            mut.iloc[:, 4:],
+        ],
+        axis=1,
     )
 
 
@@ -79,6 +151,73 @@ def build_outname(outname, sample, batch):
     return f"{sample}_{batch}_mutations.txt" if outname is None else outname
 
 
+def tag_table(table, sample=None, batch=None, location=None, date=None):
+    """add the sample's extra columns, and index the table by them and the position"""
+    idx = []
+    # add extra columns
+    if sample:
+        table["sample"] = sample
+        idx += ["sample"]
+    if batch:
+        table["batch"] = batch
+        idx += ["batch"]
+    if location:
+        table["location"] = location
+        idx += ["location"]
+    if date:
+        table["date"] = date
+        idx += ["date"]
+
+    # set index
+    idx += ["pos"]
+    return table.set_index(idx)
+
+
+def scan_sample(
+    basecnt, tsvbase, mut, sample=None, batch=None, location=None, date=None
+):
+    """search the mutations in the basecount table of one sample, returns the tagged table"""
+    table = scan_basecnt(basecnt=basecnt, tsvbase=tsvbase, mut=mut)
+    assert table.shape[0] > 0, "Generated an empty mutation table!"
+    return tag_table(table, sample, batch, location, date)
+
+
+def scan_sample_task(task):
+    """scan_sample with keyword arguments, for worker pools"""
+    return scan_sample(**task)
+
+
+def read_samples(samples_tsv):
+    """V-pipe samples TSV (no header): sample, batch, and optionally location and date"""
+    samples = pd.read_csv(samples_tsv, sep="\t", header=None, dtype=str)
+    samples = samples.iloc[:, :4].reindex(columns=range(4))
+    samples.columns = ["sample", "batch", "location", "date"]
+    return samples.replace(np.nan, None)
+
+
+def read_store_index(store):
+    """index of a basecount store: {(sample, batch): entry file}"""
+    index_file = os.path.join(store, "index.tsv")
+    if not os.path.exists(index_file):
+        return {}
+    index = pd.read_csv(index_file, sep="\t", dtype=str)
+    return {
+        (row.sample, row.batch): os.path.join(store, row.basecnt)
+        for row in index.itertuples(index=False)
+    }
+
+
+def store_sample_task(task):
+    """write_basecnt_store with keyword arguments, for worker pools, returns None if it fails"""
+    try:
+        return write_basecnt_store(**task)
+    except Exception as e:
+        print(
+            f"ERROR: cannot store basecount {task['basecnt']}: {e!r}", file=sys.stderr
+        )
+        return None
+
+
 ###
 @click.command(
     help="Search mutations and retrieve frequency from a TSV table produced by V-pipe",
@@ -163,31 +302,208 @@ def from_basecount(outname, muttable, base, basecnt, location, date, sample, bat
     mut = pd.read_csv(muttable, sep="\t").astype({"position": "int"})
 
     # seach them!
-    table = scan_basecnt(basecnt=basecnt, tsvbase=base, mut=mut)
-    assert table.shape[0] > 0, "Generated an empty mutation table!"
-
-    idx = []
-    # add extra columns
-    if sample:
-        table["sample"] = sample
-        idx += ["sample"]
-    if batch:
-        table["batch"] = batch
-        idx += ["batch"]
-    if location:
-        table["location"] = location
-        idx += ["location"]
-    if date:
-        table["date"] = date
-        idx += ["date"]
-
-    # set index
-    idx += ["pos"]
-    table.set_index(idx, inplace=True)
+    table = scan_sample(basecnt, base, mut, sample, batch, location, date)
 
     print(outname)
     table.to_csv(outname, sep="\t", compression={"method": "infer"})
 
 
+@click.command(
+    help="Search mutations in the basecount tables of all the samples of a V-pipe samples TSV, and write a single merged table",
+)
+@click.option(
+    "--output",
+    "-o",
+    required=False,
+    default="tallymut.tsv",
+    type=click.Path(),
+    help="Filename of the merged output table (compressed if ending with e.g. '.gz' or '.zst')",
+)
+@click.option(
+    "--muttable",
+    "--mutationtable",
+    "-m",
+    required=False,
+    default="mutlist.txt",
+    type=click.Path(exists=True),
+    help="Mutations helper table",
+)
+@click.option(
+    "--based",
+    "-a",
+    "base",
+    required=False,
+    default=1,
+    type=int,
+    help="Are the positions in the tsv 0-based or 1-based?",
+)
+@click.option(
+    "--basecnt",
+    "-B",
+    "basecnt_template",
+    required=False,
+    default="samples/{sample}/{batch}/alignments/basecnt.tsv.gz",
+    type=str,
+    help="Path of the basecount table of each sample, with {sample} and {batch} placeholders",
+)
+@click.option(
+    "--store",
+    "-S",
+    required=False,
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+    help="Read the basecount tables from this binary store (see store-basecount), instead of the TSVs",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    required=False,
+    default=1,
+    type=int,
+    help="Number of samples to process in parallel",
+)
+@click.argument(
+    "samples_tsv",
+    metavar="SAMPLES_TSV",
+    nargs=1,
+    type=click.Path(exists=True),
+)
+def from_samples(output, muttable, base, basecnt_template, store, jobs, samples_tsv):
+    samples = read_samples(samples_tsv)
+    stored = read_store_index(store) if store else {}
+
+    # list of mutations to search
+    mut = pd.read_csv(muttable, sep="\t").astype({"position": "int"})
+
+    tasks = []
+    for row in samples.itertuples(index=False):
+        basecnt = stored.get(
+            (row.sample, row.batch),
+            basecnt_template.format(sample=row.sample, batch=row.batch),
+        )
+        if not os.path.exists(basecnt):
+            print(
+                f"WARNING: missing basecount {basecnt} for sample {row.sample} {row.batch}, skipping",
+                file=sys.stderr,
+            )
+            continue
+        tasks += [
+            dict(
+                basecnt=basecnt,
+                tsvbase=base,
+                mut=mut,
+                sample=row.sample,
+                batch=row.batch,
+                location=row.location,
+                date=row.date,
+            )
+        ]
+    assert len(tasks), f"No basecount found for the samples of {samples_tsv}"
+
+    # search them!
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            tables = list(
+                executor.map(
+                    scan_sample_task, tasks, chunksize=max(1, len(tasks) // (4 * jobs))
+                )
+            )
+    else:
+        tables = [scan_sample_task(task) for task in tasks]
+
+    print(output)
+    pd.concat(tables).to_csv(output, sep="\t", compression={"method": "infer"})
+
+
+@click.command(
+    help="Convert the basecount tables of all the samples of a V-pipe samples TSV into a binary store, for fast (re-)extraction with from-samples",
+)
+@click.option(
+    "--store",
+    "-S",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="Directory of the store (samples already in it are skipped)",
+)
+@click.option(
+    "--basecnt",
+    "-B",
+    "basecnt_template",
+    required=False,
+    default="samples/{sample}/{batch}/alignments/basecnt.tsv.gz",
+    type=str,
+    help="Path of the basecount table of each sample, with {sample} and {batch} placeholders",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    required=False,
+    default=1,
+    type=int,
+    help="Number of samples to process in parallel",
+)
+@click.argument(
+    "samples_tsv",
+    metavar="SAMPLES_TSV",
+    nargs=1,
+    type=click.Path(exists=True),
+)
+def store_basecount(store, basecnt_template, jobs, samples_tsv):
+    samples = read_samples(samples_tsv)
+    os.makedirs(store, exist_ok=True)
+    stored = read_store_index(store)
+
+    keys = []
+    tasks = []
+    for row in samples.itertuples(index=False):
+        if (row.sample, row.batch) in stored or (row.sample, row.batch) in keys:
+            continue
+        basecnt = basecnt_template.format(sample=row.sample, batch=row.batch)
+        if not os.path.exists(basecnt):
+            print(
+                f"WARNING: missing basecount {basecnt} for sample {row.sample} {row.batch}, skipping",
+                file=sys.stderr,
+            )
+            continue
+        keys += [(row.sample, row.batch)]
+        tasks += [
+            dict(
+                basecnt=basecnt,
+                store=store,
+                name=store_entry_name(row.sample, row.batch),
+            )
+        ]
+    print(f"{len(tasks)} new sample{'' if len(tasks) == 1 else 's'} to store")
+
+    # convert them!
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            files = list(
+                executor.map(
+                    store_sample_task, tasks, chunksize=max(1, len(tasks) // (4 * jobs))
+                )
+            )
+    else:
+        files = [store_sample_task(task) for task in tasks]
+
+    # the index is only updated once all the entries are written
+    # (the ones that failed are left out, and retried by the next run)
+    index = [
+        (sample, batch, os.path.relpath(file, store))
+        for (sample, batch), file in list(stored.items()) + list(zip(keys, files))
+        if file is not None
+    ]
+    pd.DataFrame(index, columns=["sample", "batch", "basecnt"]).to_csv(
+        os.path.join(store, "index.tsv"), sep="\t", index=False
+    )
+    failed = sum(file is None for file in files)
+    if failed:
+        print(
+            f"ERROR: {failed} sample{'' if failed == 1 else 's'} could not be stored",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     from_basecount()
@@ -1,15 +1,42 @@
 #!/usr/bin/env python3
 import click
+import importlib
 from lollipop import __version__
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
-from .generate_mutlist import generate_mutlist
-from .deconvolute import deconvolute
-from .getmutations_from_basecount import from_basecount
 
+class LazyGroup(click.Group):
+    """
+    group whose subcommands are only imported (with their dependencies, e.g.: scipy) when used,
+    so that running one subcommand doesn't pay for loading all the others
+    """
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        """
+        lazy_commands (dict): {command name: "module:attribute"}
+        """
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
 
-@click.group()
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_commands:
+            module, attribute = self.lazy_commands[cmd_name].split(":")
+            return getattr(importlib.import_module(module), attribute)
+        return super().get_command(ctx, cmd_name)
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "from-basecount": "lollipop.cli.getmutations_from_basecount:from_basecount",
+        "from-samples": "lollipop.cli.getmutations_from_basecount:from_samples",
+        "store-basecount": "lollipop.cli.getmutations_from_basecount:store_basecount",
+    },
+)
 def getmutations():
     """
     Get mutations from a single sample
@@ -17,18 +44,22 @@ def getmutations():
     pass
 
 
-getmutations.add_command(from_basecount)
-
-
-@click.group(context_settings=CONTEXT_SETTINGS)
+@click.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "generate-mutlist": "lollipop.cli.generate_mutlist:generate_mutlist",
+        "deconvolute": "lollipop.cli.deconvolute:deconvolute",
+        "tally-to-parquet": "lollipop.cli.tally_io:tally_to_parquet",
+        "serve": "lollipop.cli.serve:serve",
+    },
+    context_settings=CONTEXT_SETTINGS,
+)
 @click.version_option(__version__)
 def cli():
     pass
 
 
-cli.add_command(generate_mutlist)
 cli.add_command(getmutations)
-cli.add_command(deconvolute)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import time
+import tracemalloc
+import contextlib
+import itertools
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def max_rss():
+    """peak resident set size of the process so far, in bytes (None if unknown)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class CountingReg:
+    """
+    wrapper around a regressor (see regressors), counting its solves and the rows of each solve
+    into the current stage of a Profiler
+    """
+
+    def __init__(self, reg, profiler):
+        self.reg = reg
+        self.profiler = profiler
+
+    def fit(self, X, y, k, b0=None):
+        self.profiler.count_solve(X.shape[0])
+        return self.reg.fit(X, y, k, b0=b0)
+
+    def __getattr__(self, name):
+        if name in ("reg", "profiler"):
+            # not yet set (e.g.: while unpickling)
+            raise AttributeError(name)
+        attr = getattr(self.reg, name)
+        if name == "fit_gram":
+            # solved from sufficient statistics: no rows
+
+            def fit_gram(xtx, xty, yty):
+                self.profiler.count_solve(0)
+                return attr(xtx, xty, yty)
+
+            return fit_gram
+        return attr
+
+
+class Profiler:
+    """
+    Record wall time, CPU time, peak memory and solver calls of nested stages.
+
+    Each finished stage is a record with:
+     stage, path (names of enclosing stages, joined with '/'), labels (e.g.: location, interval),
+     pid (process, e.g.: a worker, see merge),
+     wall_time and cpu_time (seconds, CPU of this process only),
+     peak_traced (bytes allocated by python at the peak, see tracemalloc),
+     max_rss (peak resident set size of the process so far, in bytes),
+     solves and rows (solver calls and total rows solved on, including nested stages),
+     min_rows and max_rows (per solve)
+
+    A disabled profiler (the default) records nothing and costs nothing.
+    """
+
+    def __init__(self, enabled=False, trace_memory=True):
+        """
+        trace_memory (bool): also trace python allocations (slows down memory intensive steps)
+        """
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.records = []
+        self.stack = []
+        self.section_stage = None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _open(self, name, labels):
+        if self.trace_memory:
+            if self.stack:
+                self.stack[-1]["peak"] = max(
+                    self.stack[-1]["peak"], tracemalloc.get_traced_memory()[1]
+                )
+            tracemalloc.reset_peak()
+        self.stack.append(
+            {
+                "stage": name,
+                "labels": labels,
+                "wall": time.perf_counter(),
+                "cpu": time.process_time(),
+                "peak": 0,
+                "solves": 0,
+                "rows": 0,
+                "min_rows": None,
+                "max_rows": None,
+            }
+        )
+
+    def _close(self):
+        frame = self.stack.pop()
+        peak = (
+            max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            if self.trace_memory
+            else None
+        )
+        self.records.append(
+            {
+                "stage": frame["stage"],
+                "path": "/".join(f["stage"] for f in self.stack),
+                "pid": os.getpid(),
+                "labels": frame["labels"],
+                "wall_time": time.perf_counter() - frame["wall"],
+                "cpu_time": time.process_time() - frame["cpu"],
+                "peak_traced": peak,
+                "max_rss": max_rss(),
+                "solves": frame["solves"],
+                "rows": frame["rows"],
+                "min_rows": frame["min_rows"],
+                "max_rows": frame["max_rows"],
+            }
+        )
+        if self.stack:
+            self._add_counts(self.records[-1])
+            if self.trace_memory:
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+
+    def _add_counts(self, record):
+        """add the solver counts of a (nested) record to the current stage"""
+        parent = self.stack[-1]
+        parent["solves"] += record["solves"]
+        parent["rows"] += record["rows"]
+        for key, best in (("min_rows", min), ("max_rows", max)):
+            if record[key] is not None:
+                parent[key] = (
+                    record[key]
+                    if parent[key] is None
+                    else best(parent[key], record[key])
+                )
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """time the enclosed code as a stage nested in the current one"""
+        if not self.enabled:
+            yield self
+            return
+        self._open(name, labels)
+        try:
+            yield self
+        finally:
+            self._close()
+
+    def iterate(self, items, name, labels=None):
+        """
+        iterate over items, timing each one as a stage: from fetching the item
+        (e.g.: a generator computing it) to the end of the loop body processing it
+
+        labels (callable): labels(index, item) gives the labels of the stage, default: its index
+        """
+        if not self.enabled:
+            yield from items
+            return
+        items = iter(items)
+        for index in itertools.count():
+            self._open(name, {})
+            try:
+                item = next(items)
+            except StopIteration:
+                # no item: nothing to record
+                self.stack.pop()
+                return
+            except BaseException:
+                self._close()
+                raise
+            self.stack[-1]["labels"] = (
+                labels(index, item) if labels is not None else {"index": index}
+            )
+            try:
+                yield item
+            finally:
+                self._close()
+
+    def section(self, name=None, **labels):
+        """
+        end the current top-level stage started by section (if any), and start a new one (unless name is None)
+
+        For long sequential code, e.g.: the successive steps of a command.
+        """
+        if not self.enabled:
+            return
+        if self.section_stage is not None:
+            # close any stage left open within the section
+            while len(self.stack) > self.section_stage:
+                self._close()
+            self.section_stage = None
+        if name is not None:
+            self.section_stage = len(self.stack)
+            self._open(name, labels)
+
+    def count_solve(self, rows):
+        """count one solver call on this many rows in the current stage"""
+        if not self.stack:
+            return
+        self._add_counts(
+            {"solves": 1, "rows": rows, "min_rows": rows, "max_rows": rows}
+        )
+
+    def wrap(self, reg):
+        """regressor counting its solves (see CountingReg), or the regressor itself when disabled"""
+        return CountingReg(reg, self) if self.enabled else reg
+
+    def merge(self, records):
+        """
+        add records of another profiler (e.g.: of a worker process) as nested in the current stage
+        """
+        if not self.enabled:
+            return
+        prefix = "/".join(f["stage"] for f in self.stack)
+        for record in records:
+            record = dict(record)
+            if prefix:
+                record["path"] = (
+                    f"{prefix}/{record['path']}" if record["path"] else prefix
+                )
+            if self.stack and record["path"] == prefix:
+                # top-level stages of the worker
+                self._add_counts(record)
+            self.records.append(record)
+
+    def write(self, path, **metadata):
+        """close all stages and write the report as JSON: {metadata..., "stages": [records...]}"""
+        if not self.enabled:
+            return
+        self.section(None)
+        while self.stack:
+            self._close()
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    **metadata,
+                    "pid": os.getpid(),
+                    "trace_memory": self.trace_memory,
+                    "stages": self.records,
+                },
+                file,
+                indent=1,
+                default=str,
+            )
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+
+class ResultCache:
+    """
+    on-disk cache of results, addressed by the hash of their inputs (see key),
+    bounded in size by evicting the least recently used entries (see evict)
+
+    Entries are written atomically, so that several processes (e.g.: the workers
+    of deconvolute) can share the same directory.
+    """
+
+    def __init__(self, directory, max_size=1024**3):
+        """
+        directory (str): where the entries are stored, created if needed
+        max_size (int): size in bytes above which evict removes entries
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        hash of the parts: tables (by their columns and the content of their rows),
+        arrays (by their type, shape and content), or anything JSON can represent (e.g.: parameters)
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, (pd.DataFrame, pd.Series)):
+                digest.update(
+                    json.dumps(
+                        list(part.columns)
+                        if isinstance(part, pd.DataFrame)
+                        else part.name,
+                        default=str,
+                    ).encode()
+                )
+                digest.update(
+                    pd.util.hash_pandas_object(part, index=False).values.tobytes()
+                )
+            elif isinstance(part, (np.ndarray, pd.Index)):
+                part = np.asarray(part)
+                if part.dtype == object:
+                    part = pd.util.hash_array(part)
+                digest.update(f"{part.dtype}{part.shape}".encode())
+                digest.update(np.ascontiguousarray(part).tobytes())
+            else:
+                digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pickle")
+
+    def get(self, key):
+        """the entry stored under key, or None if absent"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        # recently used (the modification time serves as LRU clock)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """store value under key"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits in max_size, returns how many"""
+        entries = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".pickle"):
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append(
+                        (st.st_mtime_ns, st.st_size, os.path.join(root, name))
+                    )
+        total = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import pandas as pd
+import numpy as np
+import json
+import os
+from tqdm import tqdm
+
+# binary output formats, by file extension (anything else: TSV, possibly compressed e.g. .tsv.zst)
+output_extensions = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
+
+
+def json_tokens(column):
+    """
+    JSON text of each value of a column: dates as strings,
+    and non-finite numbers as null (instead of python's non-standard NaN)
+    """
+    if column.dtype.kind in "mM":
+        # format each distinct date once
+        codes, uniques = pd.factorize(column)
+        tokens = np.array(
+            [json.dumps(d) for d in pd.Series(uniques).astype("str")] + ["null"],
+            dtype=object,
+        )
+        return tokens[codes]
+    if column.dtype.kind == "f":
+        # json.dumps's own encoding of finite floats
+        tokens = np.array(list(map(float.__repr__, column.tolist())), dtype=object)
+        tokens[~np.isfinite(column.to_numpy())] = "null"
+        return tokens
+    return np.array(list(map(json.dumps, column.tolist())), dtype=object)
+
+
+def write_covspectrum_json(results, columns, out_json):
+    """
+    stream the results to a Cov-spectrum JSON, one location at a time:
+    {location: {variant: {"timeseriesSummary": [{column: value, ...}, ...]}}}
+    results: table with location and variant columns, sorted by location, variant and date
+    columns: columns of each entry of the time series
+    """
+    variants = results["variant"].unique()
+    empty = np.empty(0, dtype=int)
+
+    with open(out_json, "w") as file:
+        file.write("{")
+        for i, (loc, rows) in enumerate(
+            tqdm(
+                results.groupby("location", sort=False).indices.items(),
+                desc="Location",
+                position=0,
+            )
+        ):
+            loc_results = results.iloc[rows]
+            # JSON text of each entry, assembled column-wise
+            entries = np.full(len(loc_results), "{", dtype=object)
+            for k, col in enumerate(columns):
+                entries += f"{', ' if k else ''}{json.dumps(col)}: "
+                entries += json_tokens(loc_results[col])
+            entries += "}"
+            groups = loc_results.groupby("variant", sort=False).indices
+
+            file.write(f"{', ' if i else ''}{json.dumps(str(loc))}: {{")
+            for j, var in enumerate(variants):
+                summary = ", ".join(entries[groups.get(var, empty)])
+                file.write(
+                    f"{', ' if j else ''}{json.dumps(str(var))}: "
+                    f'{{"timeseriesSummary": [{summary}]}}'
+                )
+            file.write("}")
+        file.write("}")
+
+
+def output_format(output, fmt=None):
+    """format of the results: explicitly given, or else guessed from the extension of the output"""
+    return fmt or output_extensions.get(os.path.splitext(output)[1].lower(), "tsv")
+
+
+def typed_results(results):
+    """results with compact types: categorical locations and variants, float32 proportions"""
+    return results.astype(
+        {
+            col: "category" if col in ("location", "variant") else "float32"
+            for col, dtype in results.dtypes.items()
+            if col in ("location", "variant") or dtype.kind == "f"
+        }
+    )
+
+
+def write_results(results, output, fmt="tsv"):
+    """
+    write the results table as a TSV (compression inferred from the extension),
+    or with typed columns (see typed_results) as zstd-compressed Parquet or Arrow IPC (Feather v2) file
+    """
+    if fmt == "tsv":
+        results.to_csv(output, sep="\t", index=None)
+    elif fmt == "parquet":
+        typed_results(results).to_parquet(
+            output, engine="pyarrow", index=False, compression="zstd"
+        )
+    elif fmt == "arrow":
+        import pyarrow.feather as feather
+
+        feather.write_feather(
+            typed_results(results).reset_index(drop=True), output, compression="zstd"
+        )
+    else:
+        raise ValueError(f"unknown output format {fmt}")
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+import pandas as pd
+import numpy as np
+import lollipop as ll
+
+import click
+import ruamel.yaml
+import json
+import os
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from lollipop.cli.deconvolute import (
+    aggregate_results,
+    deconv_settings,
+    deconvolute_location,
+    location_rng,
+)
+from lollipop.cli.tally_io import (
+    filters_columns,
+    read_tally_dataset,
+    read_tally_tsv,
+)
+
+
+def files_mtime(path):
+    """latest modification time of a file, or of the files within a directory (e.g.: a tally dataset)"""
+    if not os.path.isdir(path):
+        return os.stat(path).st_mtime_ns
+    return max(
+        [os.stat(path).st_mtime_ns]
+        + [
+            os.stat(os.path.join(root, name)).st_mtime_ns
+            for root, dirs, names in os.walk(path)
+            for name in names
+        ]
+    )
+
+
+class DeconvState:
+    """
+    configurations and preprocessed tally, kept in memory between deconvolution requests
+    and reloaded when any of their files changes (see refresh)
+    """
+
+    def __init__(
+        self,
+        tally_data,
+        variants_config,
+        deconv_configs,
+        variants_dates=None,
+        filters=None,
+        locations=None,
+        seed=None,
+    ):
+        """
+        tally_data (str): tally TSV, or Parquet dataset (see tally-to-parquet)
+        deconv_configs (list): kernel deconvolution configurations, the presets are named after their file (without extension)
+        locations (list): only keep these locations (default: locations_list of the variants configuration, or all)
+        """
+        self.tally_data = tally_data
+        self.variants_config = variants_config
+        self.deconv_configs = deconv_configs
+        self.variants_dates = variants_dates
+        self.filters_file = filters
+        self.locations_arg = locations
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.mtimes = None
+        self.data = None
+
+    def files(self):
+        """all the input files, whose changes trigger a reload"""
+        return [
+            path
+            for path in [
+                self.tally_data,
+                self.variants_config,
+                self.variants_dates,
+                self.filters_file,
+            ]
+            + list(self.deconv_configs)
+            if path is not None
+        ]
+
+    def refresh(self):
+        """(re)load everything if never loaded or if any file changed since, returns whether it did"""
+        mtimes = [files_mtime(path) for path in self.files()]
+        with self.lock:
+            if mtimes == self.mtimes:
+                return False
+            self.load()
+            self.mtimes = mtimes
+            return True
+
+    def load(self):
+        """read the configurations and the tally, and preprocess each location"""
+        yaml = ruamel.yaml.YAML(typ="rt")
+        print(f"load data {self.tally_data}")
+        with open(self.variants_config, "r") as file:
+            conf_yaml = yaml.load(file)
+        variants_pangolin = conf_yaml["variants_pangolin"]
+        variants_list = conf_yaml.get("variants_list", None)
+        no_loc = conf_yaml.get("no_loc", False)
+        start_date = conf_yaml.get("start_date", None)
+        end_date = conf_yaml.get("end_date", None)
+        locations_list = (
+            self.locations_arg
+            if self.locations_arg
+            else conf_yaml.get("locations_list", None)
+        )
+        if conf_yaml.get("no_date", False):
+            raise click.UsageError(
+                f"no_date is not supported by serve, see {self.variants_config}"
+            )
+
+        presets = {}
+        for path in self.deconv_configs:
+            with open(path, "r") as file:
+                presets[os.path.splitext(os.path.basename(path))[0]] = deconv_settings(
+                    yaml.load(file)
+                )
+
+        filters = None
+        if self.filters_file:
+            with open(self.filters_file, "r") as file:
+                filters = yaml.load(file)
+
+        # dates intervals for which to apply different variants (see deconvolute)
+        if self.variants_dates:
+            with open(self.variants_dates, "r") as file:
+                var_dates = yaml.load(file)
+            all_var_dates = [
+                var for lst in var_dates["var_dates"].values() for var in lst
+            ]
+            if variants_list is None:
+                variants_list = list(dict.fromkeys(all_var_dates))
+            else:
+                variants_list = list(variants_list) + [
+                    var
+                    for var in dict.fromkeys(all_var_dates)
+                    if var not in variants_list
+                ]
+        else:
+            if variants_list is None:
+                variants_list = list(dict.fromkeys(variants_pangolin.values()))
+            var_dates = {"var_dates": {start_date or "2020-01-01": variants_list}}
+        d = list(var_dates["var_dates"].keys())
+
+        # data
+        if os.path.isdir(self.tally_data):
+            df_tally = read_tally_dataset(
+                self.tally_data,
+                columns=set(
+                    ["sample", "date", "location", "location_code", "pos", "base"]
+                    + ["frac", "mutations"]
+                    + list(variants_pangolin.keys())
+                    + list(variants_pangolin.values())
+                )
+                | filters_columns(filters),
+                locations=locations_list if not no_loc else None,
+                start_date=start_date,
+                end_date=end_date,
+            )
+        else:
+            df_tally = read_tally_tsv(self.tally_data)
+        if no_loc:
+            df_tally["location"] = "location"
+        elif "location" not in df_tally.columns:
+            if "location_code" in df_tally.columns:
+                df_tally["location"] = df_tally["location_code"]
+            elif locations_list is not None and len(locations_list) == 1:
+                df_tally["location"] = locations_list[0]
+            else:
+                raise click.UsageError(
+                    f"No location in input data. Either pass exactly one with `--loc`/`locations_list` parameter or set true the `no_loc` parameter {self.variants_config}"
+                )
+        if locations_list is not None and not no_loc:
+            df_tally = df_tally[df_tally["location"].isin(locations_list)]
+
+        preproc = ll.DataPreprocesser(df_tally)
+        preproc = preproc.general_preprocess(
+            variants_list=variants_list,
+            variants_pangolin=variants_pangolin,
+            variants_not_reported=conf_yaml.get("variants_not_reported", []),
+            to_drop=conf_yaml.get("to_drop", []),
+            start_date=start_date,
+            end_date=end_date,
+            remove_deletions=conf_yaml.get("remove_deletions", True),
+            compact=conf_yaml.get("compact", False),
+        )
+        preproc = preproc.filter_mutations(filters=filters)
+
+        # replaced at once: requests being answered keep using the previous data
+        self.data = dict(
+            variants_list=variants_list,
+            var_dates=var_dates,
+            date_intervals=list(zip(d, d[1:] + [None])),
+            presets=presets,
+            # each location selected once, instead of on every request
+            locations={
+                str(location): loc_df
+                for location, loc_df in preproc.df_tally.groupby(
+                    "location", sort=True, observed=True
+                )
+            },
+        )
+        print(
+            f"{len(self.data['locations'])} locations loaded, presets: {', '.join(presets)}"
+        )
+
+    @property
+    def locations(self):
+        return list(self.data["locations"])
+
+    @property
+    def presets(self):
+        """names of the presets, the first one is the default"""
+        return list(self.data["presets"])
+
+    def deconvolute(
+        self, location, start_date=None, end_date=None, preset=None, bandwidth=None
+    ):
+        """
+        deconvolve a location between start_date and end_date (included) with one of the presets,
+        returns the results as exported by deconvolute (see aggregate_results)
+
+        bandwidth (float): override the bandwidth of the preset's kernel
+        """
+        data = self.data
+        if location not in data["locations"]:
+            raise KeyError(f"unknown location: {location}")
+        preset = preset or next(iter(data["presets"]))
+        if preset not in data["presets"]:
+            raise KeyError(f"unknown preset: {preset}")
+        settings = dict(data["presets"][preset])
+        if bandwidth is not None:
+            settings["kernel_params"] = dict(
+                settings["kernel_params"], bandwidth=float(bandwidth)
+            )
+        start_date = pd.Timestamp(start_date) if start_date else None
+        end_date = pd.Timestamp(end_date) if end_date else None
+
+        loc_df = data["locations"][location]
+        kernel = settings["kernel"](**settings["kernel_params"])
+        radius = (
+            kernel.support(settings["deconv_params"].get("min_tol", 1e-10))
+            # bootstrapping resamples all the mutations of the location (see resample_weights),
+            # trimming would draw other replicates than deconvolute
+            if hasattr(kernel, "support") and settings["bootstrap"] <= 1
+            else np.inf
+        )
+        if np.isfinite(radius):
+            # only the observations within reach of the kernel of the requested dates
+            keep = np.ones(len(loc_df), dtype=bool)
+            if start_date is not None:
+                keep &= (
+                    loc_df["date"] >= start_date - pd.Timedelta(days=radius)
+                ).values
+            if end_date is not None:
+                keep &= (loc_df["date"] <= end_date + pd.Timedelta(days=radius)).values
+            loc_df = loc_df[keep]
+
+        all_deconv = deconvolute_location(
+            location,
+            loc_df,
+            data["date_intervals"],
+            data["var_dates"],
+            no_date=False,
+            rng=location_rng(self.seed, location),
+            progress=False,
+            **settings,
+        )
+        if not all_deconv:
+            return pd.DataFrame(columns=["location", "variant", "date", "proportion"])
+        results, _ = aggregate_results(
+            all_deconv, data["variants_list"], settings, self.variants_dates
+        )
+        keep = np.ones(len(results), dtype=bool)
+        if start_date is not None:
+            keep &= (results["date"] >= start_date).values
+        if end_date is not None:
+            keep &= (results["date"] <= end_date).values
+        return results[keep].reset_index(drop=True)
+
+
+class DeconvHandler(BaseHTTPRequestHandler):
+    """
+    answer GET requests from the DeconvState of the server, with JSON:
+     /locations: list of locations
+     /presets: list of presets, the first one is the default
+     /deconvolute?location=NAME[&start=DATE][&end=DATE][&preset=NAME][&bandwidth=FLOAT]:
+      results as records, e.g.: {"location": ..., "variant": ..., "date": ..., "proportion": ...}
+    """
+
+    def send_json(self, status, content):
+        body = json.dumps(content, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        state = self.server.state
+        try:
+            state.refresh()
+            if url.path == "/locations":
+                self.send_json(200, state.locations)
+            elif url.path == "/presets":
+                self.send_json(200, state.presets)
+            elif url.path == "/deconvolute":
+                if "location" not in query:
+                    self.send_json(400, {"error": "missing parameter: location"})
+                    return
+                results = state.deconvolute(
+                    query["location"],
+                    start_date=query.get("start"),
+                    end_date=query.get("end"),
+                    preset=query.get("preset"),
+                    bandwidth=query.get("bandwidth"),
+                )
+                results["date"] = results["date"].astype(str)
+                self.send_json(
+                    200,
+                    json.loads(results.to_json(orient="records", double_precision=15)),
+                )
+            else:
+                self.send_json(404, {"error": f"unknown path: {url.path}"})
+        except KeyError as e:
+            self.send_json(404, {"error": e.args[0]})
+        except (ValueError, click.UsageError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            self.log_error("%r", e)
+            self.send_json(500, {"error": str(e)})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ThreadingHTTPServer, on a unix socket"""
+
+    daemon_threads = True
+
+
+def make_server(state, host="127.0.0.1", port=8000, socket=None):
+    """HTTP server answering requests from state (see DeconvHandler), on a TCP port or a unix socket"""
+    if socket is not None:
+        if os.path.exists(socket):
+            # left over from a previous server
+            os.remove(socket)
+        server = UnixHTTPServer(socket, DeconvHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), DeconvHandler)
+    server.state = state
+    return server
+
+
+@click.command(
+    help="Serve deconvolutions over HTTP, keeping the preprocessed tally in memory between requests",
+    epilog="Requests: /locations, /presets, and /deconvolute?location=NAME&start=DATE&end=DATE&preset=NAME&bandwidth=FLOAT (all but location optional)",
+)
+@click.option(
+    "--variants-config",
+    "--var",
+    "-c",
+    metavar="YAML",
+    required=True,
+    type=str,
+    help="Variants configuration used during deconvolution",
+)
+@click.option(
+    "--variants-dates",
+    "--vd",
+    metavar="YAML",
+    required=False,
+    default=None,
+    type=str,
+    help="Variants to scan per periods (as determined with cojac)",
+)
+@click.option(
+    "--deconv-config",
+    "--dec",
+    "-k",
+    metavar="YAML",
+    required=True,
+    multiple=True,
+    type=str,
+    help="Configuration(s) of parameters for kernel deconvolution, available as presets named after their file (the first is the default)",
+)
+@click.option(
+    "--loc",
+    "--location",
+    "--wwtp",
+    "--catchment",
+    "-l",
+    metavar="NAME",
+    required=False,
+    multiple=True,
+    default=None,
+    help="Name(s) of location/wastewater treatment plant/catchment area to serve",
+)
+@click.option(
+    "--filters",
+    "-fl",
+    metavar="YAML",
+    required=False,
+    default=None,
+    type=str,
+    help="List of filters for removing problematic mutations from tally",
+)
+@click.option(
+    "--seed",
+    "-s",
+    metavar="SEED",
+    required=False,
+    default=None,
+    type=int,
+    help="Seed the random generator",
+)
+@click.option(
+    "--host",
+    metavar="HOST",
+    required=False,
+    default="127.0.0.1",
+    type=str,
+    help="Listen on this address",
+)
+@click.option(
+    "--port",
+    "-p",
+    metavar="PORT",
+    required=False,
+    default=8000,
+    type=int,
+    help="Listen on this TCP port",
+)
+@click.option(
+    "--socket",
+    metavar="PATH",
+    required=False,
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Listen on this unix socket instead of a TCP port",
+)
+@click.argument("tally_data", metavar="TALLY_TSV", nargs=1)
+def serve(
+    variants_config,
+    variants_dates,
+    deconv_config,
+    loc,
+    filters,
+    seed,
+    host,
+    port,
+    socket,
+    tally_data,
+):
+    state = DeconvState(
+        tally_data,
+        variants_config,
+        deconv_config,
+        variants_dates=variants_dates,
+        filters=filters,
+        locations=loc,
+        seed=seed,
+    )
+    state.refresh()
+    server = make_server(state, host, port, socket)
+    print(
+        f"serving on {socket if socket else f'http://{host}:{server.server_address[1]}'}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
+
+
+if __name__ == "__main__":
+    serve()
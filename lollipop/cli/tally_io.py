@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import pandas as pd
+import hashlib
+import os
+import re
+import sys
+import click
+
+
+def read_tally_tsv(tally_data, **kwargs):
+    """read a tally TSV (possibly compressed, e.g.: .tsv.zst), parsing dates if present"""
+    # peek at the header instead of parsing the whole file twice
+    columns = pd.read_csv(tally_data, sep="\t", nrows=0).columns
+    return pd.read_csv(
+        tally_data,
+        sep="\t",
+        parse_dates=["date"] if "date" in columns else None,
+        dtype={"location_code": "str"},
+        **kwargs,
+    )
+
+
+def can_chunk(tally_data, locations_list=None, no_loc=False):
+    """
+    check whether a tally TSV can be read by chunks (see spill_tally):
+    it needs dates, and a location for each row (see deconvolute's location handling)
+    """
+    columns = read_tally_tsv(tally_data, nrows=0).columns
+    if "date" not in columns:
+        print("NOTE: No dates in input data, reading it whole instead of by chunks")
+        return False
+    if not (
+        no_loc
+        or "location" in columns
+        or "location_code" in columns
+        or (locations_list is not None and len(locations_list) == 1)
+    ):
+        print("NOTE: No locations in input data, reading it whole instead of by chunks")
+        return False
+    if not no_loc and "location" not in columns and "location_code" in columns:
+        print("NOTE: No location fullnames, using codes instead")
+    return True
+
+
+def spill_tally(tally_data, directory, chunksize, preprocess=None, locations=None):
+    """
+    read a tally TSV by chunks of rows, and spill each location to its own files in directory,
+    so that memory is bounded by the chunk size instead of the file size
+
+    preprocess (callable): applied to each chunk before spilling (e.g.: DataPreprocesser.prefilter), must set 'location'
+    locations (list): only keep these locations
+    returns: {location: [files]}
+    """
+    spilled = {}
+    for i, chunk in enumerate(read_tally_tsv(tally_data, chunksize=chunksize)):
+        if preprocess is not None:
+            chunk = preprocess(chunk)
+        if locations is not None:
+            chunk = chunk[chunk["location"].isin(locations)]
+        for location, part in chunk.groupby("location", sort=False):
+            file = os.path.join(
+                directory,
+                f"{hashlib.sha1(str(location).encode()).hexdigest()}-{i}.pickle",
+            )
+            part.to_pickle(file)
+            spilled.setdefault(location, []).append(file)
+
+    return spilled
+
+
+def write_tally_dataset(df_tally, dataset, row_group_size=None):
+    """
+    write a tally as a Parquet dataset partitioned by location (if present),
+    sorted by date within each location so that date ranges can skip whole row groups
+    """
+    partition = ["location"] if "location" in df_tally.columns else None
+    df_tally.sort_values(
+        (partition or []) + (["date"] if "date" in df_tally.columns else []),
+        kind="stable",
+    ).to_parquet(
+        dataset,
+        engine="pyarrow",
+        index=False,
+        partition_cols=partition,
+        row_group_size=row_group_size,
+    )
+
+
+def tally_dataset_columns(dataset):
+    """list the columns of a tally Parquet dataset, including the partitioning"""
+    import pyarrow.dataset as ds
+
+    return ds.dataset(dataset, format="parquet", partitioning="hive").schema.names
+
+
+def filters_columns(filters):
+    """names of the columns used in the statements of the filters (see DataPreprocesser.filter_mutations)"""
+    return {
+        m.group("col")
+        for fl in (filters or {}).values()
+        for fs in fl
+        if (m := re.match(r"^ *['\"]?(?P<col>\w+)", fs))
+    }
+
+
+def read_tally_dataset(
+    dataset, columns=None, locations=None, start_date=None, end_date=None
+):
+    """
+    read a tally Parquet dataset (see tally-to-parquet), pushing down the selection:
+    only reading the columns, locations and dates (start_date <= date < end_date) needed
+    """
+    available = tally_dataset_columns(dataset)
+    filters = []
+    if locations is not None and "location" in available:
+        filters += [("location", "in", list(locations))]
+    if "date" in available:
+        if start_date is not None:
+            filters += [("date", ">=", pd.Timestamp(start_date))]
+        if end_date is not None:
+            filters += [("date", "<", pd.Timestamp(end_date))]
+
+    df_tally = pd.read_parquet(
+        dataset,
+        engine="pyarrow",
+        columns=(
+            [col for col in available if col in set(columns)]
+            if columns is not None
+            else None
+        ),
+        filters=filters or None,
+    )
+    if "location" in df_tally.columns:
+        # partitioning comes back as categorical
+        df_tally["location"] = df_tally["location"].astype(str)
+
+    return df_tally
+
+
+@click.command(
+    help="Convert a tally TSV into a Parquet dataset partitioned by location, for faster reading by deconvolute",
+    # epilog="",
+)
+@click.option(
+    "--output",
+    "-o",
+    metavar="DIR",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="Write the dataset in this directory",
+)
+@click.option(
+    "--row-group-size",
+    metavar="ROWS",
+    required=False,
+    default=None,
+    type=int,
+    help="Maximum number of rows per row group (smaller groups: finer date selection)",
+)
+@click.argument("tally_data", metavar="TALLY_TSV", nargs=1)
+def tally_to_parquet(output, row_group_size, tally_data):
+    if os.path.exists(output) and os.listdir(output):
+        print(f"ERROR: output directory {output} is not empty", file=sys.stderr)
+        sys.exit(1)
+
+    print("load data")
+    df_tally = read_tally_tsv(tally_data)
+
+    if "location" not in df_tally.columns:
+        print(
+            "WARNING: No location in input data, the dataset will not be partitioned",
+            file=sys.stderr,
+        )
+
+    print("write dataset")
+    write_tally_dataset(df_tally, output, row_group_size=row_group_size)
+
+
+if __name__ == "__main__":
+    tally_to_parquet()
@@ -1,3 +1,4 @@
+import pandas as pd
 import numpy as np
 from scipy.stats import norm
 
@@ -14,6 +15,12 @@ class NullConfint:
             "upper": coefs * np.nan,
         }
 
+    def statistics(self, X, coefs, y=None, kvals=None):
+        return {}
+
+    def confint_all(self, coefs, **stats):
+        return self.confint(None, coefs)
+
 
 class WaldConfint:
     """class to compute wald se of the proportions deconvolved through a linear prob. model"""
@@ -29,9 +36,6 @@ class WaldConfint:
 
     def quasibinom_overdisp(self, X, y, coefs, kvals, method="all"):
         """compute overdispersion according to a quasibinomial model"""
-        pseudocoefs = coefs / np.sum(coefs)
-        fitted_mut = X.dot(pseudocoefs)
-
         y_hat = X.dot(coefs)
         y_hat = y_hat + self.pseudofrac
         y_hat = y_hat / (y_hat + (1 - y_hat + 2 * self.pseudofrac))
@@ -54,8 +58,8 @@ class WaldConfint:
 
             return np.sqrt(overdisp_agg)
 
-    def standard_error(self, X, coefs):
-        """compute standard errors on the linear scale"""
+    def fisher_information(self, X, coefs):
+        """compute the Fisher information of the linear prob. model"""
 
         pseudocoefs = coefs / np.sum(coefs)
         # compute fitted values of mutation props.
@@ -63,85 +67,125 @@ class WaldConfint:
         # add pseudofrac to avoid zero fitted mutations
         fitted_mut = fitted_mut + self.pseudofrac
         fitted_mut = fitted_mut / (fitted_mut + (1 - fitted_mut + 2 * self.pseudofrac))
-        # compute Fisher information of in terms of binomial model
-        binom_info = np.diag(1 / (fitted_mut * (1 - fitted_mut)))
-        # compute Fisher information of in terms of linear prob. model
-        linprob_info = X.T.dot(binom_info).dot(X)
-        # try to invert Fisher information matrix
-        se = coefs * np.nan
+        # Fisher information of the binomial model is diagonal:
+        # scale the rows of X instead of building a (mutations x mutations) matrix
+        return X.T.dot(X / np.expand_dims(fitted_mut * (1 - fitted_mut), 1))
+
+    @staticmethod
+    def inverse_information(infos):
+        """
+        invert a stack of (variants x variants) Fisher information matrices
+
+        All the matrices are Cholesky-factorized in a single call. If some of them
+        aren't positive definite, they are inverted one by one (nans if singular).
+        """
         try:
-            t_diag = np.diag(np.linalg.inv(linprob_info))
+            chol = np.linalg.cholesky(infos)
         except np.linalg.LinAlgError:
-            pass  # leave the nans in place
-        else:
-            # compute root on non-negative
-            mask = t_diag >= 0.0
-            se[mask] = np.sqrt(t_diag[mask])
+            if len(infos) > 1:
+                return np.array(
+                    [WaldConfint.inverse_information(info[None])[0] for info in infos]
+                )
+            try:
+                return np.linalg.inv(infos)
+            except np.linalg.LinAlgError:
+                return infos * np.nan
+
+        # inv(L L') = inv(L)' inv(L)
+        chol_inv = np.linalg.solve(
+            chol, np.broadcast_to(np.eye(infos.shape[-1]), infos.shape)
+        )
+        return np.swapaxes(chol_inv, -1, -2) @ chol_inv
 
-        return se
+    def standard_errors(self, infos, coefs):
+        """compute standard errors on the scale of the confint from a stack of Fisher information matrices"""
 
-    def logit_standard_error(self, X, coefs):
-        """compute the standard error on the logit scale using the Delta method"""
+        inv_info = self.inverse_information(infos)
+        variances = np.diagonal(inv_info, axis1=-2, axis2=-1)
 
-        pseudocoefs = coefs / np.sum(coefs)
-        # compute fitted values of mutation props.
-        fitted_mut = X.dot(pseudocoefs)
-        # add pseudofrac to avoid zero fitted mutations
-        fitted_mut = fitted_mut + self.pseudofrac
-        fitted_mut = fitted_mut / (fitted_mut + (1 - fitted_mut + 2 * self.pseudofrac))
-        # compute Fisher information of in terms of binomial model
-        binom_info = np.diag(1 / (fitted_mut * (1 - fitted_mut)))
-        # compute Fisher information of in terms of linear prob. model
-        linprob_info = X.T.dot(binom_info).dot(X)
-        # try to invert Fisher information matrix
-        try:
-            inv_info = np.linalg.inv(linprob_info)
-        except np.linalg.LinAlgError:
-            inv_info = linprob_info * np.nan
+        if self.scale == "linear":
+            # compute root on non-negative
+            return np.sqrt(np.where(variances >= 0.0, variances, np.nan))
 
-        # construct the jacobian
+        # logit scale, using the Delta method
+        pseudocoefs = coefs / np.sum(coefs, axis=-1, keepdims=True)
         pseudocoefs = (pseudocoefs + self.pseudofrac) / (
-            np.sum(pseudocoefs) + 2 * self.pseudofrac
+            np.sum(pseudocoefs, axis=-1, keepdims=True) + 2 * self.pseudofrac
         )
-        jacobian = -1 * np.tile(
-            np.expand_dims(1 / (pseudocoefs * (1 - pseudocoefs)), 1), pseudocoefs.size
+        # the jacobian is 1/(p*(1-p)) on the diagonal, and its opposite elsewhere:
+        # project the inverse fisher inf. on logit scale without building it
+        row_sums = inv_info.sum(axis=-1)
+        return np.sqrt(
+            (inv_info.sum(axis=(-2, -1))[..., None] - 4 * row_sums + 4 * variances)
+            / (pseudocoefs * (1 - pseudocoefs)) ** 2
         )
-        jacobian = jacobian + 2 * np.diag(-1 * np.diag(jacobian))
 
-        # project inverse fisher inf. on logit scale
-        logit_inv_info = jacobian.dot(inv_info).dot(jacobian.T)
+    def standard_error(self, X, coefs):
+        """compute standard errors on the linear scale"""
+        linear = WaldConfint(scale="linear", pseudofrac=self.pseudofrac)
+        return linear.standard_errors(
+            self.fisher_information(X, coefs)[None], coefs[None]
+        )[0]
 
-        return np.sqrt(np.diag(logit_inv_info))
+    def logit_standard_error(self, X, coefs):
+        """compute the standard error on the logit scale using the Delta method"""
+        logit = WaldConfint(scale="logit", pseudofrac=self.pseudofrac)
+        return logit.standard_errors(
+            self.fisher_information(X, coefs)[None], coefs[None]
+        )[0]
+
+    def statistics(self, X, coefs, y=None, kvals=None):
+        """
+        compute the statistics of one date needed for its confidence interval:
+        Fisher information, and overdispersion if quasibinomial (see confint_all)
+        """
+        stats = {"info": self.fisher_information(X, coefs)}
+        if self.quasi:
+            stats["overdisp"] = self.quasibinom_overdisp(X, y, coefs, kvals)
+        return stats
 
     def confint(self, X, coefs, y=None, kvals=None):
         """compute confidence intervals on the linear scale"""
+        stats = self.statistics(X, coefs, y, kvals)
+        band = self.confint_all(
+            coefs[None], **{k: np.expand_dims(v, 0) for k, v in stats.items()}
+        )
+        return {k: v[0] for k, v in band.items()}
+
+    def confint_all(self, coefs, info, overdisp=None):
+        """
+        compute confidence intervals of all the dates at once
+
+        coefs (np.array): (dates x variants) fitted proportions
+        info (np.array): (dates x variants x variants) Fisher information matrices (see statistics)
+        overdisp (np.array): quasibinomial overdispersion, (dates) with method all or (dates x variants) with strat
+        """
+        z = norm.ppf(1 - (1 - self.level) / 2)
+        se = self.standard_errors(info, coefs)
+        if self.quasi:
+            se = se * (overdisp if overdisp.ndim > 1 else overdisp[:, None])
 
         if self.scale == "linear":
-            se = self.standard_error(X, coefs)
-            if self.quasi:
-                se = se * self.quasibinom_overdisp(X, y, coefs, kvals)
             return {
-                "lower": coefs - norm.ppf(1 - (1 - self.level) / 2) * se,
-                "upper": coefs + norm.ppf(1 - (1 - self.level) / 2) * se,
+                "lower": coefs - z * se,
+                "upper": coefs + z * se,
             }
 
         elif self.scale == "logit":
-            se = self.logit_standard_error(X, coefs)
-            if self.quasi:
-                se = se * self.quasibinom_overdisp(X, y, coefs, kvals)
-
             fitted_pseudo = coefs + self.pseudofrac
-            fitted_pseudo = fitted_pseudo / np.sum(fitted_pseudo)
+            fitted_pseudo = fitted_pseudo / np.sum(
+                fitted_pseudo, axis=-1, keepdims=True
+            )
             logit_fitted_pseudo = np.log(fitted_pseudo) - np.log(1 - fitted_pseudo)
             logit_fitted = np.log(coefs) - np.log(1 - coefs)
 
-            lower = logit_fitted - norm.ppf(1 - (1 - self.level) / 2) * se
-            lower_pseudo = logit_fitted_pseudo - norm.ppf(1 - (1 - self.level) / 2) * se
-            lower_consensus = np.array([lower, lower_pseudo]).min(axis=0)
+            lower = logit_fitted - z * se
+            lower_pseudo = logit_fitted_pseudo - z * se
+            lower_consensus = np.minimum(lower, lower_pseudo)
 
-            upper = logit_fitted + norm.ppf(1 - (1 - self.level) / 2) * se
-            upper_pseudo = logit_fitted_pseudo + norm.ppf(1 - (1 - self.level) / 2) * se
-            upper_consensus = np.array([upper, upper_pseudo]).max(axis=0)
+            upper = logit_fitted + z * se
+            upper_pseudo = logit_fitted_pseudo + z * se
+            upper_consensus = np.maximum(upper, upper_pseudo)
 
             return {
                 "lower": lower_consensus,
@@ -149,14 +193,16 @@ class WaldConfint:
             }
 
 
-def resample_mutations(df_city1, mutations):
+def resample_mutations(df_city1, mutations, rng=None):
     """
     Function to resample mutations by replacement (preserving mutation-complement pairs).
     Returns a copy of the DataFrame with <resample_value> column indicating how many times the mutation was in the resample.
+
+    rng (np.random.Generator): random stream to use, instead of numpy's global one
     """
 
     # resample indices of mutations with replacement (warning: high is one above actual high!
-    rand_idcs = np.random.randint(
+    rand_idcs = (rng.integers if rng is not None else np.random.randint)(
         0, high=int(len(mutations) / 2), size=int(len(mutations) / 2)
     )
     # for all mutations, count how many times they appear in the resample (0, 1, 2 ...)
@@ -170,3 +216,43 @@ def resample_mutations(df_city1, mutations):
     df_sampled.loc[:, "resample_value"] = df_sampled.mutations.map(resample_coeff_dict)
 
     return df_sampled, rand_idcs
+
+
+def resample_weights(mutations, n, rng=None):
+    """
+    Function to draw the resamples of n bootstrap replicates at once (preserving mutation-complement pairs).
+    Returns a (n x mutations) array with how many times each mutation is in each resample, in the order of mutations.
+
+    mutations are paired with their complement by name ('-' prefix, see DataPreprocesser.make_complement),
+    unpaired ones (e.g.: after filtering only one of the pair) are never drawn.
+
+    rng (np.random.Generator): random stream to use, instead of numpy's global one
+    (draws the same resamples as n successive calls to resample_mutations, when
+    the complements follow the mutations in the same order)
+    """
+
+    names = pd.Series(np.asarray(mutations, dtype=str))
+    is_complement = names.str.startswith("-")
+    bases = names.str.replace(r"^-", "", regex=True)
+    # pairs, in order of their mutation
+    pairs = pd.Index(
+        bases[~is_complement][bases[~is_complement].isin(bases[is_complement])]
+    ).unique()
+    # column of each mutation in the counts of pairs, -1 if unpaired
+    codes = pairs.get_indexer(bases)
+
+    half = len(pairs)
+    # resample indices of mutations with replacement, one row per replicate
+    rand_idcs = (rng.integers if rng is not None else np.random.randint)(
+        0, high=half, size=(n, half)
+    )
+    # count per replicate, by offsetting each row into its own range of bins
+    resamples_counts = np.bincount(
+        (rand_idcs + half * np.expand_dims(np.arange(n), 1)).ravel(),
+        minlength=n * half,
+    ).reshape(n, half)
+
+    # unpaired mutations take the last column: never drawn
+    return np.concatenate(
+        [resamples_counts, np.zeros((n, 1), dtype=resamples_counts.dtype)], axis=1
+    )[:, codes]
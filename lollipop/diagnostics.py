@@ -0,0 +1,97 @@
+import pandas as pd
+import numpy as np
+
+
+class SolveDiagnostics:
+    """
+    collect diagnostics of each solve of a KernelDeconv (one per deconvolved date)
+
+    Per date:
+     rows: number of observations in the support of the kernel
+     kernel_mass: sum of the kernel values (times the observation weights) over the support
+     effective_rows: Kish's effective number of observations (sum k)^2 / sum k^2
+     evaluations: of the objective by the regressor, if it reports them (e.g.: RobustReg), otherwise missing
+     status: of the regressor, positive if converged (RobustReg: of least_squares, NnlsReg: 1)
+     solve_time: seconds spent in the regressor
+     gram_condition: condition number of the Gram matrix X'K^2X of the kernel-weighted least squares
+     condition: condition number of the Fisher information of the Wald confidence intervals
+      (see WaldConfint.fisher_information), missing with other confints
+    """
+
+    columns = [
+        "date",
+        "rows",
+        "kernel_mass",
+        "effective_rows",
+        "evaluations",
+        "status",
+        "solve_time",
+        "gram_condition",
+        "condition",
+    ]
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, date, rows, kernel_mass, kernel_mass2, xtx, regfit, solve_time):
+        """
+        add the diagnostics of the solve on date
+
+        kernel_mass2 (float): sum of the squared kernel values over the support
+        xtx (np.array): Gram matrix X'K^2X (variants x variants)
+        regfit (regressor object): the fitted regressor
+        """
+        self.records.append(
+            [
+                date,
+                rows,
+                kernel_mass,
+                kernel_mass**2 / kernel_mass2 if kernel_mass2 > 0 else 0.0,
+                getattr(regfit, "nfev", None),
+                getattr(regfit, "status", None),
+                solve_time,
+                np.linalg.cond(xtx) if rows else np.inf,
+                np.nan,
+            ]
+        )
+        return self
+
+    def record_information(self, info):
+        """add the Fisher information (variants x variants) of the confint to the last solve"""
+        self.records[-1][-1] = np.linalg.cond(info) if self.records[-1][1] else np.inf
+        return self
+
+    def record_support(self, date, X, kvals, regfit, solve_time):
+        """add the diagnostics of the solve on date, from the observations in the support of the kernel"""
+        kX = X * np.expand_dims(kvals, 1)
+        return self.record(
+            date,
+            kvals.size,
+            kvals.sum(),
+            kvals.dot(kvals),
+            kX.T.dot(kX),
+            regfit,
+            solve_time,
+        )
+
+    def to_frame(self, **labels):
+        """
+        diagnostics as a table with compact types, one row per solve
+
+        labels: constant columns to prepend (e.g.: location)
+        """
+        df = pd.DataFrame.from_records(self.records, columns=self.columns)
+        for i, (name, value) in enumerate(labels.items()):
+            df.insert(i, name, pd.Series(value, index=df.index, dtype=object))
+        return df.astype(
+            {
+                "rows": "int32",
+                "kernel_mass": "float32",
+                "effective_rows": "float32",
+                "evaluations": "Int32",
+                "status": "Int8",
+                "solve_time": "float32",
+                "gram_condition": "float64",
+                "condition": "float64",
+            }
+        )
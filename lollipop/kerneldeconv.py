@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+import time
 
 # from scipy.optimize import nnls, least_squares
 from .kernels import GaussianKernel, BoxKernel
@@ -21,6 +22,7 @@ class KernelDeconv:
         kernel=GaussianKernel(),
         reg=NnlsReg(),
         confint=WaldConfint(),
+        diagnostics=None,
     ):
         """
         X (pd.DataFrame): dataframe of variant definition (design matrix)
@@ -30,6 +32,7 @@ class KernelDeconv:
         kernel (kernel object): object with methods to compute kernel weighting
         reg (regressor object): object with methods to compute the regression
         confint (confint object): object with method to compute confidence bands
+        diagnostics (SolveDiagnostics): collector recording each solve of deconv and deconv_all, if provided
         """
         self.X = X
         self.y = y
@@ -41,43 +44,243 @@ class KernelDeconv:
         self.kernel = kernel
         self.reg = reg
         self.confint = confint
+        self.diagnostics = diagnostics
         self.variant_names = X.columns
 
-    def deconv(self, date, min_tol=1e-10, renormalize=True):
+    def deconv(self, date, min_tol=1e-10, renormalize=True, b0=None):
         """
         compute kernel deconvolution centered on specific date, returns fitted regression object
+
+        b0 (np.array): starting values for regressors using them (e.g.: RobustReg)
         """
         # compute kernel values
         kvals = (
             self.kernel.values(0, (date - self.dates) / pd.to_timedelta(1, unit="D"))
             * self.weights
         )
+        support = kvals.values >= min_tol
+        return self._deconv_support(
+            self.X.values[support, :],
+            self.y.values.flatten()[support],
+            kvals.values[support],
+            renormalize,
+            b0,
+            date,
+        )
+
+    def _fit_support(self, X, y, kvals, renormalize=True, b0=None, date=None):
+        """
+        fit regression on the observations in the support of the kernel, returns fitted regression object
+        """
         # compute and return fitted coefs
-        regfit = self.reg.fit(
-            self.X.values[kvals.values >= min_tol, :],
-            self.y.values.flatten()[kvals.values >= min_tol],
-            kvals.values[kvals.values >= min_tol],
+        solve_start = time.perf_counter()
+        regfit = (
+            self.reg.fit(X, y, kvals)
+            if b0 is None
+            else self.reg.fit(X, y, kvals, b0=b0)
         )
+        if self.diagnostics is not None:
+            self.diagnostics.record_support(
+                date, X, kvals, regfit, time.perf_counter() - solve_start
+            )
 
         # renormalize
         if renormalize:
             regfit.fitted = regfit.fitted / np.sum(regfit.fitted)
 
+        return regfit
+
+    def _deconv_support(self, X, y, kvals, renormalize=True, b0=None, date=None):
+        """
+        fit regression and confint on the observations in the support of the kernel, returns fitted regression object
+        """
+        regfit = self._fit_support(X, y, kvals, renormalize, b0, date)
+
         # compute and return confint
         regfit.conf_band = self.confint.confint(
-            X=self.X.values[kvals.values >= min_tol, :]
-            * np.expand_dims(kvals.values[kvals.values >= min_tol], 1),
+            X=X * np.expand_dims(kvals, 1),
             coefs=regfit.fitted,
-            y=self.y.values.flatten()[kvals.values >= min_tol],
-            kvals=kvals.values[kvals.values >= min_tol],
+            y=y,
+            kvals=kvals,
         )
+        if self.diagnostics is not None and hasattr(self.confint, "fisher_information"):
+            self.diagnostics.record_information(
+                self.confint.fisher_information(
+                    X * np.expand_dims(kvals, 1), regfit.fitted
+                )
+            )
 
         return regfit
 
-    def deconv_all(self, min_tol=1e-10, renormalize=True):
+    def date_index(self):
+        """
+        index the observations by their integer day ordinals
+
+        returns:
+         ordinals (np.array): day ordinal of each observation
+         order (np.array): permutation sorting the observations by date
+         days (np.array): sorted unique day ordinals
+         bounds (np.array): observations order[bounds[i]:bounds[i+1]] are on days[i]
+        """
+        ordinals = np.asarray(self.dates.values, dtype="datetime64[D]").astype(np.int64)
+        order = np.argsort(ordinals, kind="stable")
+        days, starts = np.unique(ordinals[order], return_index=True)
+        return ordinals, order, days, np.append(starts, ordinals.size)
+
+    def support_radius(self, min_tol=1e-10, max_weight=1.0):
+        """
+        radius (in days) beyond which kernel values, weighted by at most max_weight, are all below min_tol
+        """
+        support = getattr(self.kernel, "support", None)
+        if support is None or max_weight <= 0:
+            return np.inf
+        # weights above 1 can lift kernel values below min_tol back into the support
+        return support(min_tol / max_weight)
+
+    def output_dates(self, dates=None):
+        """
+        unique dates to deconvolve (in the order of self.dates.unique()), optionally restricted to dates
+        """
+        udates = self.dates.unique()
+        if dates is None:
+            return udates
+        return udates[pd.Index(udates).isin(dates)]
+
+    def affected_dates(self, changed, min_tol=1e-10):
+        """
+        dates whose deconvolution can change when the observations on the changed dates change
+        (i.e.: within the support radius of the kernel), in the order of self.dates.unique()
+        """
+        udates = self.dates.unique()
+        changed = np.sort(
+            np.asarray(pd.to_datetime(changed), dtype="datetime64[D]").astype(np.int64)
+        )
+        if changed.size == 0:
+            return udates[:0]
+        radius = self.support_radius(
+            min_tol, np.asarray(self.weights, dtype=float).max(initial=0.0)
+        )
+        ordinals = np.asarray(udates, dtype="datetime64[D]").astype(np.int64)
+        # distance to the closest changed date on either side
+        pos = np.searchsorted(changed, ordinals)
+        after = changed[np.minimum(pos, changed.size - 1)] - ordinals
+        before = ordinals - changed[np.maximum(pos - 1, 0)]
+        mask = (np.abs(after) <= radius) | (np.abs(before) <= radius)
+        return udates[mask]
+
+    def _day_windows(self, days, min_tol, max_weight, dates=None):
+        """
+        iterate over the output dates (see output_dates),
+        yielding the range [start, stop) of the sorted unique days within the kernel radius
+        and the kernel values on those days
+        """
+        radius = self.support_radius(min_tol, max_weight)
+        for day in np.asarray(self.output_dates(dates), dtype="datetime64[D]").astype(
+            np.int64
+        ):
+            start = np.searchsorted(days, day - radius, side="left")
+            stop = np.searchsorted(days, day + radius, side="right")
+            yield start, stop, self.kernel.values(
+                0, (day - days[start:stop]).astype(float)
+            )
+
+    def kernel_windows(self, min_tol=1e-10, dates=None):
+        """
+        iterate over the output dates (see output_dates),
+        yielding the indices of the observations within reach of the kernel and their kernel values
+
+        The observations are indexed by their sorted integer day ordinals, and only those inside
+        the support radius of the kernel (see the kernels' support method) are evaluated,
+        making this O(rows x window) instead of O(rows x dates).
+        """
+        weights = np.asarray(self.weights, dtype=float).flatten()
+        ordinals, order, days, bounds = self.date_index()
+
+        for start, stop, kdays in self._day_windows(
+            days, min_tol, weights.max(initial=0.0), dates
+        ):
+            idx = order[bounds[start] : bounds[stop]]
+            kvals = np.repeat(kdays, np.diff(bounds[start : stop + 1])) * weights[idx]
+            # keep the original order of observations
+            srt = np.argsort(idx, kind="stable")
+            idx, kvals = idx[srt], kvals[srt]
+            mask = kvals >= min_tol
+            yield idx[mask], kvals[mask]
+
+    def gram_windows(self, min_tol=1e-10, dates=None, support=False):
+        """
+        iterate over the output dates (see output_dates),
+        yielding the sufficient statistics (X'KX, X'Ky, y'Ky) of the kernel-weighted least squares
+
+        The statistics are accumulated once per observation day,
+        and then only combined per date, making this independent of the number of mutations.
+        Requires all observations to share the same weight (no resampling).
+
+        support (bool): also yield the number of observations in the support of the kernel,
+         and the sums of their kernel values and squared kernel values (see SolveDiagnostics)
+        """
+        X = np.asarray(self.X.values, dtype=float)
+        y = np.asarray(self.y.values, dtype=float).flatten()
+        weight = np.asarray(self.weights, dtype=float).flatten()[0]
+        ordinals, order, days, bounds = self.date_index()
+
+        # per observation day statistics
+        xtx = np.empty((days.size, X.shape[1], X.shape[1]))
+        xty = np.empty((days.size, X.shape[1]))
+        yty = np.empty(days.size)
+        for i in range(days.size):
+            idx = order[bounds[i] : bounds[i + 1]]
+            xtx[i] = X[idx, :].T.dot(X[idx, :])
+            xty[i] = X[idx, :].T.dot(y[idx])
+            yty[i] = y[idx].dot(y[idx])
+
+        for start, stop, kdays in self._day_windows(days, min_tol, weight, dates):
+            kvals = kdays * weight
+            # regressors square the kernel weights
+            kk = np.where(kvals >= min_tol, kvals**2, 0.0)
+            stats = (
+                np.tensordot(kk, xtx[start:stop], axes=1),
+                kk.dot(xty[start:stop]),
+                kk.dot(yty[start:stop]),
+            )
+            if support:
+                rows = np.where(kvals >= min_tol, np.diff(bounds[start : stop + 1]), 0)
+                stats += ((rows.sum(), rows.dot(kvals), rows.dot(kk)),)
+            yield stats
+
+    def _start_values(self, date, start=None, previous=None):
+        """
+        starting coefficients for the regression on date: from start if provided, else from the previous fit
+        """
+        if start is not None and date in start.index:
+            return start.loc[date, self.variant_names].values.astype(float)
+        if previous:
+            return previous[-1]
+        return None
+
+    def deconv_all(
+        self,
+        min_tol=1e-10,
+        renormalize=True,
+        batched=True,
+        dates=None,
+        warm_start=False,
+        start=None,
+    ):
         """
         compute kernel deconvolution for all dates
 
+        batched (bool): only evaluate the kernel within its support window around each date
+         (see kernel_windows) and feed the regressor and confint from precomputed arrays,
+         computing the confidence intervals of all dates at once (see the confints' confint_all),
+         otherwise call self.deconv on each date in turn.
+         With a regressor in gram mode (e.g.: NnlsReg(gram=True)) and without confint,
+         the regression is solved from per-day sufficient statistics (see gram_windows).
+        dates (list-like): only deconvolve on these dates (e.g.: see affected_dates), default: all dates
+        warm_start (bool): start the regressor (e.g.: RobustReg) from the previous date's coefficients
+        start (pd.DataFrame): per-date starting coefficients (e.g.: the fit on the full data, when bootstrapping),
+         takes precedence over warm_start
+
         self.fitted (pd.DataFrame):
         """
         #         deconvolved = [self.deconv(date).__dict__ for date in self.dates.unique()]
@@ -92,28 +295,236 @@ class KernelDeconv:
         loss = []
         lower = []
         upper = []
-        for date in self.dates.unique():
-            deconv = self.deconv(date, min_tol, renormalize)
-            fitted.append(deconv.fitted)
-            loss.append(deconv.loss)
-            lower.append(deconv.conf_band["lower"])
-            upper.append(deconv.conf_band["upper"])
+        weights = np.asarray(self.weights, dtype=float).flatten()
+        if (
+            batched
+            and getattr(self.reg, "gram", False)
+            and isinstance(self.confint, NullConfint)
+            and np.all(weights == weights[0])
+        ):
+            # regression only needs the sufficient statistics
+            for date, (xtx, xty, yty, *support) in zip(
+                self.output_dates(dates),
+                self.gram_windows(min_tol, dates, self.diagnostics is not None),
+            ):
+                solve_start = time.perf_counter()
+                deconv = self.reg.fit_gram(xtx, xty, yty)
+                if self.diagnostics is not None:
+                    self.diagnostics.record(
+                        date,
+                        *support[0],
+                        xtx,
+                        deconv,
+                        time.perf_counter() - solve_start,
+                    )
+                if renormalize:
+                    deconv.fitted = deconv.fitted / np.sum(deconv.fitted)
+                fitted.append(deconv.fitted)
+                loss.append(deconv.loss)
+                lower.append(deconv.fitted * np.nan)
+                upper.append(deconv.fitted * np.nan)
+        elif batched:
+            X = np.asarray(self.X.values, dtype=float)
+            y = np.asarray(self.y.values, dtype=float).flatten()
+            stats = []
+            for date, (idx, kvals) in zip(
+                self.output_dates(dates), self.kernel_windows(min_tol, dates)
+            ):
+                deconv = self._fit_support(
+                    X[idx, :],
+                    y[idx],
+                    kvals,
+                    renormalize,
+                    self._start_values(date, start, fitted if warm_start else None),
+                    date,
+                )
+                fitted.append(deconv.fitted)
+                loss.append(deconv.loss)
+                # only keep the (variants x variants) statistics of the window for the confint
+                stats.append(
+                    self.confint.statistics(
+                        X[idx, :] * np.expand_dims(kvals, 1),
+                        deconv.fitted,
+                        y[idx],
+                        kvals,
+                    )
+                )
+                if self.diagnostics is not None and "info" in stats[-1]:
+                    self.diagnostics.record_information(stats[-1]["info"])
+            if fitted:
+                # confint of all dates at once
+                conf_band = self.confint.confint_all(
+                    np.array(fitted),
+                    **{k: np.array([st[k] for st in stats]) for k in stats[0]},
+                )
+                lower, upper = conf_band["lower"], conf_band["upper"]
+        else:
+            for date in self.output_dates(dates):
+                deconv = self.deconv(
+                    date,
+                    min_tol,
+                    renormalize,
+                    self._start_values(date, start, fitted if warm_start else None),
+                )
+                fitted.append(deconv.fitted)
+                loss.append(deconv.loss)
+                lower.append(deconv.conf_band["lower"])
+                upper.append(deconv.conf_band["upper"])
 
+        index = self.output_dates(dates)
         self.fitted = pd.DataFrame(
-            np.array(fitted), columns=self.variant_names, index=self.dates.unique()
+            np.array(fitted).reshape(-1, len(self.variant_names)),
+            columns=self.variant_names,
+            index=index,
         )
         self.loss = np.array(loss)
         self.conf_bands = {
             "lower": pd.DataFrame(
-                np.array(lower), columns=self.variant_names, index=self.dates.unique()
+                np.array(lower).reshape(-1, len(self.variant_names)),
+                columns=self.variant_names,
+                index=index,
             ),
             "upper": pd.DataFrame(
-                np.array(upper), columns=self.variant_names, index=self.dates.unique()
+                np.array(upper).reshape(-1, len(self.variant_names)),
+                columns=self.variant_names,
+                index=index,
             ),
         }
 
         return self
 
+    def deconv_bootstrap(
+        self,
+        mutations,
+        counts,
+        min_tol=1e-10,
+        renormalize=True,
+        batch_size=100,
+        warm_start=False,
+        **kwargs,
+    ):
+        """
+        compute kernel deconvolution for all dates on bootstrap replicates resampling the mutations
+
+        mutations (np.array): for each observation, its mutation as a column index of counts
+        counts (np.array): (replicates x mutations) times each mutation is drawn (e.g.: see resample_weights)
+        batch_size (int): number of replicates whose sufficient statistics are combined at once
+        warm_start (bool): start the regressors of all replicates (e.g.: RobustReg) from the fit on all data
+        kwargs: further parameters passed to deconv_all (regressors without fit_gram only)
+
+        yields (pd.DataFrame) the fitted values of each replicate, as it finishes
+
+        With a regressor providing fit_gram (e.g.: NnlsReg), the kernel weights and design are only
+        processed once per date into per-mutation sufficient statistics, that each replicate reweights.
+        Otherwise, each replicate runs deconv_all with the counts as observation weights.
+        """
+        mutations = np.asarray(mutations)
+        counts = np.asarray(counts)
+
+        if not hasattr(self.reg, "fit_gram"):
+            start = (
+                self.deconv_all(min_tol, renormalize, **kwargs).fitted.copy()
+                if warm_start
+                else None
+            )
+            for replicate in counts:
+                yield KernelDeconv(
+                    self.X,
+                    self.y,
+                    self.dates,
+                    weights=replicate[mutations],
+                    kernel=self.kernel,
+                    reg=self.reg,
+                    confint=self.confint,
+                ).deconv_all(min_tol, renormalize, start=start, **kwargs).fitted
+            return
+
+        X = np.asarray(self.X.values, dtype=float)
+        y = np.asarray(self.y.values, dtype=float).flatten()
+        n_var = X.shape[1]
+        ordinals, order, days, bounds = self.date_index()
+        max_count = counts.max(initial=0)
+        index = self.output_dates()
+        fitted = np.empty((counts.shape[0], len(index), n_var))
+
+        for d, (start, stop, kdays) in enumerate(
+            self._day_windows(days, min_tol, max_count)
+        ):
+            idx = order[bounds[start] : bounds[stop]]
+            kvals = np.repeat(kdays, np.diff(bounds[start : stop + 1]))
+            # smallest count bringing each observation into the support: kvals * count >= min_tol
+            with np.errstate(divide="ignore", invalid="ignore"):
+                level = np.ceil(min_tol / kvals)
+            level = np.where(kvals * (level - 1) >= min_tol, level - 1, level)
+            level = np.where(kvals * level < min_tol, level + 1, level)
+            level = np.maximum(level, 1)
+
+            # per mutation sufficient statistics, for each support level
+            stats = []
+            for lvl in np.unique(level[level <= max_count]):
+                rows = idx[level == lvl]
+                kk = kvals[level == lvl] ** 2
+                srt = np.argsort(mutations[rows], kind="stable")
+                rows, kk = rows[srt], kk[srt]
+                muts, firsts = np.unique(mutations[rows], return_index=True)
+                kX = np.expand_dims(kk, 1) * X[rows, :]
+                stats.append(
+                    (
+                        int(lvl),
+                        muts,
+                        np.add.reduceat(
+                            np.expand_dims(kX, 2) * np.expand_dims(X[rows, :], 1),
+                            firsts,
+                            axis=0,
+                        ).reshape(muts.size, -1),
+                        np.add.reduceat(kX * np.expand_dims(y[rows], 1), firsts),
+                        np.add.reduceat(kk * y[rows] ** 2, firsts),
+                    )
+                )
+
+            for first in range(0, counts.shape[0], batch_size):
+                batch = counts[first : first + batch_size]
+                xtx = np.zeros((batch.shape[0], n_var * n_var))
+                xty = np.zeros((batch.shape[0], n_var))
+                yty = np.zeros(batch.shape[0])
+                for lvl, muts, s_xtx, s_xty, s_yty in stats:
+                    # regressors square the weights
+                    cc = np.where(batch[:, muts] >= lvl, batch[:, muts] ** 2, 0)
+                    xtx += cc.dot(s_xtx)
+                    xty += cc.dot(s_xty)
+                    yty += cc.dot(s_yty)
+                for b in range(batch.shape[0]):
+                    regfit = self.reg.fit_gram(
+                        xtx[b].reshape(n_var, n_var), xty[b], yty[b]
+                    )
+                    fitted[first + b, d] = (
+                        regfit.fitted / np.sum(regfit.fitted)
+                        if renormalize
+                        else regfit.fitted
+                    )
+
+        for replicate in fitted:
+            yield pd.DataFrame(replicate, columns=self.variant_names, index=index)
+
+    def merge_previous(self, fitted, conf_bands):
+        """
+        complete the deconvolution with results of a previous run (e.g.: on the dates left out of deconv_all(dates=...)),
+        only keeping those of dates still present and not recomputed
+        """
+        index = self.output_dates()
+
+        def complete(new, old):
+            old = old[old.index.isin(index) & ~old.index.isin(new.index)]
+            return pd.concat([new, old]).reindex(index)
+
+        self.fitted = complete(self.fitted, fitted)
+        self.conf_bands = {
+            band: complete(self.conf_bands[band], conf_bands[band])
+            for band in self.conf_bands
+        }
+
+        return self
+
     def renormalize(self):
         """renormalize variants proportion so that they sum to 1"""
         self.fitted = self.fitted.divide(self.fitted.sum(axis=1), axis=0)
@@ -17,6 +17,16 @@ class GaussianKernel:
         """
         return np.exp(-((y1 - y2) ** 2) / 2 / self.bandwidth)
 
+    def support(self, min_tol=1e-10):
+        """
+        radius beyond which the kernel drops below min_tol (truncation of the infinite support)
+        """
+        if min_tol <= 0:
+            return np.inf
+        if min_tol >= 1:
+            return 0.0
+        return np.sqrt(-2 * self.bandwidth * np.log(min_tol))
+
 
 class BoxKernel:
     """compute box kernel between y1 and y2"""
@@ -32,3 +42,9 @@ class BoxKernel:
         compute box kernel between y1 and y2
         """
         return 1.0 * (np.abs(y1 - y2) <= self.bandwidth / 2)
+
+    def support(self, min_tol=1e-10):
+        """
+        radius beyond which the kernel is zero (exact)
+        """
+        return self.bandwidth / 2
@@ -3,7 +3,7 @@ import numpy as np
 from functools import reduce
 import re
 import sys
-from pandas.api.types import is_numeric_dtype
+from pandas.api.types import is_float_dtype, is_numeric_dtype
 
 
 class DataPreprocesser:
@@ -13,18 +13,64 @@ class DataPreprocesser:
 
     def __init__(self, df_tally):
         self.df_tally = df_tally
+        # columns that differ between mutations and their complement (see general_preprocess)
+        self.complemented = None
 
     def make_complement(self, df_tally, variants_list):
         """return a dataframe with the complement of mutations signatures and mutations fracs"""
         t_data = df_tally.copy()
-        t_data["mutations"] = "-" + t_data["mutations"]
+        if isinstance(t_data["mutations"].dtype, pd.CategoricalDtype):
+            # complement codes within the same categories (see compact_mutations)
+            categories = t_data["mutations"].cat.categories
+            t_data["mutations"] = pd.Categorical.from_codes(
+                categories.get_indexer("-" + categories)[t_data["mutations"].cat.codes],
+                dtype=t_data["mutations"].dtype,
+            )
+        else:
+            t_data["mutations"] = "-" + t_data["mutations"]
         t_data["frac"] = 1 - t_data["frac"]
         t_data[variants_list] = 1 - t_data[variants_list]
-        t_data["undetermined"] = 1
+        t_data["undetermined"] = np.ones(
+            len(t_data), dtype=t_data.get("undetermined", pd.Series(dtype=int)).dtype
+        )
 
         return t_data
 
-    def general_preprocess(
+    def compact_columns(self, variants_columns=[]):
+        """
+        use compact dtypes for all but the variant columns (see general_preprocess's compact):
+        text as categoricals, smallest integers, and single precision floats
+        """
+        for col in self.df_tally.columns.difference(
+            list(variants_columns) + ["date", "mutations"], sort=False
+        ):
+            column = self.df_tally[col]
+            if is_numeric_dtype(column):
+                column = column.fillna(0)
+                self.df_tally[col] = (
+                    column.astype(np.float32)
+                    if is_float_dtype(column)
+                    else pd.to_numeric(column, downcast="integer")
+                )
+            elif column.dtype == object:
+                self.df_tally[col] = column.astype("category")
+
+        return self
+
+    def compact_mutations(self):
+        """
+        integer-code the mutations as a categorical,
+        with categories for both the mutations and their complements (see make_complement)
+        """
+        mutations = self.df_tally["mutations"].astype("category")
+        categories = mutations.cat.categories
+        self.df_tally["mutations"] = mutations.cat.set_categories(
+            categories.append("-" + categories)
+        )
+
+        return self
+
+    def prefilter(
         self,
         variants_list,
         variants_pangolin,
@@ -34,28 +80,21 @@ class DataPreprocesser:
         end_date=None,
         no_date=False,
         remove_deletions=True,
-        make_complement=True,
     ):
-        """General preprocessing steps"""
+        """
+        preprocessing steps which only select rows and columns (see general_preprocess),
+        and can thus be applied independently on chunks of a tally
+        """
         # rename columns
-        assert len(variants_pangolin.values()) == len(
-            set(variants_pangolin.values())
-        ), f"duplicate values in:\n{variants_pangolin}"
         self.df_tally = self.df_tally.rename(columns=variants_pangolin)
         # drop non reported variants
         self.df_tally = self.df_tally.drop(
             variants_not_reported, axis=1, errors="ignore"
         )
         # drop rows without estimated frac or date
-        self.df_tally.dropna(
-            subset=["frac", "date"] if not no_date else ["frac"], inplace=True
+        self.df_tally = self.df_tally.dropna(
+            subset=["frac", "date"] if not no_date else ["frac"]
         )
-        # create column with mutation signature
-        if ("base" in self.df_tally.columns) and ("pos" in self.df_tally.columns):
-            # NOTE if cojac-based instead of SNV-bsed deconvolution: there is no single mutation
-            self.df_tally["mutations"] = (
-                self.df_tally["pos"].astype(str) + self.df_tally["base"]
-            )
         # convert date string to date object
         # (also convert any dummy date of 'no_date'
         self.df_tally["date"] = pd.to_datetime(self.df_tally["date"])
@@ -76,10 +115,60 @@ class DataPreprocesser:
                     file=sys.stderr,
                 )
 
-        # df_data = df_data[df_data.columns.difference(['pos', 'gene', 'base'], sort=False)]
-
         # delete lines with mutation of the type that we want to delete (to_drop)
         # e.g.: remove all 'subset' mutations
+        for v in variants_list:
+            if v in self.df_tally.columns:
+                drop_mask = self.df_tally[v].isin(to_drop)
+                if any(drop_mask):
+                    self.df_tally = self.df_tally[~drop_mask]
+
+        return self
+
+    def general_preprocess(
+        self,
+        variants_list,
+        variants_pangolin,
+        variants_not_reported,
+        to_drop,
+        start_date=None,
+        end_date=None,
+        no_date=False,
+        remove_deletions=True,
+        make_complement=True,
+        compact=False,
+    ):
+        """
+        General preprocessing steps
+
+        compact (bool): keep the tally in compact dtypes instead of object/float64 columns,
+         (see compact_columns and compact_mutations), with int8 variant signatures
+        """
+        # rename columns
+        assert len(variants_pangolin.values()) == len(
+            set(variants_pangolin.values())
+        ), f"duplicate values in:\n{variants_pangolin}"
+        self.prefilter(
+            variants_list,
+            variants_pangolin,
+            variants_not_reported,
+            to_drop,
+            start_date,
+            end_date,
+            no_date,
+            remove_deletions,
+        )
+        # create column with mutation signature
+        if ("base" in self.df_tally.columns) and ("pos" in self.df_tally.columns):
+            # NOTE if cojac-based instead of SNV-bsed deconvolution: there is no single mutation
+            self.df_tally["mutations"] = (
+                self.df_tally["pos"].astype(str) + self.df_tally["base"]
+            )
+        if compact:
+            self.compact_columns(set(variants_list) | set(variants_pangolin.values()))
+
+        # df_data = df_data[df_data.columns.difference(['pos', 'gene', 'base'], sort=False)]
+
         absentcol = set(variants_list) - set(self.df_tally.columns)
         if len(absentcol):
             # check for missing
@@ -87,23 +176,35 @@ class DataPreprocesser:
                 f"Warning, variants_list's {absentcol} is not present in columns {self.df_tally.columns}",
                 file=sys.stderr,
             )
-        for v in variants_list:
-            if v in self.df_tally.columns:
-                drop_mask = self.df_tally[v].isin(to_drop)
-                if any(drop_mask):
-                    self.df_tally = self.df_tally[~drop_mask]
         # drop index
         self.df_tally = self.df_tally.reset_index(drop=True)
 
-        # this should be done very differently: create 0-1 matrix of definitions
-        self.df_tally = self.df_tally.replace(np.nan, 0)
-        # self.df_tally = self
-        self.df_tally = self.df_tally.replace(
-            ["extra", "mut", "shared", "revert", "subset"], 1
-        ).infer_objects()
+        variants_columns = list(set(variants_list) & set(self.df_tally.columns))
+        if compact:
+            # 0-1 matrix of definitions, only translating the variant columns
+            for v in variants_columns:
+                column = self.df_tally[v]
+                self.df_tally[v] = (
+                    pd.to_numeric(
+                        column.mask(
+                            column.isin(["extra", "mut", "shared", "revert", "subset"]),
+                            1,
+                        )
+                    )
+                    .fillna(0)
+                    .astype(np.int8)
+                )
+            if "mutations" in self.df_tally.columns:
+                self.compact_mutations()
+        else:
+            # this should be done very differently: create 0-1 matrix of definitions
+            self.df_tally = self.df_tally.replace(np.nan, 0)
+            # self.df_tally = self
+            self.df_tally = self.df_tally.replace(
+                ["extra", "mut", "shared", "revert", "subset"], 1
+            ).infer_objects()
 
         # remove uninformative mutations
-        variants_columns = list(set(variants_list) & set(self.df_tally.columns))
         self.df_tally = self.df_tally[
             ~self.df_tally[variants_columns]
             .sum(axis=1)
@@ -111,19 +212,25 @@ class DataPreprocesser:
         ]
 
         # make complement of mutation signatures for undetermined cases
-        self.df_tally.insert(self.df_tally.columns.size - 1, "undetermined", 0)
+        self.df_tally.insert(
+            self.df_tally.columns.size - 1,
+            "undetermined",
+            np.zeros(len(self.df_tally), dtype=np.int8 if compact else int),
+        )
         if make_complement:
             self.df_tally = pd.concat(
                 [self.df_tally, self.make_complement(self.df_tally, variants_columns)]
             )
+            self.complemented = variants_columns + ["mutations", "frac", "undetermined"]
 
         return self
 
-    def filter_mutations(self, filters=None):
-        """filter out hardcoded problematic mutations"""
-        if not filters:
-            return self
-
+    def compile_filters(self, filters):
+        """
+        parse the filters once into a query plan:
+        a list of (name, statements) with each statement a (column, predicate) pair,
+        the predicate taking a Series (or Index) of the column and returning a boolean array
+        """
         types = self.df_tally.dtypes
 
         rxprser = re.compile(
@@ -132,8 +239,8 @@ class DataPreprocesser:
             + r")|(?P<bad>\w+))(?P=qc) *(?P<op>in|[<>=~!]*) *(?P<qv>['\"]?)(?P<val>.+)(?P=qv) *$"
         )
 
-        def apply_filter_statement(name, fs):
-            """parse a single statement from a filter and apply it, returning a boolean series"""
+        def compile_filter_statement(name, fs):
+            """parse a single statement from a filter, returning its column and predicate"""
             m = rxprser.search(fs)
             assert m, f"Cannot parse statement <{fs}> in filter {name}"
             m = m.groupdict()
@@ -143,11 +250,6 @@ class DataPreprocesser:
             ], f"bad column name {m['bad']}, not in list: {self.df_tally.columns}, while parsing statement <{fs}> in filter {name}"
 
             # HACK handle 'date' column differently, to force datatypes
-            col = (
-                pd.to_datetime(self.df_tally["date"])
-                if "date" == m["col"]
-                else self.df_tally[m["col"]]
-            )
             val = (
                 np.datetime64(m["val"])
                 if "date" == m["col"]
@@ -158,58 +260,129 @@ class DataPreprocesser:
                 )
             )
 
-            # apply operator
+            # operator
             match m["op"]:
                 case "=" | "==" | "" as e:
                     if e == "":
                         assert (
                             " " not in val
                         ), "Do not use values with space <{val}> when using no operator (implicit 'equals'). (while parsing statement <{fs}> in filter {name})"
-                    return col == val
+                    predicate = lambda col: col == val
                 case "!=" | "!":
-                    return col != val
+                    predicate = lambda col: col != val
                 case "<":
-                    return col < val
+                    predicate = lambda col: col < val
                 case "<=" | "=<":
-                    return col <= val
+                    predicate = lambda col: col <= val
                 case ">=" | ">=":
-                    return col >= val
+                    predicate = lambda col: col >= val
                 case ">":
-                    return col > val
+                    predicate = lambda col: col > val
                 case "in":
                     # unpack list
-                    return col.isin(
-                        [
-                            v.strip("\"' ")
-                            for v in val.lstrip("[ ").rstrip(" ]").split(",")
-                        ]
-                    )
+                    values = [
+                        v.strip("\"' ")
+                        for v in val.lstrip("[ ").rstrip(" ]").split(",")
+                    ]
+                    predicate = lambda col: col.isin(values)
                 case "~" | "=~" | "~=":
-                    return col.str.contains(
+                    pattern = (
                         val[1:-1] if not m["qv"] and val[0] == val[-1] in "/@" else val
                     )
+                    predicate = lambda col: col.str.contains(pattern, na=False)
                 case "!~" | "~!":
-                    return ~(
-                        col.str.contains(
-                            val[1:-1]
-                            if not m["qv"] and val[0] == val[-1] in "/@"
-                            else val
-                        )
+                    pattern = (
+                        val[1:-1] if not m["qv"] and val[0] == val[-1] in "/@" else val
                     )
+                    predicate = lambda col: ~(col.str.contains(pattern, na=False))
                 case _ as o:
                     raise ValueError(
                         f"unknown operator {o}, while parsing statement <{fs}> in filter {name}"
                     )
 
-        for name, fl in filters.items():
-            print(f"filter {name}")
+            return m["col"], predicate
+
+        return [
+            (name, [compile_filter_statement(name, fstatmt) for fstatmt in fl])
+            for name, fl in filters.items()
+        ]
+
+    def filter_mutations(self, filters=None):
+        """
+        filter out hardcoded problematic mutations
+
+        The filters are compiled once (see compile_filters) and evaluated in a single pass:
+        each statement only on the rows still matching the previous statements of its filter,
+        text and categorical columns on their categories, and statements on columns shared by
+        mutations and their complement (see general_preprocess) only once per pair.
+        """
+        if not filters:
+            return self
+
+        plan = self.compile_filters(filters)
+
+        df = self.df_tally
+        removed = np.zeros(len(df), dtype=bool)
 
-            self.df_tally = self.df_tally[
-                ~reduce(
-                    (lambda x, y: x & y),
-                    [apply_filter_statement(name, fstatmt) for fstatmt in fl],
+        # mutations and their complement rows share index and all but the complemented columns
+        half = len(df) // 2
+        paired = (
+            self.complemented is not None
+            and len(df) == 2 * half
+            and df.index[:half].equals(df.index[half:])
+            and (df["undetermined"].values[:half] == 0).all()
+            and (df["undetermined"].values[half:] == 1).all()
+        )
+
+        columns = {}
+
+        def column(col):
+            """column as used by the predicates, converting the date and factorizing text once"""
+            if col not in columns:
+                columns[col] = (
+                    pd.to_datetime(df[col])
+                    if "date" == col
+                    else (
+                        df[col].astype("category")
+                        if df[col].dtype == object
+                        else df[col]
+                    )
                 )
-            ]
+            return columns[col]
+
+        for name, statements in plan:
+            print(f"filter {name}")
+
+            shared = paired and not (
+                {col for col, _ in statements} & set(self.complemented)
+            )
+            # rows still present (for shared statements: pairs with one row still present)
+            rows = np.flatnonzero(
+                ~(removed[:half] & removed[half:]) if shared else ~removed
+            )
+            for col, predicate in statements:
+                if rows.size == 0:
+                    # nothing matching anymore
+                    break
+                values = column(col)
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    # evaluate on categories (and missing values, last), then map the codes
+                    categories = values.cat.categories
+                    match = np.asarray(
+                        predicate(
+                            pd.Series(categories).reindex(range(categories.size + 1))
+                        ),
+                        dtype=bool,
+                    )
+                    rows = rows[match[values.cat.codes.values[rows]]]
+                else:
+                    rows = rows[np.asarray(predicate(values.iloc[rows]), dtype=bool)]
+
+            removed[rows] = True
+            if shared:
+                removed[rows + half] = True
+
+        self.df_tally = df[~removed]
 
         # HACK completely disable filters
         return self
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 from scipy.optimize import nnls, least_squares
+from scipy.linalg import solve_triangular
 
 
 class NnlsReg:
@@ -8,18 +9,54 @@ class NnlsReg:
     wrapper around nnls to feed to kernel_deconv
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, gram=False):
+        """
+        gram (bool): solve in variant space from the sufficient statistics X'KX and X'Ky
+         instead of on the full weighted design matrix
+        """
+        self.gram = gram
 
-    def fit(self, X, y, k):
+    def fit(self, X, y, k, b0=None):
         """
         fit nnls to f(X) ~= y, weighted by values of k
 
         X (np.array): array of variant definition (design matrix)
         y (np.array): array of observed mutation frequencies
         k (np.array): kernel weighting values
+        b0 (np.array): ignored, nnls doesn't use starting values
         """
+        if self.gram:
+            kk = k**2
+            return self.fit_gram(
+                X.T.dot(np.expand_dims(kk, 1) * X), X.T.dot(kk * y), kk.dot(y**2)
+            )
         self.fitted, self.loss = nnls(np.expand_dims(k, 1) * X, k * y)
+        # converged (see SolveDiagnostics): nnls raises otherwise
+        self.status = 1
+        return self
+
+    def fit_gram(self, xtx, xty, yty):
+        """
+        fit nnls from the sufficient statistics of the weighted least squares
+
+        xtx (np.array): p x p matrix X'KX (K: diagonal of squared kernel weights)
+        xty (np.array): p vector X'Ky
+        yty (np.array): scalar y'Ky
+        """
+        # factor X'KX = R'R, then min |kX b - ky| = min |R b - c| with R'c = X'Ky
+        try:
+            R = np.linalg.cholesky(xtx).T
+            c = solve_triangular(R, xty, trans="T")
+        except np.linalg.LinAlgError:
+            # singular (e.g.: variant without mutation in support): use the eigen decomposition
+            s, V = np.linalg.eigh(xtx)
+            s = np.where(s > s.max(initial=0.0) * xtx.shape[0] * 1e-12, s, 0.0)
+            R = np.expand_dims(np.sqrt(s), 1) * V.T
+            c = np.divide(V.T.dot(xty), np.sqrt(s), out=np.zeros_like(s), where=s > 0)
+        self.fitted, rnorm = nnls(R, c)
+        self.status = 1
+        # residual of the full problem: |R b - c|^2 + y'Ky - c'c
+        self.loss = np.sqrt(max(rnorm**2 + yty - c.dot(c), 0.0))
         return self
 
 
@@ -44,6 +81,9 @@ class RobustReg:
         # make starting values
         if b0 is None:
             b0 = np.ones(X.shape[1]) / X.shape[1]
+        else:
+            # warm start (e.g.: from a neighbouring date) must be within bounds
+            b0 = np.clip(np.nan_to_num(b0, nan=1 / X.shape[1]), 0, 1)
         # regress
         ls = least_squares(
             lambda beta: (np.expand_dims(k, 1) * X).dot(beta) - (k * y),
@@ -53,4 +93,6 @@ class RobustReg:
             f_scale=self.f_scale,
         )
         self.fitted, self.loss = ls.x, ls.cost
+        # convergence (see SolveDiagnostics): function evaluations, not iterations of trf
+        self.nfev, self.status = ls.nfev, ls.status
         return self
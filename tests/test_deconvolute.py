@@ -0,0 +1,111 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import subprocess
+import sys
+import lollipop as ll
+from pandas.testing import assert_frame_equal
+from lollipop.cli.deconvolute import deconv_settings, deconvolute_location
+from test_kerneldeconv import synthetic_tally
+from test_preprocess import raw_tally
+
+
+def test_bootstrap_zero_weight(monkeypatch):
+    df, cols = synthetic_tally(n_mut=10)
+    variants = cols[:-1]
+    # a date far from the others, observing a single mutation pair
+    # (informative: in some variants but not all)
+    signatures = df.drop_duplicates("mutations").set_index("mutations")[variants]
+    mutation = signatures.index[
+        signatures.sum(axis=1).between(1, len(variants) - 1)
+        & ~signatures.index.str.startswith("-")
+    ][0]
+    lone = df[df["mutations"].isin([mutation, f"-{mutation}"])].iloc[[0, -1]].copy()
+    lone["date"] = df["date"].max() + pd.Timedelta(days=100)
+    loc_df = pd.concat([df, lone])
+
+    # ...that the first replicate never draws
+    resample_weights = ll.resample_weights
+
+    def without_lone(mutations, n, rng=None):
+        counts = resample_weights(mutations, n, rng=rng)
+        counts[0, pd.Index(mutations).get_indexer([mutation, f"-{mutation}"])] = 0
+        return counts
+
+    monkeypatch.setattr(ll, "resample_weights", without_lone)
+
+    def run(aggregate):
+        return pd.concat(
+            deconvolute_location(
+                "Plant A",
+                loc_df,
+                date_intervals=[("2021-01-01", None)],
+                var_dates={"var_dates": {"2021-01-01": variants}},
+                no_date=False,
+                rng=np.random.default_rng(42),
+                progress=False,
+                **deconv_settings(
+                    {
+                        "kernel": "box",
+                        "kernel_params": {"bandwidth": 10},
+                        "bootstrap": 5,
+                        "bootstrap_aggregate": aggregate,
+                    }
+                ),
+            )
+        )
+
+    replicates = run("concat")
+    assert replicates.loc[lone["date"].iloc[0]].isna().any().any()
+
+    # as aggregating the concatenated replicates: missing fits count as 0
+    res = run("exact")
+    expected = replicates[cols].fillna(0).groupby(level=0).mean()
+    mean = res.loc[res["estimate"] == "mean", cols]
+    assert_frame_equal(mean, expected, check_names=False)
+    assert not res[cols].isna().any().any()
+
+
+def run_solves(tmp_path, hashseed, *args):
+    """run deconvolute in a new interpreter with this hash seed, returns its number of solves"""
+    if not (tmp_path / "tally.tsv").exists():
+        raw_tally(n_dates=20).to_csv(tmp_path / "tally.tsv", sep="\t", index=False)
+        # no variants_list: from the lineage map
+        (tmp_path / "variants.yaml").write_text(
+            "variants_pangolin:\n  al: B.1.1.7\n  be: B.1.351\n  ga: P.1\n"
+            "to_drop: [subset]\n"
+        )
+        (tmp_path / "box.yaml").write_text(
+            "kernel: box\nkernel_params:\n  bandwidth: 10\n"
+        )
+    subprocess.check_call(
+        [sys.executable, "-m", "lollipop.cli.lollipop", "deconvolute"]
+        + ["--var", str(tmp_path / "variants.yaml")]
+        + ["--dec", str(tmp_path / "box.yaml")]
+        + ["--profile", str(tmp_path / "profile.json")]
+        + ["--output", str(tmp_path / "out.tsv")]
+        + list(args)
+        + [str(tmp_path / "tally.tsv")],
+        env=dict(os.environ, PYTHONHASHSEED=str(hashseed)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    with open(tmp_path / "profile.json") as file:
+        stages = json.load(file)["stages"]
+    return sum(stage["solves"] for stage in stages if stage["stage"] == "interval")
+
+
+def test_incremental_between_processes(tmp_path):
+    # the state of a run is reused by the next, whatever the order of python's sets
+    incremental = ["--incremental", str(tmp_path / "state")]
+    assert run_solves(tmp_path, 1, *incremental) > 0
+    assert run_solves(tmp_path, 2, *incremental) == 0
+
+
+def test_cache_between_processes(tmp_path):
+    # the results of a run are reused by the next, whatever the order of python's sets
+    cache = ["--cache", str(tmp_path / "cache")]
+    assert run_solves(tmp_path, 1, *cache) > 0
+    assert run_solves(tmp_path, 2, *cache) == 0
+    assert run_solves(tmp_path, 3, *cache) == 0
@@ -0,0 +1,101 @@
+import pandas as pd
+import numpy as np
+from click.testing import CliRunner
+from lollipop.cli.generate_mutlist import (
+    generate_mutlist,
+    gene_intervals,
+    annotate_genes,
+)
+
+
+def write_vocs(tmp_path):
+    (tmp_path / "a.yaml").write_text(
+        "variant:\n  short: 'al'\n  pangolin: 'B.1.1.7'\n"
+        "mut:\n  100: 'C>T'\n  200: 'AT>GC'\n  300: '---'\n  400: '+AT'\n"
+        "shared:\n  50: 'G'\n  100: 'C>T'\n"
+    )
+    (tmp_path / "b.yaml").write_text(
+        "variant:\n  short: 'de'\n  pangolin: 'B.1.617.2'\n"
+        "mut:\n  201: 'T>C'\n  301: '-'\n"
+        "shared:\n  50: 'G'\n"
+    )
+
+
+def test_generate_mutlist(tmp_path):
+    write_vocs(tmp_path)
+
+    result = CliRunner().invoke(
+        generate_mutlist,
+        ["-o", str(tmp_path / "mutlist.tsv")]
+        + [str(tmp_path / "a.yaml"), str(tmp_path / "b.yaml")],
+    )
+    assert result.exit_code == 0, result.output
+
+    expected = pd.DataFrame(
+        [
+            (50, "N", "G", "shared", "shared"),
+            (100, "C", "T", "mut", np.nan),
+            (200, "A", "G", "mut", np.nan),
+            (201, "T", "C", "mut", "mut"),
+            (300, "N", "-", "mut", np.nan),
+            (301, "N", "-", "mut", "mut"),
+            (302, "N", "-", "mut", np.nan),
+        ],
+        columns=["position", "reference", "variant", "al", "de"],
+    )
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "mutlist.tsv", sep="\t"), expected
+    )
+
+
+def test_cache(tmp_path):
+    write_vocs(tmp_path)
+    runner = CliRunner()
+
+    def run(output):
+        result = runner.invoke(
+            generate_mutlist,
+            ["-o", str(tmp_path / output), "-p", str(tmp_path / "pango.yaml")]
+            + ["-c", str(tmp_path / "cache")]
+            + [str(tmp_path / "a.yaml"), str(tmp_path / "b.yaml")],
+        )
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    run("mutlist.tsv")
+    assert "up to date" in run("mutlist.tsv")
+
+    # only the modified voc is parsed again
+    with open(tmp_path / "b.yaml", "a") as f:
+        f.write("  302: 'A>G'\n")
+    assert "up to date" not in run("mutlist.tsv")
+    assert len(list((tmp_path / "cache").glob("voc-*.json"))) == 3
+
+    result = runner.invoke(
+        generate_mutlist,
+        ["-o", str(tmp_path / "uncached.tsv")]
+        + [str(tmp_path / "a.yaml"), str(tmp_path / "b.yaml")],
+    )
+    assert (tmp_path / "mutlist.tsv").read_bytes() == (
+        tmp_path / "uncached.tsv"
+    ).read_bytes()
+
+
+def test_gene_intervals():
+    # overlapping features: the last one wins
+    features = [(10, 100, "ORF1"), (50, 60, "inner"), (90, 120, "ORF2")]
+    positions = np.array([5, 10, 49, 50, 60, 61, 89, 90, 100, 120, 121])
+
+    names = annotate_genes(positions, *gene_intervals(features))
+
+    expected = np.full(len(positions), "", dtype=object)
+    for start, end, name in features:
+        expected[(start <= positions) & (positions <= end)] = name
+    np.testing.assert_array_equal(names, expected)
+    assert list(names) == ["", "ORF1", "ORF1", "inner", "inner", "ORF1"] + [
+        "ORF1",
+        "ORF2",
+        "ORF2",
+        "ORF2",
+        "",
+    ]
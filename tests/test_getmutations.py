@@ -0,0 +1,224 @@
+import pandas as pd
+import numpy as np
+import os
+from click.testing import CliRunner
+from lollipop.cli.getmutations_from_basecount import (
+    from_basecount,
+    from_samples,
+    read_store_index,
+    store_entry_name,
+    scan_basecnt,
+    store_basecount,
+    write_basecnt_store,
+)
+
+
+def write_basecnt(path, sample, seed=42, length=300):
+    """basecount table as written by V-pipe (1-based positions)"""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 50, size=(length, 5))
+    counts[10] = 0  # no coverage
+    pd.DataFrame(
+        counts,
+        index=pd.MultiIndex.from_arrays(
+            [["NC_045512.2"] * length, np.arange(1, length + 1)], names=["ref", "pos"]
+        ),
+        columns=pd.MultiIndex.from_product(
+            [[sample], ["A", "C", "G", "T", "-"]], names=["sample", "base"]
+        ),
+    ).to_csv(path, sep="\t")
+    return counts
+
+
+def mutlist():
+    return pd.DataFrame(
+        {
+            "position": [11, 42, 42, 250],
+            "reference": ["G", "C", "C", "A"],
+            "variant": ["T", "T", "-", "G"],
+            "gene": [np.nan, "ORF1ab", "ORF1ab", "ORF1ab"],
+            "al": ["mut", np.nan, np.nan, "shared"],
+            "de": [np.nan, "mut", "mut", "shared"],
+        }
+    )
+
+
+def test_scan_basecnt(tmp_path):
+    counts = write_basecnt(tmp_path / "basecnt.tsv", "s1")
+    mut = mutlist()
+
+    table = scan_basecnt(str(tmp_path / "basecnt.tsv"), 1, mut)
+
+    assert list(table.columns) == ["gene", "pos", "base", "cov", "var", "frac"] + [
+        "al",
+        "de",
+    ]
+    rows = mut["position"] - 1
+    cols = mut["variant"].map({"A": 0, "C": 1, "G": 2, "T": 3, "-": 4})
+    np.testing.assert_array_equal(table["cov"], counts[rows].sum(axis=1))
+    np.testing.assert_array_equal(table["var"], counts[rows, cols])
+    assert np.isnan(table["frac"][0])
+    np.testing.assert_allclose(
+        table["frac"][1:], (counts[rows, cols] / counts[rows].sum(axis=1))[1:]
+    )
+
+    # table with 0-based positions: looked up one label lower
+    table0 = scan_basecnt(str(tmp_path / "basecnt.tsv"), 0, mut)
+    np.testing.assert_array_equal(table0["cov"], counts[rows - 1].sum(axis=1))
+
+    # binary store: same lookups
+    entry = write_basecnt_store(str(tmp_path / "basecnt.tsv"), str(tmp_path), "s1")
+    pd.testing.assert_frame_equal(scan_basecnt(entry, 1, mut), table)
+
+
+def test_from_samples(tmp_path):
+    mutlist().to_csv(tmp_path / "mutlist.tsv", sep="\t", index=False)
+    samples = [
+        ("s1", "b1", "Plant A", "2021-01-05"),
+        ("s2", "b1", "Plant B", "2021-01-06"),
+    ]
+    for i, (sample, batch, location, date) in enumerate(samples):
+        (tmp_path / sample / batch).mkdir(parents=True)
+        write_basecnt(tmp_path / sample / batch / "basecnt.tsv", sample, seed=i)
+    pd.DataFrame(samples).to_csv(
+        tmp_path / "samples.tsv", sep="\t", header=False, index=False
+    )
+
+    runner = CliRunner()
+    # one by one
+    expected = []
+    for sample, batch, location, date in samples:
+        out = tmp_path / f"{sample}.tsv"
+        result = runner.invoke(
+            from_basecount,
+            ["-m", str(tmp_path / "mutlist.tsv"), "-o", str(out)]
+            + ["-s", sample, "-b", batch, "-l", location, "-d", date]
+            + [str(tmp_path / sample / batch / "basecnt.tsv")],
+        )
+        assert result.exit_code == 0, result.output
+        expected.append(pd.read_csv(out, sep="\t"))
+
+    # all at once
+    result = runner.invoke(
+        from_samples,
+        ["-m", str(tmp_path / "mutlist.tsv"), "-o", str(tmp_path / "tally.tsv")]
+        + ["-B", str(tmp_path / "{sample}/{batch}/basecnt.tsv"), "-j", "2"]
+        + [str(tmp_path / "samples.tsv")],
+    )
+    assert result.exit_code == 0, result.output
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "tally.tsv", sep="\t"),
+        pd.concat(expected, ignore_index=True),
+    )
+
+    # from the binary store
+    result = runner.invoke(
+        store_basecount,
+        [
+            "-S",
+            str(tmp_path / "store"),
+            "-B",
+            str(tmp_path / "{sample}/{batch}/basecnt.tsv"),
+        ]
+        + [str(tmp_path / "samples.tsv")],
+    )
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(
+        from_samples,
+        ["-m", str(tmp_path / "mutlist.tsv"), "-o", str(tmp_path / "stored.tsv")]
+        + ["-S", str(tmp_path / "store"), "-B", "missing/{sample}.tsv"]
+        + [str(tmp_path / "samples.tsv")],
+    )
+    assert result.exit_code == 0, result.output
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "stored.tsv", sep="\t"),
+        pd.concat(expected, ignore_index=True),
+    )
+
+
+def test_store_names(tmp_path):
+    # sanitized "{sample}-{batch}" would collide: a-b-c
+    samples = [
+        ("a-b", "c", "Plant A", "2021-01-05"),
+        ("a", "b-c", "Plant A", "2021-01-06"),
+    ]
+    expected = {}
+    for i, (sample, batch, location, date) in enumerate(samples):
+        (tmp_path / sample / batch).mkdir(parents=True)
+        expected[sample, batch] = write_basecnt(
+            tmp_path / sample / batch / "basecnt.tsv", sample, seed=i
+        )
+    pd.DataFrame(samples).to_csv(
+        tmp_path / "samples.tsv", sep="\t", header=False, index=False
+    )
+
+    result = CliRunner().invoke(
+        store_basecount,
+        [
+            "-S",
+            str(tmp_path / "store"),
+            "-B",
+            str(tmp_path / "{sample}/{batch}/basecnt.tsv"),
+        ]
+        + [str(tmp_path / "samples.tsv")],
+    )
+    assert result.exit_code == 0, result.output
+    stored = read_store_index(str(tmp_path / "store"))
+    assert len(set(stored.values())) == 2
+    for key, counts in expected.items():
+        np.testing.assert_array_equal(np.load(stored[key]), counts)
+
+    # never overwritten
+    entry = write_basecnt_store(
+        str(tmp_path / "a/b-c/basecnt.tsv"),
+        str(tmp_path / "store"),
+        os.path.splitext(os.path.basename(stored["a-b", "c"]))[0],
+    )
+    assert entry == stored["a-b", "c"]
+    np.testing.assert_array_equal(np.load(entry), expected["a-b", "c"])
+
+
+def test_store_interrupted(tmp_path):
+    samples = [(f"s{i}", "b1", "Plant A", f"2021-01-0{i + 1}") for i in range(3)]
+    expected = {}
+    for i, (sample, batch, location, date) in enumerate(samples):
+        (tmp_path / sample / batch).mkdir(parents=True)
+        expected[sample, batch] = write_basecnt(
+            tmp_path / sample / batch / "basecnt.tsv", sample, seed=i
+        )
+    pd.DataFrame(samples).to_csv(
+        tmp_path / "samples.tsv", sep="\t", header=False, index=False
+    )
+    (tmp_path / "store").mkdir()
+    args = ["-S", str(tmp_path / "store")]
+    args += ["-B", str(tmp_path / "{sample}/{batch}/basecnt.tsv")]
+    args += [str(tmp_path / "samples.tsv")]
+
+    # interrupted before writing the index
+    write_basecnt_store(
+        str(tmp_path / "s0/b1/basecnt.tsv"),
+        str(tmp_path / "store"),
+        store_entry_name("s0", "b1"),
+    )
+    # a corrupt table
+    (tmp_path / "s2/b1/basecnt.tsv").write_text("garbage\n")
+
+    # the others are stored and indexed, the failed one reported
+    result = CliRunner().invoke(store_basecount, args)
+    assert result.exit_code == 1
+    assert set(read_store_index(str(tmp_path / "store"))) == {
+        ("s0", "b1"),
+        ("s1", "b1"),
+    }
+
+    # and retried by the next run
+    expected["s2", "b1"] = write_basecnt(tmp_path / "s2/b1/basecnt.tsv", "s2", seed=2)
+    result = CliRunner().invoke(store_basecount, args)
+    assert result.exit_code == 0, result.output
+    stored = read_store_index(str(tmp_path / "store"))
+    assert set(stored) == set(expected)
+    for key, counts in expected.items():
+        np.testing.assert_array_equal(np.load(stored[key]), counts)
+    assert not [
+        name for name in os.listdir(tmp_path / "store") if name.endswith(".tmp")
+    ]
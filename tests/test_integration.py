@@ -1,4 +1,5 @@
 import subprocess
+import sys
 
 
 def test_workflow():
@@ -23,3 +24,16 @@ def test_workflow():
             "preprint/data/tallymut_line_full.tsv.zst",
         ]
     )
+
+
+def test_lazy_imports():
+    # the version, or a subcommand not deconvolving, shouldn't load scipy
+    code = (
+        "import sys; import lollipop; from lollipop.cli import cli; "
+        "from lollipop.cli.getmutations_from_basecount import from_basecount; "
+        "assert lollipop.__version__; "
+        "assert not [m for m in sys.modules if m.split('.')[0] in "
+        "('scipy', 'ruamel', 'strictyaml', 'tqdm', 'BCBio')], sys.modules; "
+        "assert lollipop.KernelDeconv and 'scipy' in sys.modules"
+    )
+    subprocess.check_call([sys.executable, "-c", code])
@@ -0,0 +1,337 @@
+import pandas as pd
+import numpy as np
+import lollipop as ll
+import pytest
+from pandas.testing import assert_frame_equal
+
+
+def synthetic_tally(n_dates=40, n_mut=60, n_var=3, seed=42):
+    """small tally-like design with mutation/complement pairs over irregular dates"""
+    rng = np.random.default_rng(seed)
+    variants = [f"var{v}" for v in range(n_var)]
+    sig = (rng.random((n_mut, n_var)) < 0.4).astype(float)
+    dates = pd.to_datetime("2021-01-01") + pd.to_timedelta(
+        np.sort(rng.choice(3 * n_dates, size=n_dates, replace=False)), unit="D"
+    )
+    rows = []
+    for i, d in enumerate(dates):
+        props = rng.dirichlet(np.ones(n_var))
+        frac = np.clip(sig @ props + rng.normal(0, 0.05, n_mut), 0, 1)
+        df = pd.DataFrame(sig, columns=variants)
+        df["undetermined"] = 0.0
+        df["frac"] = frac
+        df["date"] = d
+        df["mutations"] = [f"{m}X" for m in range(n_mut)]
+        rows.append(df)
+    df = pd.concat(rows, ignore_index=True)
+    # complement, as DataPreprocesser.make_complement
+    comp = df.copy()
+    comp["mutations"] = "-" + comp["mutations"]
+    comp["frac"] = 1 - comp["frac"]
+    comp[variants] = 1 - comp[variants]
+    comp["undetermined"] = 1.0
+    return pd.concat([df, comp]), variants + ["undetermined"]
+
+
+@pytest.mark.parametrize("kernel", [ll.GaussianKernel(30), ll.BoxKernel(10)])
+@pytest.mark.parametrize("reg", [ll.NnlsReg(), ll.RobustReg(f_scale=0.01)])
+@pytest.mark.parametrize(
+    "confint",
+    [ll.NullConfint(), ll.WaldConfint(scale="logit", quasi=True, method="strat")],
+)
+def test_batched(kernel, reg, confint):
+    df, cols = synthetic_tally()
+
+    def run(**kwargs):
+        return ll.KernelDeconv(
+            df[cols], df["frac"], df["date"], kernel=kernel, reg=reg, confint=confint
+        ).deconv_all(min_tol=1e-3, **kwargs)
+
+    ref = run(batched=False)
+    res = run(batched=True)
+
+    assert_frame_equal(res.fitted, ref.fitted)
+    assert_frame_equal(res.conf_bands["lower"], ref.conf_bands["lower"])
+    assert_frame_equal(res.conf_bands["upper"], ref.conf_bands["upper"])
+
+
+@pytest.mark.parametrize("kernel", [ll.GaussianKernel(30), ll.BoxKernel(10)])
+def test_windows_weights(kernel):
+    df, cols = synthetic_tally()
+    # bootstrap-like weights: above 1 they reach beyond the unweighted support
+    weights = pd.Series(
+        np.random.default_rng(0).integers(0, 4, size=len(df)), index=df.index
+    )
+
+    def run(**kwargs):
+        return ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            weights=weights,
+            kernel=kernel,
+            confint=ll.NullConfint(),
+        ).deconv_all(min_tol=0.1, **kwargs)
+
+    assert_frame_equal(run(batched=True).fitted, run(batched=False).fitted)
+
+    # nothing is lost outside of the support
+    r = kernel.support(0.1 / 3)
+    assert kernel.values(0, r + 1e-9) * 3 < 0.1
+
+
+@pytest.mark.parametrize("kernel", [ll.GaussianKernel(30), ll.BoxKernel(10)])
+@pytest.mark.parametrize("confint", [ll.NullConfint(), ll.WaldConfint()])
+def test_gram(kernel, confint):
+    df, cols = synthetic_tally()
+    # variant without any mutation: singular X'KX
+    df.insert(0, "absent", 0.0)
+    cols = ["absent"] + cols
+
+    def run(gram):
+        return ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            kernel=kernel,
+            reg=ll.NnlsReg(gram=gram),
+            confint=confint,
+        ).deconv_all(min_tol=1e-3)
+
+    ref = run(False)
+    res = run(True)
+
+    assert_frame_equal(res.fitted, ref.fitted, atol=1e-8)
+    np.testing.assert_allclose(res.loss, ref.loss, rtol=1e-8)
+
+
+@pytest.mark.parametrize("kernel", [ll.GaussianKernel(30), ll.BoxKernel(10)])
+def test_incremental(kernel):
+    df, cols = synthetic_tally()
+    confint = ll.WaldConfint()
+    # previous run, before the last few samples arrived
+    last = df["date"].sort_values().unique()[-5]
+    old = df[df["date"] < last]
+    prev = ll.KernelDeconv(
+        old[cols], old["frac"], old["date"], kernel=kernel, confint=confint
+    ).deconv_all(min_tol=1e-3)
+
+    full = ll.KernelDeconv(
+        df[cols], df["frac"], df["date"], kernel=kernel, confint=confint
+    )
+    dates = full.affected_dates(df.loc[df["date"] >= last, "date"], min_tol=1e-3)
+    assert 5 <= len(dates) < len(df["date"].unique())
+    res = full.deconv_all(min_tol=1e-3, dates=dates).merge_previous(
+        prev.fitted, prev.conf_bands
+    )
+    ref = ll.KernelDeconv(
+        df[cols], df["frac"], df["date"], kernel=kernel, confint=confint
+    ).deconv_all(min_tol=1e-3)
+
+    assert_frame_equal(res.fitted, ref.fitted)
+    assert_frame_equal(res.conf_bands["upper"], ref.conf_bands["upper"])
+
+
+def test_warm_start():
+    df, cols = synthetic_tally()
+
+    def run(**kwargs):
+        return ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            kernel=ll.GaussianKernel(10),
+            reg=ll.RobustReg(f_scale=0.01),
+            confint=ll.NullConfint(),
+        ).deconv_all(min_tol=1e-3, **kwargs)
+
+    ref = run()
+    # from the previous date
+    assert_frame_equal(run(warm_start=True).fitted, ref.fitted, rtol=0, atol=1e-6)
+    # from given starting values (e.g.: central fit, when bootstrapping)
+    assert_frame_equal(run(start=ref.fitted).fitted, ref.fitted, rtol=0, atol=1e-6)
+
+
+def test_resample_weights():
+    df, cols = synthetic_tally()
+    mutations = df["mutations"].unique()
+    counts = ll.resample_weights(mutations, 5, rng=np.random.default_rng(42))
+
+    # same draws as successive resample_mutations
+    rng = np.random.default_rng(42)
+    for replicate in counts:
+        resampled = ll.resample_mutations(df, mutations, rng=rng)[0]
+        np.testing.assert_array_equal(
+            resampled["resample_value"].values,
+            replicate[pd.Index(mutations).get_indexer(df["mutations"])],
+        )
+
+
+def test_resample_weights_unpaired():
+    df, cols = synthetic_tally()
+    # a filter dropping a mutation but not its complement
+    df = df[df["mutations"] != "5X"]
+    mutations = pd.Index(df["mutations"].unique())
+    assert len(mutations) % 2 == 1
+    counts = ll.resample_weights(mutations, 20, rng=np.random.default_rng(42))
+
+    assert counts.shape == (20, len(mutations))
+    # paired by name, the unpaired complement never drawn
+    np.testing.assert_array_equal(
+        counts[:, mutations.get_indexer(["-10X"])],
+        counts[:, mutations.get_indexer(["10X"])],
+    )
+    np.testing.assert_array_equal(counts[:, mutations.get_indexer(["-5X"])], 0)
+    assert (counts.sum(axis=1) == 2 * (len(mutations) // 2)).all()
+
+    # bootstrap runs, ignoring the unpaired rows
+    codes = mutations.get_indexer(df["mutations"])
+    res = list(
+        ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            kernel=ll.GaussianKernel(30),
+            confint=ll.NullConfint(),
+        ).deconv_bootstrap(codes, counts, min_tol=1e-3)
+    )
+    assert len(res) == 20
+    assert not any(fitted.isna().any().any() for fitted in res)
+
+
+@pytest.mark.parametrize(
+    "kernel,min_tol",
+    [
+        (ll.GaussianKernel(30), 1e-3),
+        (ll.GaussianKernel(30), 0.3),
+        (ll.BoxKernel(10), 1e-3),
+    ],
+)
+def test_bootstrap(kernel, min_tol):
+    df, cols = synthetic_tally()
+    mutations = pd.Index(df["mutations"].unique())
+    counts = ll.resample_weights(mutations, 10, rng=np.random.default_rng(42))
+    codes = mutations.get_indexer(df["mutations"])
+
+    res = list(
+        ll.KernelDeconv(
+            df[cols], df["frac"], df["date"], kernel=kernel, confint=ll.NullConfint()
+        ).deconv_bootstrap(codes, counts, min_tol=min_tol, batch_size=3)
+    )
+
+    assert len(res) == 10
+    for replicate, fitted in zip(counts, res):
+        ref = ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            weights=replicate[codes],
+            kernel=kernel,
+            confint=ll.NullConfint(),
+        ).deconv_all(min_tol=min_tol)
+        assert_frame_equal(fitted, ref.fitted, atol=1e-10)
+
+
+@pytest.mark.parametrize("aggregator", [ll.ExactQuantiles, ll.P2Quantiles])
+def test_aggregators(aggregator):
+    values = np.random.default_rng(0).normal(size=(500, 4, 3))
+    agg = aggregator(len(values), values.shape[1:])
+    for replicate in values:
+        agg.update(replicate)
+
+    np.testing.assert_allclose(agg.mean(), values.mean(axis=0))
+    ref = np.quantile(values, q=(0.025, 0.975), axis=0)
+    tol = 0 if aggregator is ll.ExactQuantiles else 0.3
+    np.testing.assert_allclose(agg.quantiles(), ref, atol=tol)
+
+
+@pytest.mark.parametrize("scale", ["linear", "logit"])
+def test_wald_information(scale):
+    df, cols = synthetic_tally(n_dates=1)
+    X = df[cols].values * 0.5
+    coefs = np.array([0.2, 0.3, 0.4, 0.1])
+    confint = ll.WaldConfint(scale=scale)
+
+    # dense reference: X' diag(1/(p(1-p))) X
+    fitted_mut = (X.dot(coefs) + confint.pseudofrac) / (1 + 2 * confint.pseudofrac)
+    info = X.T.dot(np.diag(1 / (fitted_mut * (1 - fitted_mut)))).dot(X)
+    np.testing.assert_allclose(confint.fisher_information(X, coefs), info)
+
+    # batched inversion, including a singular information matrix
+    infos = np.array([info, info * 2, np.zeros_like(info)])
+    se = confint.standard_errors(infos, np.array([coefs] * 3))
+    inv_info = np.linalg.inv(info)
+    if scale == "linear":
+        ref = np.sqrt(np.diag(inv_info))
+    else:
+        pc = (coefs + confint.pseudofrac) / (1 + 2 * confint.pseudofrac)
+        jacobian = -np.tile(np.expand_dims(1 / (pc * (1 - pc)), 1), pc.size)
+        jacobian = jacobian + 2 * np.diag(-np.diag(jacobian))
+        ref = np.sqrt(np.diag(jacobian.dot(inv_info).dot(jacobian.T)))
+    np.testing.assert_allclose(se[0], ref)
+    np.testing.assert_allclose(se[1], ref / np.sqrt(2))
+    assert np.isnan(se[2]).all()
+
+
+@pytest.mark.parametrize("kernel", [ll.GaussianKernel(30), ll.BoxKernel(10)])
+def test_diagnostics(kernel):
+    df, cols = synthetic_tally()
+
+    def diagnose(reg, batched, confint=ll.NullConfint()):
+        diagnostics = ll.SolveDiagnostics()
+        kdec = ll.KernelDeconv(
+            df[cols],
+            df["frac"],
+            df["date"],
+            kernel=kernel,
+            reg=reg,
+            confint=confint,
+            diagnostics=diagnostics,
+        ).deconv_all(min_tol=1e-3, batched=batched)
+        return diagnostics.to_frame(location="Plant A"), kdec
+
+    ref, _ = diagnose(ll.NnlsReg(), False)
+    assert list(ref.columns) == ["location"] + ll.SolveDiagnostics.columns
+    assert (ref["date"].values == df["date"].unique()).all()
+    assert (ref["location"] == "Plant A").all()
+    assert ref["evaluations"].isna().all()
+    assert (ref["status"] == 1).all()
+    assert (ref["rows"] > 0).all()
+    assert (ref["kernel_mass"] <= ref["rows"]).all()
+    assert (ref["effective_rows"] <= ref["rows"] + 1e-3).all()
+    assert (ref["gram_condition"] >= 1).all()
+    assert ref["condition"].isna().all()
+
+    # same support and information, solved from windows or sufficient statistics
+    for res, _ in [
+        diagnose(ll.NnlsReg(), True),
+        diagnose(ll.NnlsReg(gram=True), True),
+    ]:
+        assert_frame_equal(
+            res.drop(columns="solve_time"),
+            ref.drop(columns="solve_time"),
+            check_exact=False,
+            rtol=1e-5,
+        )
+
+    # with Wald confints: condition of their Fisher information
+    wald = ll.WaldConfint()
+    res, kdec = diagnose(ll.NnlsReg(), True, wald)
+    date = df["date"].unique()[5]
+    idx = (df["date"] - date).dt.days.abs() <= kernel.support(1e-3)
+    kvals = kernel.values(0, (df["date"][idx] - date).dt.days.values)
+    info = wald.fisher_information(
+        df[cols][idx].values * np.expand_dims(kvals, 1), kdec.fitted.loc[date].values
+    )
+    np.testing.assert_allclose(res["condition"][5], np.linalg.cond(info), rtol=1e-6)
+    unbatched, _ = diagnose(ll.NnlsReg(), False, wald)
+    assert_frame_equal(
+        res.drop(columns="solve_time"),
+        unbatched.drop(columns="solve_time"),
+        check_exact=False,
+        rtol=1e-5,
+    )
+
+    robust, _ = diagnose(ll.RobustReg(f_scale=0.01), True)
+    assert (robust["evaluations"] > 0).all()
+    assert (robust["status"] > 0).all()
@@ -0,0 +1,116 @@
+import pandas as pd
+import numpy as np
+import lollipop as ll
+from pandas.testing import assert_frame_equal
+
+
+def raw_tally(n_dates=10, n_pos=30, seed=42):
+    """tallymut-like table, with variant signatures as text labels"""
+    rng = np.random.default_rng(seed)
+    labels = np.array([np.nan, np.nan, "mut", "shared", "subset"], dtype=object)
+    pos = np.sort(rng.choice(29000, size=n_pos, replace=False))
+    sig = {
+        v: labels[rng.integers(0, labels.size, size=n_pos)] for v in ["al", "be", "ga"]
+    }
+    rows = []
+    for d in pd.date_range("2021-01-01", periods=n_dates, freq="3D"):
+        for loc in ["Plant A", "Plant B"]:
+            cov = rng.integers(10, 1000, size=n_pos)
+            df = pd.DataFrame(
+                {
+                    "sample": f"{loc}_{d.date()}",
+                    "proto": "v3",
+                    "date": str(d.date()),
+                    "location": loc,
+                    "gene": pd.Series(["ORF1ab", None])[
+                        (pos >= 21000).astype(int)
+                    ].values,
+                    "pos": pos,
+                    "base": rng.choice(list("ACGT-"), size=n_pos),
+                    "cov": cov,
+                    "var": rng.integers(0, 10, size=n_pos),
+                    "frac": rng.random(n_pos),
+                    **sig,
+                }
+            )
+            rows.append(df)
+    return pd.concat(rows, ignore_index=True)
+
+
+def test_compact():
+    def preprocess(compact):
+        return (
+            ll.DataPreprocesser(raw_tally())
+            .general_preprocess(
+                variants_list=["B.1.1.7", "B.1.351", "P.1"],
+                variants_pangolin={"al": "B.1.1.7", "be": "B.1.351", "ga": "P.1"},
+                variants_not_reported=[],
+                to_drop=["subset"],
+                compact=compact,
+            )
+            .filter_mutations({"low": ["cov < 50", "proto == v3"]})
+            .df_tally
+        )
+
+    ref = preprocess(False)
+    res = preprocess(True)
+
+    assert (res[["B.1.1.7", "B.1.351", "P.1", "undetermined"]].dtypes == np.int8).all()
+    assert isinstance(res["mutations"].dtype, pd.CategoricalDtype)
+    assert isinstance(res["location"].dtype, pd.CategoricalDtype)
+    assert res["frac"].dtype == np.float32
+    assert res.memory_usage(deep=True).sum() < ref.memory_usage(deep=True).sum() / 2
+
+    # same content, only the types change
+    columns = ["date", "mutations", "B.1.1.7", "B.1.351", "P.1", "undetermined"]
+    assert_frame_equal(
+        res[columns].astype(ref[columns].dtypes.to_dict()),
+        ref[columns],
+    )
+    np.testing.assert_allclose(res["frac"], ref["frac"], atol=1e-6)
+
+
+def test_filter_pairs():
+    def preprocess(compact):
+        return ll.DataPreprocesser(raw_tally()).general_preprocess(
+            variants_list=["B.1.1.7", "B.1.351", "P.1"],
+            variants_pangolin={"al": "B.1.1.7", "be": "B.1.351", "ga": "P.1"},
+            variants_not_reported=[],
+            to_drop=["subset"],
+            compact=compact,
+        )
+
+    ref = preprocess(False).df_tally
+    mutation = ref["mutations"].iloc[0]
+    filters = {
+        # only the mutation, not its complement
+        "single": [f"mutations in [ {mutation} ]"],
+        # shared by mutations and their complement
+        "amplicon": ["proto v3", "date > 2021-01-10", "pos >= 5000", "pos <= 20000"],
+        "text": ["location ~ /B$/", "gene !~ ORF", "frac < 0.5"],
+        "nothing": ["cov > 10000", "sample == 'Plant C'"],
+    }
+    # the filters are conjunctions of statements, and remove the matching rows
+    dates = pd.to_datetime(ref["date"])
+    expected = ref[
+        ~(ref["mutations"] == mutation)
+        & ~(
+            (ref["proto"] == "v3")
+            & (dates > np.datetime64("2021-01-10"))
+            & (ref["pos"] >= 5000)
+            & (ref["pos"] <= 20000)
+        )
+        & ~(
+            ref["location"].str.contains("B$")
+            & ~ref["gene"].astype(str).str.contains("ORF")
+            & (ref["frac"] < 0.5)
+        )
+    ]
+
+    for compact in [False, True]:
+        res = preprocess(compact).filter_mutations(filters).df_tally
+        assert_frame_equal(
+            res[["date", "pos", "undetermined"]].astype(int),
+            expected[["date", "pos", "undetermined"]].astype(int),
+        )
+        assert (res["mutations"].astype(str) == expected["mutations"]).all()
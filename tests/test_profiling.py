@@ -0,0 +1,65 @@
+import pandas as pd
+import numpy as np
+import json
+import lollipop as ll
+from lollipop.cli.profiling import Profiler
+
+
+def test_profiler_stages(tmp_path):
+    rng = np.random.default_rng(42)
+    dates = pd.Series(pd.date_range("2021-01-01", periods=5).repeat(10))
+    X = pd.DataFrame(rng.integers(0, 2, size=(50, 3)), columns=["a", "b", "c"])
+    y = pd.Series(rng.random(50))
+
+    profiler = Profiler(enabled=True)
+    profiler.section("prepare")
+    profiler.section("solve")
+    for interval in profiler.iterate(
+        ["2021-01-01", "2021-01-03"], "interval", lambda i, d: {"mindate": d}
+    ):
+        with profiler.stage("kernel", bandwidth=2):
+            ll.KernelDeconv(
+                X,
+                y,
+                dates,
+                kernel=ll.BoxKernel(bandwidth=2),
+                reg=profiler.wrap(ll.NnlsReg()),
+                confint=ll.NullConfint(),
+            ).deconv_all()
+    # records of a worker process, nested in the current stage
+    worker = Profiler(enabled=True)
+    with worker.stage("location", location="Plant A"):
+        worker.count_solve(7)
+    profiler.merge(worker.records)
+    profiler.write(tmp_path / "profile.json", argv=["test"])
+
+    report = json.loads((tmp_path / "profile.json").read_text())
+    assert report["argv"] == ["test"]
+    stages = {(r["path"], r["stage"]): r for r in report["stages"]}
+    assert [r["labels"] for r in report["stages"] if r["stage"] == "interval"] == [
+        {"mindate": "2021-01-01"},
+        {"mindate": "2021-01-03"},
+    ]
+    kernel = stages[("solve/interval", "kernel")]
+    assert kernel["labels"] == {"bandwidth": 2}
+    # one solve per date, on the observations within the box
+    assert kernel["solves"] == 5
+    assert kernel["min_rows"] == 20 and kernel["max_rows"] == 30
+    solve = stages[("", "solve")]
+    assert solve["solves"] == 2 * 5 + 1
+    assert solve["rows"] == 2 * kernel["rows"] + 7
+    assert solve["max_rows"] == 30 and solve["min_rows"] == 7
+    assert stages[("solve", "location")]["labels"] == {"location": "Plant A"}
+    assert stages[("", "prepare")]["solves"] == 0
+    for r in report["stages"]:
+        assert r["wall_time"] >= 0 and r["cpu_time"] >= 0
+        assert r["peak_traced"] >= 0
+
+
+def test_profiler_disabled():
+    profiler = Profiler()
+    reg = ll.NnlsReg()
+    assert profiler.wrap(reg) is reg
+    with profiler.stage("stage"):
+        assert list(profiler.iterate(range(3), "item")) == [0, 1, 2]
+    assert profiler.records == []
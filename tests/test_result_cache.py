@@ -0,0 +1,87 @@
+import pandas as pd
+import numpy as np
+import os
+import lollipop as ll
+from pandas.testing import assert_frame_equal
+from lollipop.cli.deconvolute import deconv_settings, deconvolute_location
+from lollipop.cli.profiling import Profiler
+from lollipop.cli.result_cache import ResultCache
+from test_preprocess import raw_tally
+
+
+def test_cache(tmp_path):
+    cache = ResultCache(tmp_path / "cache", max_size=0)
+    df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})
+    key = cache.key("v1", {"bandwidth": 30}, df, np.arange(3))
+
+    # same content, same key
+    assert key == cache.key("v1", {"bandwidth": 30}, df.copy(), np.arange(3))
+    for other in [
+        cache.key("v1", {"bandwidth": 31}, df, np.arange(3)),
+        cache.key("v1", {"bandwidth": 30}, df.iloc[::-1], np.arange(3)),
+        cache.key("v1", {"bandwidth": 30}, df.rename(columns={"a": "c"}), np.arange(3)),
+        cache.key("v1", {"bandwidth": 30}, df, np.arange(3, dtype=np.int8)),
+    ]:
+        assert other != key
+
+    assert cache.get(key) is None
+    cache.put(key, df)
+    assert_frame_equal(cache.get(key), df)
+
+    # least recently used first
+    cache.put("old", 1)
+    cache.put("new", 2)
+    os.utime(cache.path("old"), ns=(0, 0))
+    os.utime(cache.path(key), ns=(1, 1))
+    cache.max_size = os.path.getsize(cache.path("new"))
+    assert cache.evict() == 2
+    assert cache.get("old") is None and cache.get(key) is None
+    assert cache.get("new") == 2
+
+
+def test_deconvolute_location(tmp_path):
+    preproc = (
+        ll.DataPreprocesser(raw_tally(n_dates=20))
+        .general_preprocess(
+            variants_list=["B.1.1.7", "B.1.351", "P.1"],
+            variants_pangolin={"al": "B.1.1.7", "be": "B.1.351", "ga": "P.1"},
+            variants_not_reported=[],
+            to_drop=["subset"],
+        )
+        .filter_mutations()
+    )
+    loc_df = preproc.df_tally[preproc.df_tally["location"] == "Plant A"]
+    var_dates = {
+        "var_dates": {
+            "2021-01-01": ["B.1.1.7", "B.1.351", "P.1"],
+            "2021-02-01": ["B.1.1.7", "P.1"],
+        }
+    }
+    args = dict(
+        date_intervals=[("2021-01-01", "2021-02-01"), ("2021-02-01", None)],
+        var_dates=var_dates,
+        no_date=False,
+        **deconv_settings(
+            {"kernel": "box", "kernel_params": {"bandwidth": 10}, "confint": "wald"}
+        ),
+    )
+    cache = ResultCache(tmp_path / "cache")
+
+    def run(df):
+        profiler = Profiler(enabled=True)
+        with profiler.stage("location"):
+            results = deconvolute_location(
+                "Plant A", df, cache=cache, profiler=profiler, progress=False, **args
+            )
+        ref = deconvolute_location("Plant A", df, progress=False, **args)
+        assert len(results) == len(ref) == 6
+        for res, expected in zip(results, ref):
+            assert_frame_equal(res, expected)
+        return [r["solves"] for r in profiler.records if r["stage"] == "interval"]
+
+    assert run(loc_df) == [11, 9]
+    assert run(loc_df) == [0, 0]
+    # only the interval with changed rows is solved again
+    changed = loc_df.copy()
+    changed.loc[changed["date"] >= "2021-02-01", "frac"] /= 2
+    assert run(changed) == [0, 9]
@@ -0,0 +1,81 @@
+import pandas as pd
+import numpy as np
+import json
+import pytest
+from lollipop.cli.results_io import (
+    output_format,
+    write_covspectrum_json,
+    write_results,
+)
+
+
+def test_covspectrum_json(tmp_path):
+    results = pd.DataFrame(
+        {
+            "location": ["Plant A"] * 3 + ["Plant B"],
+            "variant": ["al", "al", "de", "al"],
+            "date": pd.to_datetime(["2021-01-05", "2021-01-06"] * 2),
+            "proportion": [0.25, np.nan, 1 / 3, 1.0],
+            "proportionLower": [0.125, np.inf, 0.0, np.nan],
+        }
+    )
+    columns = ["date", "proportion", "proportionLower"]
+
+    write_covspectrum_json(results, columns, tmp_path / "out.json")
+
+    text = (tmp_path / "out.json").read_text()
+    assert "NaN" not in text and "Infinity" not in text
+    assert json.loads(text) == {
+        "Plant A": {
+            "al": {
+                "timeseriesSummary": [
+                    {
+                        "date": "2021-01-05",
+                        "proportion": 0.25,
+                        "proportionLower": 0.125,
+                    },
+                    {"date": "2021-01-06", "proportion": None, "proportionLower": None},
+                ]
+            },
+            "de": {
+                "timeseriesSummary": [
+                    {"date": "2021-01-05", "proportion": 1 / 3, "proportionLower": 0.0}
+                ]
+            },
+        },
+        "Plant B": {
+            "al": {
+                "timeseriesSummary": [
+                    {"date": "2021-01-06", "proportion": 1.0, "proportionLower": None}
+                ]
+            },
+            # every variant is listed at every location
+            "de": {"timeseriesSummary": []},
+        },
+    }
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "arrow"])
+def test_write_results(tmp_path, fmt):
+    pytest.importorskip("pyarrow")
+    results = pd.DataFrame(
+        {
+            "location": ["Plant A", "Plant A", "Plant B"],
+            "variant": ["al", "de", "al"],
+            "date": pd.to_datetime(["2021-01-05", "2021-01-05", "2021-01-06"]),
+            "proportion": [0.25, 0.75, np.nan],
+        }
+    )
+    output = tmp_path / f"out.{'feather' if fmt == 'arrow' else fmt}"
+    assert output_format(str(output)) == fmt
+    assert output_format("out.tsv.zst") == "tsv"
+
+    write_results(results, output, fmt)
+
+    written = (pd.read_parquet if fmt == "parquet" else pd.read_feather)(output)
+    assert written["location"].dtype == "category"
+    assert written["proportion"].dtype == "float32"
+    pd.testing.assert_frame_equal(
+        written.astype({"location": str, "variant": str, "proportion": float}),
+        results,
+    )
@@ -0,0 +1,106 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from pandas.testing import assert_frame_equal
+from lollipop.cli.serve import DeconvState, make_server
+from test_preprocess import raw_tally
+
+
+@pytest.fixture
+def state(tmp_path):
+    raw_tally(n_dates=30).to_csv(tmp_path / "tally.tsv", sep="\t", index=False)
+    (tmp_path / "variants.yaml").write_text(
+        "variants_pangolin:\n  al: B.1.1.7\n  be: B.1.351\n  ga: P.1\n"
+        "to_drop: [subset]\n"
+    )
+    (tmp_path / "box.yaml").write_text(
+        "kernel: box\nkernel_params:\n  bandwidth: 10\nconfint: wald\n"
+    )
+    (tmp_path / "gaussian.yaml").write_text(
+        "kernel: gaussian\nkernel_params:\n  bandwidth: 30\n"
+        "deconv_params:\n  min_tol: 1.0e-3\n"
+    )
+    (tmp_path / "bootstrap.yaml").write_text(
+        "kernel: gaussian\nkernel_params:\n  bandwidth: 10\n"
+        "deconv_params:\n  min_tol: 1.0e-3\nbootstrap: 10\n"
+    )
+    return DeconvState(
+        str(tmp_path / "tally.tsv"),
+        str(tmp_path / "variants.yaml"),
+        [
+            str(tmp_path / "box.yaml"),
+            str(tmp_path / "gaussian.yaml"),
+            str(tmp_path / "bootstrap.yaml"),
+        ],
+        seed=42,
+    )
+
+
+@pytest.mark.parametrize("preset", ["box", "gaussian", "bootstrap"])
+def test_date_range(state, preset):
+    assert state.refresh()
+    assert not state.refresh()
+    assert state.locations == ["Plant A", "Plant B"]
+    assert state.presets == ["box", "gaussian", "bootstrap"]
+
+    ref = state.deconvolute("Plant B", preset=preset)
+    res = state.deconvolute(
+        "Plant B", start_date="2021-02-01", end_date="2021-02-19", preset=preset
+    )
+
+    # only the data within reach of the kernel, same results on the requested dates
+    assert set(res["date"]) == set(pd.date_range("2021-02-03", "2021-02-19", freq="3D"))
+    expected = ref[ref["date"].isin(res["date"])].reset_index(drop=True)
+    assert_frame_equal(res, expected, check_exact=False, atol=1e-10)
+    if preset == "box":
+        assert {"proportionLower", "proportionUpper"} <= set(res.columns)
+
+
+def test_server(state, tmp_path):
+    state.refresh()
+    server = make_server(state, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def get(path):
+        with urllib.request.urlopen(url + path) as response:
+            return json.loads(response.read())
+
+    try:
+        assert get("/locations") == ["Plant A", "Plant B"]
+        res = get(
+            "/deconvolute?location=Plant%20A&start=2021-01-10&end=2021-01-20"
+            "&preset=gaussian&bandwidth=5"
+        )
+        assert {r["date"] for r in res} == {
+            "2021-01-10",
+            "2021-01-13",
+            "2021-01-16",
+            "2021-01-19",
+        }
+        assert {r["variant"] for r in res} >= {"B.1.1.7", "undetermined"}
+        for status, path in [
+            (404, "/deconvolute?location=nowhere"),
+            (404, "/deconvolute?location=Plant%20A&preset=none"),
+            (400, "/deconvolute"),
+        ]:
+            with pytest.raises(urllib.error.HTTPError) as e:
+                get(path)
+            assert e.value.code == status
+
+        # changed file: reloaded on next request
+        data = state.data
+        (tmp_path / "gaussian.yaml").write_text("kernel: gaussian\n")
+        os.utime(tmp_path / "gaussian.yaml", ns=(0, 0))
+        assert get("/presets") == ["box", "gaussian", "bootstrap"]
+        assert state.data is not data
+        assert state.data["presets"]["gaussian"]["kernel_params"] == {}
+    finally:
+        server.shutdown()
+        server.server_close()
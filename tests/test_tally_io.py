@@ -0,0 +1,98 @@
+import pandas as pd
+import numpy as np
+import pytest
+from pandas.testing import assert_frame_equal
+from lollipop.cli.tally_io import (
+    filters_columns,
+    read_tally_dataset,
+    spill_tally,
+    write_tally_dataset,
+)
+
+
+def test_dataset(tmp_path):
+    pytest.importorskip("pyarrow")
+    rng = np.random.default_rng(42)
+    n = 600
+    df = pd.DataFrame(
+        {
+            "sample": [f"s{i // 20}" for i in range(n)],
+            "date": pd.to_datetime("2021-01-01")
+            + pd.to_timedelta(rng.integers(0, 90, size=n), unit="D"),
+            "location": rng.choice(["Plant A", "Plant B/C", "Plant D"], size=n),
+            "location_code": rng.choice(["1", "01"], size=n),
+            "pos": rng.integers(1, 29000, size=n),
+            "proto": "v3",
+            "frac": rng.random(n),
+            "al": rng.choice(["mut", None], size=n),
+        }
+    )
+    write_tally_dataset(df, tmp_path / "ds", row_group_size=50)
+
+    res = read_tally_dataset(
+        tmp_path / "ds",
+        columns=["date", "location", "location_code", "pos", "frac", "al", "absent"],
+        locations=["Plant B/C", "Plant D"],
+        start_date="2021-02-01",
+        end_date="2021-03-01",
+    )
+    ref = df[
+        df["location"].isin(["Plant B/C", "Plant D"])
+        & (df["date"] >= "2021-02-01")
+        & (df["date"] < "2021-03-01")
+    ]
+
+    assert list(res.columns) == [
+        "date",
+        "location_code",
+        "pos",
+        "frac",
+        "al",
+        "location",
+    ]
+    key = ["location", "date", "pos"]
+    assert_frame_equal(
+        res.sort_values(key).reset_index(drop=True),
+        ref[res.columns].sort_values(key).reset_index(drop=True),
+        check_dtype=False,
+    )
+
+
+def test_filters_columns():
+    assert filters_columns(
+        {"a": ["proto v3", "date > 2021-11-20"], "b": ["'gene' ~ /ORF/"]}
+    ) == {"proto", "date", "gene"}
+
+
+def test_spill(tmp_path):
+    rng = np.random.default_rng(42)
+    n = 500
+    df = pd.DataFrame(
+        {
+            "date": pd.to_datetime("2021-01-01")
+            + pd.to_timedelta(rng.integers(0, 90, size=n), unit="D"),
+            "location_code": rng.choice(["01", "02", "03"], size=n),
+            "pos": rng.integers(1, 29000, size=n),
+            "frac": rng.random(n),
+        }
+    )
+    df.to_csv(tmp_path / "tally.tsv", sep="\t", index=False)
+
+    def preprocess(chunk):
+        assert len(chunk) <= 64
+        chunk["location"] = chunk["location_code"]
+        return chunk[chunk["frac"] > 0.5]
+
+    spilled = spill_tally(
+        tmp_path / "tally.tsv",
+        tmp_path,
+        64,
+        preprocess=preprocess,
+        locations=["01", "03"],
+    )
+
+    assert set(spilled) == {"01", "03"}
+    for location, files in spilled.items():
+        res = pd.concat([pd.read_pickle(file) for file in files])
+        ref = df[(df["location_code"] == location) & (df["frac"] > 0.5)]
+        assert_frame_equal(res.drop(columns="location"), ref)